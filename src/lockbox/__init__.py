@@ -1 +1,2 @@
 from src.lockbox.main import *  # noqa
+from src.lockbox.agent import Agent, AgentClient, connect_agent  # noqa
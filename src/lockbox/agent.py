@@ -0,0 +1,213 @@
+import base64
+import json
+import os
+import secrets
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+
+from src.lockbox.main import (
+    HASH_ITERATIONS,
+    SALT_LENGTH,
+    KeyCache,
+    LockBoxException,
+)
+
+AGENT_SOCKET_ENV = "LOCKBOX_AGENT_SOCK"
+AGENT_TTL = 60 * 60  # 1 hour
+AGENT_KEY_TTL = 60 * 5  # 5 minutes
+AGENT_CACHE_SIZE = 64
+
+# Requests are single lines of JSON. Anything longer is not a valid request.
+MAX_REQUEST = 4096
+# Refuse to spend more than this on a single key derivation for a client
+MAX_ITERATIONS = HASH_ITERATIONS * 10
+
+_PEER_CREDENTIALS = struct.Struct("3i")  # pid, uid, gid
+
+
+def default_agent_path():
+    runtime_directory = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return Path(runtime_directory) / f"lockbox-{os.getuid()}" / "agent.sock"
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while line := self.rfile.readline(MAX_REQUEST):
+            try:
+                response = self.server.respond(json.loads(line))
+            except (ValueError, KeyError, TypeError, LockBoxException) as e:
+                response = {"error": str(e) or e.__class__.__name__}
+
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class Agent(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # Holds a passphrase for ttl seconds and derives keys from it for clients
+    # on the same machine. Clients are handed the derived keys and do the
+    # encryption themselves, so any process of the same user that can reach
+    # the socket can get them. Keys are kept for the most recently used
+    # cache_size salts and dropped key_ttl seconds after they were derived.
+    # Files encrypted through the agent all share one salt, so the key
+    # derivation only runs again once that key has been dropped.
+    daemon_threads = True
+
+    def __init__(
+        self,
+        password,
+        path=None,
+        ttl=AGENT_TTL,
+        cache_size=AGENT_CACHE_SIZE,
+        key_ttl=AGENT_KEY_TTL,
+    ):
+        if isinstance(password, str):
+            password = password.encode("utf-8")
+
+        self.path = Path(path or default_agent_path())
+        self.password = password
+        self.ttl = ttl
+        self.expires = time.monotonic() + ttl
+        self.salt = secrets.token_bytes(SALT_LENGTH)
+        # The agent forgets everything once its ttl is up, and each key once
+        # its key_ttl is
+        self.keys = KeyCache(maxsize=cache_size, ttl=key_ttl)
+
+        self._prepare_path()
+        super().__init__(str(self.path), _AgentHandler)
+        os.chmod(self.path, 0o600)
+
+    def _prepare_path(self):
+        directory = self.path.parent
+        directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if directory.stat().st_uid != os.getuid():
+            raise LockBoxException(f"{directory} is owned by another user")
+
+        if self.path.is_socket():
+            if AgentClient(self.path).ping():
+                raise LockBoxException(f"An agent is already running at {self.path}")
+            # Left behind by an agent that did not shut down cleanly
+            self.path.unlink()
+        elif self.path.exists():
+            raise LockBoxException(f"{self.path} already exists")
+
+    def verify_request(self, request, client_address):
+        # The socket is only accessible to its owner, but where the platform
+        # reports the peer, make sure it belongs to the same user as well
+        if not hasattr(socket, "SO_PEERCRED"):
+            return True
+
+        credentials = request.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, _PEER_CREDENTIALS.size
+        )
+        _, uid, _ = _PEER_CREDENTIALS.unpack(credentials)
+        return uid == os.getuid()
+
+    def service_actions(self):
+        # Runs between requests, at least every poll interval of serve_forever
+        self.keys.expire()
+
+    def respond(self, request):
+        operation = request["op"]
+
+        if operation == "ping":
+            return {
+                "ttl": max(self.expires - time.monotonic(), 0),
+                "keys": len(self.keys),
+            }
+        elif operation == "salt":
+            return {"salt": base64.b64encode(self.salt).decode("ascii")}
+        elif operation == "derive":
+            salt = base64.b64decode(request["salt"], validate=True)
+            iterations = int(request["iterations"])
+            if not salt or not 0 < iterations <= MAX_ITERATIONS:
+                raise LockBoxException("Invalid key derivation parameters")
+
+            key = self.keys.derive_key(self.password, salt, iterations)
+            return {"key": base64.b64encode(key).decode("ascii")}
+        elif operation == "stop":
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return {}
+
+        raise LockBoxException(f"Unknown operation {operation}")
+
+    def run(self):
+        timer = threading.Timer(self.ttl, self.shutdown)
+        timer.daemon = True
+        timer.start()
+        try:
+            self.serve_forever()
+        finally:
+            timer.cancel()
+            self.close()
+
+    def close(self):
+        self.server_close()
+        self.path.unlink(missing_ok=True)
+        self.password = None
+        self.keys.clear()
+
+
+class AgentClient:
+    # Stands in for a passphrase anywhere lockbox takes one. Keys are derived
+    # by the agent and only the salt it already holds a key for is used for
+    # new files and strings. Only the socket path is kept, so clients can be
+    # handed to worker processes.
+    def __init__(self, path=None):
+        self.path = Path(
+            path or os.environ.get(AGENT_SOCKET_ENV) or default_agent_path()
+        )
+        self._salt = None
+
+    def _request(self, **request):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(str(self.path))
+                sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+                with sock.makefile("rb") as response_file:
+                    response = json.loads(response_file.readline())
+        except (OSError, ValueError) as e:
+            raise LockBoxException(f"Could not reach lockbox agent at {self.path}: {e}")
+
+        if "error" in response:
+            raise LockBoxException(f"lockbox agent: {response['error']}")
+        return response
+
+    def ping(self):
+        try:
+            return self._request(op="ping")
+        except LockBoxException:
+            return None
+
+    def new_salt(self):
+        if self._salt is None:
+            self._salt = base64.b64decode(self._request(op="salt")["salt"])
+        return self._salt
+
+    def derive_key(self, salt, iterations):
+        response = self._request(
+            op="derive",
+            salt=base64.b64encode(salt).decode("ascii"),
+            iterations=iterations,
+        )
+        return base64.b64decode(response["key"])
+
+    def stop(self):
+        self._request(op="stop")
+
+
+def connect_agent(path=None):
+    # Returns a client for the agent given by path or LOCKBOX_AGENT_SOCK, or
+    # None when no agent is running there
+    path = path or os.environ.get(AGENT_SOCKET_ENV)
+    if not path:
+        return None
+
+    client = AgentClient(path)
+    if not client.path.is_socket() or client.ping() is None:
+        return None
+    return client
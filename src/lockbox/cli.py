@@ -1,5 +1,8 @@
+import contextlib
 import os
+import sys
 import getpass
+from datetime import datetime
 from pathlib import Path
 
 from src.lockbox import (
@@ -7,16 +10,35 @@ from src.lockbox import (
     decrypt,
     encrypt_file,
     decrypt_file,
+    encrypt_stream,
+    decrypt_stream,
     encrypt_directory,
     decrypt_directory,
+    decrypt_range,
+    pack_directory,
+    unpack_archive,
+    Vault,
+    Repository,
     LockBoxException,
     LOCKBOX_SUFFIX,
+    DEFAULT_CIPHER,
+    REPOSITORY_CONFIG,
+)
+from src.lockbox.agent import (
+    Agent,
+    AGENT_SOCKET_ENV,
+    AGENT_TTL,
+    connect_agent,
+    default_agent_path,
 )
 
 from blessings import Terminal
 
 term = Terminal()
 YES = ("y", "yes")
+# Input file name that streams from stdin
+STDIN = "-"
+SIZE_SUFFIXES = {"k": 1024, "m": 1024**2, "g": 1024**3}
 
 
 def cli_encrypt(
@@ -27,17 +49,59 @@ def cli_encrypt(
     recursive=False,
     remove_original=False,
     force=False,
+    armor=False,
+    cipher=DEFAULT_CIPHER,
+    index=False,
+    pipeline=False,
+    jobs=1,
+    pool="thread",
+    incremental=False,
+    resume=False,
+    chunk_size=None,
+    compression=None,
 ):
+    if chunk_size:
+        chunk_size = _parse_size(chunk_size)
+
+    if infile == STDIN:
+        if outfile:
+            outfile = Path(outfile)
+        elif not armor and sys.stdout.isatty():
+            raise LockBoxException(
+                "Refusing to write binary data to a terminal, use --armor or --output"
+            )
+
+        _validate_files(None, outfile, force)
+        _confirm_passphrase(passphrase)
+        with _binary_output(outfile) as output:
+            encrypt_stream(
+                passphrase,
+                sys.stdin.buffer,
+                output,
+                armor=armor,
+                cipher=cipher,
+                index=index,
+                pipeline=pipeline,
+                workers=jobs,
+                chunk_size=chunk_size,
+                compression=compression,
+            )
+        return
+
     if infile:
         infile = Path(infile)
 
+    # Recursively encrypting into a given output directory mirrors the input
+    output_directory = None
     if outfile:
         outfile = Path(outfile)
+        if recursive and infile and infile.is_dir():
+            output_directory = outfile
     else:
         if infile:
             outfile = infile.parent / f"{infile.name}{LOCKBOX_SUFFIX}"
 
-    _validate_files(infile, outfile, force)
+    _validate_files(infile, None if output_directory else outfile, force)
     _confirm_passphrase(passphrase)
 
     if data:
@@ -47,7 +111,17 @@ def cli_encrypt(
     else:
         if infile.is_file():
             encrypt_file(
-                passphrase, infile, output_file=outfile, remove_original=remove_original
+                passphrase,
+                infile,
+                output_file=outfile,
+                remove_original=remove_original,
+                armor=armor,
+                cipher=cipher,
+                index=index,
+                pipeline=pipeline,
+                workers=jobs,
+                chunk_size=chunk_size,
+                compression=compression,
             )
         elif infile.is_dir():
             if not recursive:
@@ -57,6 +131,10 @@ def cli_encrypt(
                     )
                 )
             else:
+                if output_directory and remove_original:
+                    raise LockBoxException(
+                        "Originals are kept when encrypting into an output directory"
+                    )
                 if recursive and remove_original:
                     print(
                         term.yellow(
@@ -70,10 +148,43 @@ def cli_encrypt(
                     )
                     if confirm.lower() not in YES:
                         raise LockBoxException("User Aborted")
-                encrypt_directory(passphrase, infile)
+                encrypt_directory(
+                    passphrase,
+                    infile,
+                    cipher=cipher,
+                    workers=jobs,
+                    pool=pool,
+                    output_directory=output_directory,
+                    incremental=incremental,
+                    resume=resume,
+                    chunk_size=chunk_size,
+                    compression=compression,
+                )
                 print(term.green("Done"))
 
 
+def _parse_size(size):
+    # Sizes are a number of bytes, optionally followed by K, M or G
+    multiplier = SIZE_SUFFIXES.get(size[-1:].lower())
+    try:
+        value = int(size[:-1] if multiplier else size) * (multiplier or 1)
+    except ValueError:
+        raise LockBoxException(
+            f"Invalid size {size}, expected a size such as 64K or 16M"
+        )
+    return value
+
+
+@contextlib.contextmanager
+def _binary_output(outfile):
+    if outfile:
+        with open(outfile, "wb") as output:
+            yield output
+    else:
+        yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
+
+
 def _validate_files(infile, outfile, force):
     if infile and not infile.exists():
         raise LockBoxException(f"{infile} does not exist")
@@ -87,6 +198,10 @@ def _validate_files(infile, outfile, force):
 
 
 def _confirm_passphrase(passphrase):
+    if not isinstance(passphrase, bytes):
+        # The passphrase was confirmed when the agent was started
+        return
+
     confirm_passphrase = getpass.getpass("Confirm passphrase: ").encode("utf-8")
 
     if passphrase != confirm_passphrase:
@@ -102,12 +217,33 @@ def cli_decrypt(
     recursive=False,
     remove_original=False,
     force=False,
+    jobs=1,
+    byte_range=None,
+    pipeline=False,
+    pool="thread",
+    resume=False,
 ):
+    if outfile:
+        outfile = Path(outfile)
+
+    if infile == STDIN:
+        _validate_files(None, outfile, force)
+        with _binary_output(outfile) as output:
+            decrypt_stream(
+                passphrase,
+                sys.stdin.buffer,
+                output,
+                workers=jobs,
+                pipeline=pipeline,
+            )
+        return
+
     if infile:
         infile = Path(infile)
 
-    if outfile:
-        outfile = Path(outfile)
+    if byte_range:
+        _cli_decrypt_range(passphrase, infile, outfile, byte_range, force)
+        return
 
     if not recursive:
         if infile and infile.suffix == LOCKBOX_SUFFIX:
@@ -142,7 +278,12 @@ def cli_decrypt(
                 if confirm.lower() not in YES:
                     return
             decrypt_file(
-                passphrase, infile, output_file=outfile, remove_original=remove_original
+                passphrase,
+                infile,
+                output_file=outfile,
+                remove_original=remove_original,
+                workers=jobs,
+                pipeline=pipeline,
             )
         elif os.path.isdir(infile):
             if not recursive:
@@ -152,5 +293,179 @@ def cli_decrypt(
                     )
                 )
             else:
-                decrypt_directory(passphrase, infile)
+                decrypt_directory(
+                    passphrase, infile, workers=jobs, pool=pool, resume=resume
+                )
                 print(term.green("Done"))
+
+
+def _cli_decrypt_range(passphrase, infile, outfile, byte_range, force):
+    if not infile or not infile.is_file():
+        raise LockBoxException("A byte range can only be decrypted from a file")
+
+    try:
+        offset, length = (int(value) for value in byte_range.split(":"))
+    except ValueError:
+        raise LockBoxException(
+            f"Invalid byte range {byte_range}, expected OFFSET:LENGTH"
+        )
+
+    _validate_files(infile, outfile, force)
+
+    stdout_data = decrypt_range(passphrase, infile, offset, length, output_file=outfile)
+    if not outfile:
+        # Ranges are arbitrary bytes, so they are written out unchanged
+        with _binary_output(None) as output:
+            output.write(stdout_data)
+
+
+def cli_pack(
+    passphrase,
+    infile,
+    outfile=None,
+    force=False,
+    cipher=DEFAULT_CIPHER,
+    compression=None,
+):
+    infile = Path(infile)
+
+    if outfile:
+        outfile = Path(outfile)
+    else:
+        outfile = infile.parent / f"{infile.name}{LOCKBOX_SUFFIX}"
+
+    _validate_files(infile, outfile, force)
+    if not infile.is_dir():
+        raise LockBoxException(f"{infile} is not a directory")
+    _confirm_passphrase(passphrase)
+
+    pack_directory(passphrase, infile, outfile, cipher=cipher, compression=compression)
+    print(term.green("Done"))
+
+
+def cli_unpack(passphrase, infile, outfile=None, members=None, preserve_mode=False):
+    infile = Path(infile)
+
+    if outfile:
+        outfile = Path(outfile)
+    elif infile.suffix == LOCKBOX_SUFFIX:
+        outfile = infile.parent / infile.stem
+    else:
+        raise LockBoxException(
+            f"Could not automatically determine output directory for {infile}"
+        )
+
+    _validate_files(infile, None, False)
+
+    unpack_archive(
+        passphrase, infile, outfile, members=members, preserve_mode=preserve_mode
+    )
+    print(term.green("Done"))
+
+
+def cli_agent(passphrase, socket_path=None, ttl=AGENT_TTL, foreground=False):
+    _confirm_passphrase(passphrase)
+
+    agent = Agent(passphrase, path=socket_path, ttl=ttl)
+    print(f"{AGENT_SOCKET_ENV}={agent.path}; export {AGENT_SOCKET_ENV};")
+
+    if not foreground:
+        sys.stdout.flush()
+        if os.fork():
+            agent.socket.close()
+            return
+
+        # Detach from the terminal so that the agent outlives the shell
+        # command that started it
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+
+    agent.run()
+
+
+def cli_agent_stop(socket_path=None):
+    agent = connect_agent(socket_path or default_agent_path())
+    if not agent:
+        raise LockBoxException("No lockbox agent is running")
+
+    agent.stop()
+    print(term.green("Agent stopped"))
+
+
+def _existing_vault(vault):
+    vault = Path(vault)
+    if not vault.is_file():
+        raise LockBoxException(f"{vault} does not exist")
+    return vault
+
+
+def cli_vault_get(passphrase, vault, name):
+    with Vault(passphrase, _existing_vault(vault)) as opened:
+        value = opened.get(name)
+
+    # Values may be binary, so they are written out as they were stored
+    with _binary_output(None) as output:
+        output.write(value)
+
+
+def cli_vault_set(passphrase, vault, name, value, cipher=DEFAULT_CIPHER):
+    vault = Path(vault)
+    if not vault.exists():
+        # The passphrase of a new vault is needed to read any of it later
+        _confirm_passphrase(passphrase)
+
+    with Vault(passphrase, vault, cipher=cipher) as opened:
+        opened.set(name, value)
+
+
+def cli_vault_list(passphrase, vault):
+    with Vault(passphrase, _existing_vault(vault)) as opened:
+        for name in opened.names():
+            print(name)
+
+
+def _existing_repository(repository):
+    repository = Path(repository)
+    if not (repository / REPOSITORY_CONFIG).is_file():
+        raise LockBoxException(f"{repository} is not a lockbox repository")
+    return repository
+
+
+def cli_repo_backup(
+    passphrase, repository, directory, cipher=DEFAULT_CIPHER, compression=None, jobs=1
+):
+    repository = Path(repository)
+    if not (repository / REPOSITORY_CONFIG).exists():
+        # The passphrase of a new repository is needed to restore any of it
+        _confirm_passphrase(passphrase)
+
+    opened = Repository(passphrase, repository, cipher=cipher, compression=compression)
+    snapshot = opened.backup(Path(directory), workers=jobs)
+    print(term.green(f"Snapshot {snapshot.id} saved"))
+
+
+def cli_repo_snapshots(passphrase, repository):
+    opened = Repository(passphrase, _existing_repository(repository))
+    for snapshot in opened.snapshots():
+        saved = datetime.fromtimestamp(snapshot.time).isoformat(
+            sep=" ", timespec="seconds"
+        )
+        print(f"{snapshot.id}  {saved}  {snapshot.source}")
+
+
+def cli_repo_restore(
+    passphrase, repository, snapshot, outfile, members=None, preserve_mode=False
+):
+    opened = Repository(passphrase, _existing_repository(repository))
+    opened.restore(
+        snapshot, Path(outfile), members=members, preserve_mode=preserve_mode
+    )
+    print(term.green("Done"))
+
+
+def cli_repo_forget(passphrase, repository, snapshot):
+    opened = Repository(passphrase, _existing_repository(repository))
+    removed = opened.forget(snapshot)
+    print(term.green(f"Snapshot forgotten, {removed} unused chunks removed"))
@@ -1,24 +1,190 @@
 import base64
+import collections
+import contextlib
+import functools
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import lzma
+import math
+import mmap
+import multiprocessing
 import os
+import queue
 import secrets
+import sqlite3
+import stat
+import struct
+import sys
+import threading
+import time
+import zlib
 
-from pathlib import Path
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from pathlib import Path, PurePosixPath
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF, HKDFExpand
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
 from tqdm import tqdm
 
 import qrcode
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 LOCKBOX_SUFFIX = ".lockbox"
 
 SALT_LENGTH = 16
+NONCE_LENGTH = 16
 KEY_LENGTH = 32
 HASH_ITERATIONS = 1_200_000
 
 CHUNK_SIZE = 1024 * 1024 * 10  # 10 MB
+MAX_CHUNK_SIZE = 1024 * 1024 * 256  # 256 MB
+LEGACY_CHUNK_SIZE = 1024 * 1024 * 10  # 10 MB
+
+# Unless a chunk size is given, it is chosen from what is known of the input.
+# Input of unknown size, such as a pipe, is sent on in STREAM_CHUNK_SIZE frames
+# so that output starts to appear early. Files grow past CHUNK_SIZE chunks once
+# they would take more than LARGE_FILE_FRAMES frames, up to LARGE_CHUNK_SIZE,
+# and are cut into at least WORKER_FRAMES frames for every worker encrypting
+# them, down to MIN_CHUNK_SIZE.
+STREAM_CHUNK_SIZE = 1024 * 1024  # 1 MB
+MIN_CHUNK_SIZE = 1024 * 64  # 64 KB
+LARGE_CHUNK_SIZE = 1024 * 1024 * 64  # 64 MB
+LARGE_FILE_FRAMES = 1024
+WORKER_FRAMES = 4
+
+# Number of chunks that may queue up between each stage of a pipeline
+PIPELINE_DEPTH = 2
+
+# encrypt_file maps regular files of at least MMAP_MIN_SIZE bytes into memory
+# instead of reading them. A mapped file that is truncated while it is being
+# encrypted kills the process, so files of directory runs are always read.
+MMAP_MIN_SIZE = 1024 * 1024 * 64  # 64 MB
+
+# Bounds of the optional in-process cache of derived keys
+KEY_CACHE_SIZE = 128
+KEY_CACHE_TTL = 60 * 5  # 5 minutes
+
+# Process pools start their workers on demand, while the directory scan and
+# progress threads are running, so workers must not be forked
+_PROCESS_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+DIRECTORY_POOLS = {
+    "thread": ThreadPoolExecutor,
+    "process": functools.partial(ProcessPoolExecutor, mp_context=_PROCESS_CONTEXT),
+}
+
+# Directory jobs hand files of up to SMALL_FILE_SIZE bytes to workers in
+# batches of BATCH_FILES, and split files of at least twice SPLIT_FRAMES frames
+# into ranges of SPLIT_FRAMES frames that are processed by different workers.
+SMALL_FILE_SIZE = 1024 * 64  # 64 KB
+BATCH_FILES = 32
+SPLIT_FRAMES = 4
+
+# Number of files the directory walk may find before workers take them
+SCAN_AHEAD = 10_000
+
+# Version 2 files start with a header carrying the salt and KDF parameters, so
+# the key is derived once per file rather than once per chunk. The header is
+# followed by length-prefixed binary frames. Armored files carry the same
+# header and frames base64 encoded, one per line, behind HEADER_PREFIX.
+FORMAT_VERSION = 2
+MAGIC = b"\x89LOCKBOX"
+HEADER_PREFIX = b"lockbox$"
+# version, cipher id, flags, iterations, chunk size, salt, nonce
+_HEADER = struct.Struct(f">BBBII{SALT_LENGTH}s{NONCE_LENGTH}s")
+_FRAME_LENGTH = struct.Struct(">I")
+_FRAME_NONCE = struct.Struct(">Q??xx")  # frame index, final frame, index frame
+_AEAD_TAG_LENGTH = 16
+
+# Indexed files follow their data frames with an end of frames marker, the
+# offset of every data frame spread over frames of their own, another marker
+# and a trailer pointing at the first index frame so the index can be found by
+# seeking from the end of the file.
+FLAG_INDEXED = 0x01
+_INDEX_TRAILER = struct.Struct(">QQ")  # index offset, data frame count
+_INDEX_ENTRY = struct.Struct(">Q")
+
+# The plaintext of an archive is a record for every file followed by its
+# contents, an empty record, the member table and a trailer pointing at the
+# table. Table entries are the offset of the file contents followed by the
+# same record.
+FLAG_ARCHIVE = 0x02
+_MEMBER = struct.Struct(">HQIq")  # name length, size, mode, mtime in ns
+_MEMBER_OFFSET = struct.Struct(">Q")
+_ARCHIVE_TRAILER = struct.Struct(">QQ")  # member table offset, member count
+
+# Values encrypted together share one header and key. Every token is the
+# header, the position of the value in its batch and the value encrypted as a
+# frame of its own, so tokens can still be decrypted one at a time.
+FLAG_BATCH = 0x04
+_BATCH_INDEX = struct.Struct(">I")
+
+# Vaults are sqlite databases holding a header and a row for every entry. An
+# entry is its name and value encrypted together under a random nonce, which
+# is stored in front of it, and is found by a keyed hash of the name.
+FLAG_VAULT = 0x08
+_VAULT_NAME = struct.Struct(">H")
+
+# Compressed files carry the id of their compression method in these bits of
+# the flags. Every frame of a compressed file starts with a byte saying whether
+# the rest of it is compressed, since chunks that look like they are already
+# compressed, or that do not shrink, are stored as they are.
+_COMPRESSION_SHIFT = 4
+_COMPRESSION_MASK = 0x70
+_FRAME_STORED = b"\x00"
+_FRAME_COMPRESSED = b"\x01"
+
+# Chunks are sampled in ENTROPY_SAMPLES slices adding up to ENTROPY_SAMPLE_SIZE
+# bytes. Samples with more than ENTROPY_THRESHOLD bits of entropy per byte are
+# taken to be compressed or encrypted already and are not compressed again.
+ENTROPY_SAMPLE_SIZE = 4096
+ENTROPY_SAMPLES = 4
+ENTROPY_THRESHOLD = 7.5
+
+# Repositories are directories of deduplicated snapshots. Files are cut into
+# chunks at boundaries found from their contents, so an insertion only changes
+# the chunks around it. Every chunk is stored once, encrypted, under a keyed
+# hash of its contents, and a snapshot is a manifest listing the chunks of
+# every file. The config file holds the header all keys are derived from. Its
+# chunk size is the largest chunk; chunks average an eighth of it and are at
+# least a sixteenth of it, so it must be at least REPOSITORY_MIN_CHUNK_SIZE.
+# Gear hashes for the boundaries are found GEAR_BLOCK_SIZE bytes at a time.
+FLAG_REPOSITORY = 0x80
+REPOSITORY_CHUNK_SIZE = 1024 * 1024 * 8  # 8 MB
+REPOSITORY_CONFIG = "config"
+REPOSITORY_DATA = "data"
+REPOSITORY_SNAPSHOTS = "snapshots"
+SNAPSHOT_ID_LENGTH = 8
+REPOSITORY_MIN_CHUNK_SIZE = 16
+GEAR_BLOCK_SIZE = 1024 * 64  # 64 KB
+_GEAR = struct.Struct(">256I")
+Snapshot = collections.namedtuple("Snapshot", ["id", "time", "source"])
+
+DEFAULT_CIPHER = "auto"
 
 QR_CODE_EXTENSIONS = (".png",)
 
@@ -27,49 +193,501 @@ class LockBoxException(Exception):
     pass
 
 
-def _count_files(path):
-    total_files = 0
-    for root, dirs, files in os.walk(path):
-        total_files += len(files)
-    return total_files
+def _scan_files(directory, select=None, unreadable=None):
+    # Walks directory with os.scandir, yielding (path, size) for every regular
+    # file accepted by select. The type of each entry comes from the directory
+    # listing itself, so only the files that are yielded are stat'ed.
+    # Symlinks are never followed or yielded. Each directory is listed in full
+    # before any of its files are yielded so that files written next to them
+    # while the walk is running are not picked up. Directories and entries
+    # that can not be read are skipped, and added to the unreadable list when
+    # one is given.
+    stack = [os.fspath(directory)]
+    while stack:
+        path = stack.pop()
+        try:
+            entries = os.scandir(path)
+        except OSError:
+            if unreadable is not None:
+                unreadable.append(Path(path))
+            continue
+
+        files = []
+        subdirectories = []
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False) and (
+                        select is None or select(entry)
+                    ):
+                        files.append(
+                            (
+                                Path(entry.path),
+                                entry.stat(follow_symlinks=False).st_size,
+                            )
+                        )
+                except OSError:
+                    if unreadable is not None:
+                        unreadable.append(Path(entry.path))
+                    continue
 
+        yield from files
+        stack.extend(reversed(subdirectories))
 
-def _path_generator(directory):
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            fullpath = Path(root) / file
-            yield fullpath
 
+@contextlib.contextmanager
+def _scan_in_background(files, progress):
+    # Runs the files generator on its own thread so that work can start on the
+    # first files while the rest of the tree is still being walked. Files are
+    # put on a priority queue as (-size, sequence, path) so the largest file
+    # found so far is always taken first. The walk ends with a (1, sequence,
+    # None) item and errors jump the queue. The progress total grows by the
+    # size of each file as it is found. The walk waits while SCAN_AHEAD files
+    # are queued, so the largest file is only picked from those.
+    found = queue.PriorityQueue(maxsize=SCAN_AHEAD)
+    stop = threading.Event()
+    sequence = itertools.count()
 
-def _get_fernet(password, salt):
+    def scan():
+        try:
+            for path, size in files:
+                if stop.is_set():
+                    return
+                progress.total += size
+                found.put((-size, next(sequence), path))
+        except BaseException as e:
+            found.put((-math.inf, next(sequence), e))
+        finally:
+            found.put((1, next(sequence), None))
+
+    thread = threading.Thread(target=scan, daemon=True)
+    thread.start()
+    try:
+        yield found
+    finally:
+        stop.set()
+        # Make room for a walk that is waiting to queue a file
+        while thread.is_alive():
+            with contextlib.suppress(queue.Empty):
+                found.get(timeout=0.1)
+        thread.join()
+
+
+class KeyCache:
+    # Keeps the keys derived from passphrases, and the ciphers built from
+    # them, for up to ttl seconds, dropping the least recently used entries
+    # beyond maxsize. Entries are found by salt, KDF parameters and a hash of
+    # the passphrase keyed with a secret of the cache, so passphrases are
+    # never kept.
+    def __init__(self, maxsize=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._secret = secrets.token_bytes(KEY_LENGTH)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def expire(self):
+        # Drops the entries whose ttl is up
+        now = time.monotonic()
+        with self._lock:
+            for expired in [k for k, (e, _) in self._entries.items() if e <= now]:
+                del self._entries[expired]
+
+    def _get(self, key, create):
+        now = time.monotonic()
+        with self._lock:
+            expires, value = self._entries.get(key, (0, None))
+            if expires > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = create()
+
+        self.expire()
+        with self._lock:
+            self._entries[key] = (now + self.ttl if self.ttl else math.inf, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def get(self, password, salt, iterations, *extra, create):
+        digest = hmac.digest(self._secret, password, "sha256")
+        return self._get((salt, iterations, digest, *extra), create)
+
+    def derive_key(self, password, salt, iterations=HASH_ITERATIONS):
+        return self.get(
+            password,
+            salt,
+            iterations,
+            create=lambda: _pbkdf2(password, salt, iterations),
+        )
+
+
+_key_cache = None
+
+
+def enable_key_cache(maxsize=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL):
+    # Keys derived from passphrases in this process are cached from now on.
+    # Returns the cache so that it can be cleared or its hit rate checked.
+    global _key_cache
+    _key_cache = KeyCache(maxsize=maxsize, ttl=ttl)
+    return _key_cache
+
+
+def disable_key_cache():
+    global _key_cache
+    _key_cache = None
+
+
+def _derive_key(password, salt, iterations=HASH_ITERATIONS):
+    if not isinstance(password, bytes):
+        # Keys are derived by whoever holds the passphrase, such as a lockbox
+        # agent, without the passphrase ever reaching this process
+        return password.derive_key(salt, iterations)
+
+    if _key_cache is not None:
+        return _key_cache.derive_key(password, salt, iterations)
+    return _pbkdf2(password, salt, iterations)
+
+
+def _pbkdf2(password, salt, iterations):
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=KEY_LENGTH,
         salt=salt,
-        iterations=HASH_ITERATIONS,
+        iterations=iterations,
+        backend=default_backend(),
+    )
+
+    return kdf.derive(password)
+
+
+def _new_salt(password):
+    # A lockbox agent hands out the salt of a key it has already derived. Every
+    # file still gets keys of its own from the random nonce in its header.
+    if not isinstance(password, bytes):
+        return password.new_salt()
+
+    return secrets.token_bytes(SALT_LENGTH)
+
+
+def _get_fernet(password, salt):
+    if _key_cache is None or not isinstance(password, bytes):
+        key = _derive_key(password, salt, HASH_ITERATIONS)
+        return Fernet(base64.urlsafe_b64encode(key))
+
+    def create():
+        key = _pbkdf2(password, salt, HASH_ITERATIONS)
+        return Fernet(base64.urlsafe_b64encode(key))
+
+    return _key_cache.get(password, salt, HASH_ITERATIONS, "fernet", create=create)
+
+
+class _FernetCipher:
+    # Adapts Fernet to the AEAD interface used by the other ciphers. Every
+    # frame gets its own Fernet subkey expanded from the nonce and associated
+    # data, and the base64 layer of the token is stripped.
+    def __init__(self, key):
+        self._key = key
+
+    def _get_fernet(self, nonce, associated_data):
+        hkdf = HKDFExpand(
+            algorithm=hashes.SHA256(),
+            length=KEY_LENGTH,
+            info=associated_data + nonce,
+            backend=default_backend(),
+        )
+        return Fernet(base64.urlsafe_b64encode(hkdf.derive(self._key)))
+
+    def encrypt(self, nonce, data, associated_data):
+        # Fernet only takes bytes, not the buffers chunks are read into
+        token = self._get_fernet(nonce, associated_data).encrypt(bytes(data))
+        return base64.urlsafe_b64decode(token)
+
+    def decrypt(self, nonce, data, associated_data):
+        token = base64.urlsafe_b64encode(data)
+        return self._get_fernet(nonce, associated_data).decrypt(token)
+
+
+Cipher = collections.namedtuple("Cipher", ["cipher_id", "name", "factory", "overhead"])
+
+# Ciphers available for version 2 files. A factory takes a KEY_LENGTH byte key
+# and returns an object with AEAD style encrypt(nonce, data, associated_data)
+# and decrypt(nonce, data, associated_data) methods. The overhead is the most
+# a ciphertext can grow over its plaintext.
+CIPHERS = {
+    cipher.name: cipher
+    for cipher in (
+        Cipher(0, "fernet", _FernetCipher, 73),
+        Cipher(1, "aes-256-gcm", AESGCM, _AEAD_TAG_LENGTH),
+        Cipher(2, "chacha20-poly1305", ChaCha20Poly1305, _AEAD_TAG_LENGTH),
+    )
+}
+
+
+def _frame_length(cipher, length):
+    # Exact length of the ciphertext of a frame holding length bytes
+    if cipher.name == "fernet":
+        # Version, timestamp, IV, PKCS7 padded ciphertext and HMAC
+        return 57 + (length // 16 + 1) * 16
+    return length + cipher.overhead
+
+
+def _get_cipher(name):
+    if name == "auto":
+        name = _fastest_cipher()
+
+    try:
+        return CIPHERS[name]
+    except KeyError:
+        raise LockBoxException(f"Unknown cipher {name}")
+
+
+def _get_cipher_by_id(cipher_id):
+    for cipher in CIPHERS.values():
+        if cipher.cipher_id == cipher_id:
+            return cipher
+
+    raise LockBoxException(f"Unknown cipher id {cipher_id}")
+
+
+def _decompress_stream(decompressor, data, max_length):
+    # Output is capped just past max_length, so a frame can never expand to
+    # more than a chunk
+    decompressor = decompressor()
+    try:
+        data = decompressor.decompress(data, max_length + 1)
+    except (zlib.error, lzma.LZMAError):
+        raise LockBoxException("Invalid compressed frame")
+
+    if len(data) > max_length or not decompressor.eof or decompressor.unused_data:
+        raise LockBoxException("Invalid compressed frame")
+    return data
+
+
+def _zstd_compress(data):
+    # Compressors are not safe to share between threads
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def _zstd_decompress(data, max_length):
+    # zstandard sizes its output from the frame rather than a limit, so the
+    # size recorded in the frame is checked first
+    try:
+        size = zstandard.frame_content_size(data)
+        if not 0 <= size <= max_length:
+            raise LockBoxException("Invalid compressed frame")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    except zstandard.ZstdError:
+        raise LockBoxException("Invalid compressed frame")
+
+    if len(data) != size:
+        raise LockBoxException("Invalid compressed frame")
+    return data
+
+
+Compression = collections.namedtuple(
+    "Compression", ["compression_id", "name", "compress", "decompress"]
+)
+
+# Compression methods for the chunks of version 2 files. compress(data) returns
+# the compressed bytes and decompress(data, max_length) raises
+# LockBoxException for data that does not decompress to at most max_length
+# bytes. zstd is only available with the zstandard package installed.
+COMPRESSIONS = {
+    compression.name: compression
+    for compression in (
+        Compression(
+            1,
+            "zlib",
+            zlib.compress,
+            functools.partial(_decompress_stream, zlib.decompressobj),
+        ),
+        Compression(
+            2,
+            "lzma",
+            lzma.compress,
+            functools.partial(_decompress_stream, lzma.LZMADecompressor),
+        ),
+        Compression(
+            3,
+            "zstd",
+            zstandard and _zstd_compress,
+            zstandard and _zstd_decompress,
+        ),
+    )
+}
+
+
+def _check_compression(compression):
+    if compression.compress is None:
+        raise LockBoxException(f"{compression.name} compression is not available")
+    return compression
+
+
+def _get_compression(name):
+    if name is None:
+        return None
+
+    try:
+        return _check_compression(COMPRESSIONS[name])
+    except KeyError:
+        raise LockBoxException(f"Unknown compression {name}")
+
+
+def _header_compression(fields):
+    compression_id = (fields.flags & _COMPRESSION_MASK) >> _COMPRESSION_SHIFT
+    if not compression_id:
+        return None
+
+    for compression in COMPRESSIONS.values():
+        if compression.compression_id == compression_id:
+            return _check_compression(compression)
+
+    raise LockBoxException(f"Unknown compression id {compression_id}")
+
+
+def _compression_flags(compression):
+    return compression.compression_id << _COMPRESSION_SHIFT if compression else 0
+
+
+def _max_frame_length(fields):
+    # Frames of compressed files may hold a whole stored chunk after the byte
+    # saying that it is stored
+    length = fields.chunk_size + fields.cipher.overhead
+    return length + 1 if fields.flags & _COMPRESSION_MASK else length
+
+
+def _entropy(chunk):
+    # Bits of entropy per byte of a sample of slices spread over the chunk
+    if len(chunk) <= ENTROPY_SAMPLE_SIZE:
+        sample = bytes(chunk)
+    else:
+        size = ENTROPY_SAMPLE_SIZE // ENTROPY_SAMPLES
+        step = (len(chunk) - size) // (ENTROPY_SAMPLES - 1)
+        sample = b"".join(
+            chunk[start : start + size]
+            for start in range(0, step * ENTROPY_SAMPLES, step)
+        )
+
+    if not sample:
+        return 0.0
+    return -sum(
+        count / len(sample) * math.log2(count / len(sample))
+        for count in collections.Counter(sample).values()
+    )
+
+
+def _compress_frame(compression, chunk):
+    if _entropy(chunk) <= ENTROPY_THRESHOLD:
+        compressed = compression.compress(chunk)
+        if len(compressed) < len(chunk):
+            return _FRAME_COMPRESSED + compressed
+
+    return _FRAME_STORED + chunk
+
+
+def _decompress_frame(compression, data, chunk_size):
+    encoding, payload = data[:1], data[1:]
+    if encoding == _FRAME_STORED and len(payload) <= chunk_size:
+        return payload
+    if encoding == _FRAME_COMPRESSED:
+        return compression.decompress(payload, chunk_size)
+
+    raise LockBoxException("Invalid compressed frame")
+
+
+@functools.cache
+def _fastest_cipher():
+    # Whether AES-GCM beats ChaCha20-Poly1305 depends on hardware AES support,
+    # so time both on a small sample and use the winner for this process.
+    sample = bytes(1024 * 256)
+    nonce = _FRAME_NONCE.pack(0, True, False)
+    timings = {}
+
+    for name in ("aes-256-gcm", "chacha20-poly1305"):
+        cipher = CIPHERS[name].factory(bytes(KEY_LENGTH))
+        start = time.perf_counter()
+        for _ in range(4):
+            cipher.encrypt(nonce, sample, None)
+        timings[name] = time.perf_counter() - start
+
+    return min(timings, key=timings.get)
+
+
+def _get_stream_cipher(cipher, master_key, nonce):
+    # The stream key is unique to each file even if a salt were ever reused,
+    # which keeps the counter based frame nonces from repeating under a key.
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=KEY_LENGTH,
+        salt=nonce,
+        info=b"lockbox stream key",
         backend=default_backend(),
     )
+    return cipher.factory(hkdf.derive(master_key))
+
+
+Header = collections.namedtuple(
+    "Header", ["cipher", "flags", "iterations", "chunk_size", "salt", "nonce"]
+)
+
+
+def _pack_header(header):
+    return _HEADER.pack(
+        FORMAT_VERSION,
+        header.cipher.cipher_id,
+        header.flags,
+        header.iterations,
+        header.chunk_size,
+        header.salt,
+        header.nonce,
+    )
+
+
+def _unpack_header(header):
+    try:
+        version, cipher_id, *fields = _HEADER.unpack(header)
+    except struct.error:
+        raise LockBoxException("Invalid lockbox header")
 
-    key = base64.urlsafe_b64encode(kdf.derive(password))
+    if version != FORMAT_VERSION:
+        raise LockBoxException(f"Unsupported lockbox format version {version}")
 
-    return Fernet(key)
+    header = Header(_get_cipher_by_id(cipher_id), *fields)
+    if not 0 < header.chunk_size <= MAX_CHUNK_SIZE:
+        raise LockBoxException(f"Unsupported chunk size {header.chunk_size}")
+
+    return header
 
 
 def encrypt(password, plain_data, outfile=None):
-    if not isinstance(password, bytes):
+    if isinstance(password, str):
         password = password.encode("utf-8")
 
     if not isinstance(plain_data, bytes):
         plain_data = plain_data.encode("utf-8")
 
-    salt = secrets.token_bytes(SALT_LENGTH)
+    salt = _new_salt(password)
     fernet = _get_fernet(password, salt)
     cipher_data = fernet.encrypt(plain_data)
 
     encoded_salt = base64.urlsafe_b64encode(salt)
-    # The string concatenation below looks weird but is required to interpolate
-    # and receive back a byte string
-    output_data = encoded_salt + b"$" + cipher_data
+    output_data = b"$".join((encoded_salt, cipher_data))
 
     if not outfile:
         return output_data
@@ -83,13 +701,15 @@ def encrypt(password, plain_data, outfile=None):
 
 
 def decrypt(password, cipher_data, outfile=None):
-    if not isinstance(password, bytes):
+    if isinstance(password, str):
         password = password.encode("utf-8")
 
     if not isinstance(cipher_data, bytes):
         cipher_data = cipher_data.encode("utf-8")
 
-    encoded_salt, data = cipher_data.split(b"$")
+    encoded_salt, separator, data = cipher_data.partition(b"$")
+    if not separator or b"$" in data:
+        raise LockBoxException("Invalid Token has been provided")
 
     salt = base64.urlsafe_b64decode(encoded_salt)
     fernet = _get_fernet(password, salt)
@@ -106,84 +726,2830 @@ def decrypt(password, cipher_data, outfile=None):
             f.write(plaintext)
 
 
-def encrypt_file(password, input_file, output_file=None, remove_original=False):
-    if not input_file.exists():
-        raise LockBoxException("{} does not exist".format(input_file))
+def encrypt_many(password, values, cipher=DEFAULT_CIPHER):
+    if isinstance(password, str):
+        password = password.encode("utf-8")
 
-    with open(input_file, "rb") as infile:
-        if output_file:
-            with open(output_file, "wb") as outfile:
-                chunk = infile.read(CHUNK_SIZE)
+    for count, value in enumerate(values):
+        # Start a new batch once the positions of the current one run out
+        index = count % (1 << (_BATCH_INDEX.size * 8))
+        if index == 0:
+            header, stream_cipher = _new_stream(
+                password, cipher, chunk_size=MAX_CHUNK_SIZE, flags=FLAG_BATCH
+            )
+
+        if not isinstance(value, bytes):
+            value = value.encode("utf-8")
+        if len(value) > MAX_CHUNK_SIZE:
+            raise LockBoxException(
+                f"Values of more than {MAX_CHUNK_SIZE} bytes cannot be encrypted in a batch"
+            )
+
+        frame = _encrypt_frame(stream_cipher, header, value, index, False)
+        yield base64.urlsafe_b64encode(header + _BATCH_INDEX.pack(index) + frame)
+
+
+def decrypt_many(password, tokens):
+    if isinstance(password, str):
+        password = password.encode("utf-8")
+
+    # The key is derived once for every batch the tokens come from
+    ciphers = {}
+    for token in tokens:
+        if not isinstance(token, bytes):
+            token = token.encode("utf-8")
+
+        try:
+            data = base64.urlsafe_b64decode(token)
+            (index,) = _BATCH_INDEX.unpack_from(data, _HEADER.size)
+        except (ValueError, struct.error):
+            raise LockBoxException("Invalid Token has been provided")
+
+        header = data[: _HEADER.size]
+        if header not in ciphers:
+            fields = _unpack_header(header)
+            if not fields.flags & FLAG_BATCH:
+                raise LockBoxException("Invalid Token has been provided")
+            ciphers[header] = _open_stream(password, fields)
+
+        frame = data[_HEADER.size + _BATCH_INDEX.size :]
+        yield _decrypt_frame(ciphers[header], header, frame, index, False)
+
+
+def _read_chunks(infile, chunk_size, reuse_buffer=True, size=None):
+    # Yields (chunk, is_final) pairs. There is always at least one chunk, even
+    # for empty input, so that the final frame marker is always written.
+    # Unless reuse_buffer is False, every chunk is read into the same buffer
+    # and is only valid until the next one is requested. The input is peeked
+    # at to find the final chunk, so it must be buffered. With the size of the
+    # input known, buffers are no larger than what is left of it.
+    buffer = None
+
+    while True:
+        wanted = chunk_size if size is None else min(chunk_size, size)
+        if not reuse_buffer or buffer is None or len(buffer) < wanted:
+            buffer = bytearray(wanted)
+        chunk = memoryview(buffer)[:wanted]
+        length = _read_exactly(infile, chunk)
+
+        if length == wanted < chunk_size and infile.peek(1):
+            # The input has grown since its size was taken
+            grown = bytearray(chunk_size)
+            grown[:length] = chunk
+            chunk = memoryview(grown)
+            length += _read_exactly(infile, chunk[length:])
+            buffer, size = grown, None
+        elif size is not None:
+            size -= length
+
+        final = length < chunk_size or not infile.peek(1)
+        yield chunk[:length], final
+
+        if final:
+            break
+
+
+def _file_size(infile):
+    # Returns the number of bytes left in a regular file, or None for pipes,
+    # special files and anything else whose size is not known up front
+    try:
+        info = os.fstat(infile.fileno())
+        if not stat.S_ISREG(info.st_mode):
+            return None
+        return max(info.st_size - infile.tell(), 0)
+    except (io.UnsupportedOperation, OSError, ValueError):
+        return None
+
+
+def _map_file(infile):
+    # Returns a read only mapping of a regular file, or None for pipes,
+    # special files, empty files and anything else that cannot be mapped
+    try:
+        fd = infile.fileno()
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            return None
+        mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (io.UnsupportedOperation, OSError, ValueError):
+        return None
+
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+def _mapped_chunks(mapped, start, chunk_size):
+    # Like _read_chunks, but chunks are views of the mapping rather than
+    # copies, and stay valid for as long as the mapping is open
+    view = memoryview(mapped)
+    position = start
+    while True:
+        chunk = view[position : position + chunk_size]
+        position += len(chunk)
+        final = position >= len(view)
+        yield chunk, final
+
+        if final:
+            break
+
+
+def _check_chunk_size(chunk_size):
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise LockBoxException(
+            f"Chunk size must be between 1 and {MAX_CHUNK_SIZE} bytes"
+        )
+
+
+def _chunk_size(chunk_size=None, size=None, workers=1):
+    # Returns chunk_size if one was given, or the adaptive default for an
+    # input of size bytes, None if its size is not known
+    if chunk_size is not None:
+        _check_chunk_size(chunk_size)
+        return chunk_size
+
+    if size is None:
+        return min(CHUNK_SIZE, STREAM_CHUNK_SIZE)
+
+    chunk_size = max(CHUNK_SIZE, min(-(-size // LARGE_FILE_FRAMES), LARGE_CHUNK_SIZE))
+    if workers > 1:
+        chunk_size = min(
+            chunk_size, max(-(-size // (workers * WORKER_FRAMES)), MIN_CHUNK_SIZE)
+        )
+    # Small files get a single frame of their own size, so neither side
+    # allocates a full chunk for them
+    return min(chunk_size, max(size, 1))
+
+
+def _new_header(cipher=DEFAULT_CIPHER, chunk_size=CHUNK_SIZE, flags=0, salt=None):
+    return Header(
+        cipher=_get_cipher(cipher),
+        flags=flags,
+        iterations=HASH_ITERATIONS,
+        chunk_size=chunk_size,
+        salt=salt or secrets.token_bytes(SALT_LENGTH),
+        nonce=secrets.token_bytes(NONCE_LENGTH),
+    )
+
+
+def _new_stream(password, cipher=DEFAULT_CIPHER, chunk_size=CHUNK_SIZE, flags=0):
+    header = _new_header(
+        cipher, chunk_size=chunk_size, flags=flags, salt=_new_salt(password)
+    )
+
+    return _pack_header(header), _open_stream(password, header)
+
+
+def _open_stream(password, header):
+    if _key_cache is None or not isinstance(password, bytes):
+        master_key = _derive_key(password, header.salt, header.iterations)
+        return _get_stream_cipher(header.cipher, master_key, header.nonce)
+
+    # Files that are read again reuse the cipher as well as the key
+    def create():
+        master_key = _pbkdf2(password, header.salt, header.iterations)
+        return _get_stream_cipher(header.cipher, master_key, header.nonce)
+
+    return _key_cache.get(
+        password,
+        header.salt,
+        header.iterations,
+        header.cipher.name,
+        header.nonce,
+        create=create,
+    )
+
+
+def _encrypt_frame(cipher, header, chunk, index, final):
+    # Frames are authenticated along with the header, their position and
+    # whether they are the final frame, so reordered, spliced or truncated
+    # frames will fail to decrypt.
+    nonce = _FRAME_NONCE.pack(index, final, False)
+    return cipher.encrypt(nonce, chunk, header)
+
+
+def _encrypt_compressed_frame(cipher, header, compression, chunk, index, final):
+    chunk = _compress_frame(compression, chunk)
+    return _encrypt_frame(cipher, header, chunk, index, final)
+
+
+def _encrypt_frames(
+    cipher,
+    header,
+    chunks,
+    pipeline=False,
+    workers=1,
+    compression=None,
+):
+    # Chunks handed to more than one thread must not share a buffer. They are
+    # compressed on the same threads they are encrypted on.
+    if pipeline or workers > 1:
+        if compression:
+            encrypt = functools.partial(
+                _encrypt_compressed_frame, cipher, header, compression
+            )
+        else:
+            encrypt = functools.partial(_encrypt_frame, cipher, header)
+
+        yield from _pipelined(
+            ((chunk, index, final) for index, (chunk, final) in enumerate(chunks)),
+            encrypt,
+            workers=workers,
+        )
+        return
 
-                while chunk:
-                    encrypted_data = encrypt(password, chunk)
-                    outfile.write(encrypted_data + b"\n")
+    # Where the cipher supports it, chunks are encrypted into a single buffer,
+    # so a yielded frame is only valid until the next one is requested. The
+    # buffer is sized by the chunks themselves and only grows if it must.
+    encrypt_into = getattr(cipher, "encrypt_into", None)
+    buffer = bytearray()
 
-                    chunk = infile.read(CHUNK_SIZE)
+    for index, (chunk, final) in enumerate(chunks):
+        if compression:
+            chunk = _compress_frame(compression, chunk)
+
+        if encrypt_into:
+            length = len(chunk) + _AEAD_TAG_LENGTH
+            if len(buffer) < length:
+                buffer = bytearray(length)
+            frame = memoryview(buffer)[:length]
+            encrypt_into(_FRAME_NONCE.pack(index, final, False), chunk, header, frame)
+            yield frame
+        else:
+            yield _encrypt_frame(cipher, header, chunk, index, final)
+
+
+def _write_frames(outfile, header, frames):
+    outfile.write(MAGIC + header)
+
+    position = len(MAGIC) + len(header)
+    offsets = []
+    for frame in frames:
+        offsets.append(position)
+        outfile.writelines((_FRAME_LENGTH.pack(len(frame)), frame))
+        position += _FRAME_LENGTH.size + len(frame)
+
+    return offsets, position
+
+
+def _write_index(outfile, cipher, header, offsets, position, chunk_size):
+    outfile.write(_FRAME_LENGTH.pack(0))
+    position += _FRAME_LENGTH.size
+
+    # Keep index frames within the chunk size so readers can bound buffers.
+    # Chunks smaller than an entry still get one entry per frame.
+    per_frame = max(chunk_size // _INDEX_ENTRY.size, 1)
+    count = -(-len(offsets) // per_frame)
+    for number in range(count):
+        entries = offsets[number * per_frame : (number + 1) * per_frame]
+        nonce = _FRAME_NONCE.pack(number, number == count - 1, True)
+        frame = cipher.encrypt(
+            nonce, struct.pack(f">{len(entries)}Q", *entries), header
+        )
+
+        outfile.writelines((_FRAME_LENGTH.pack(len(frame)), frame))
+
+    outfile.write(_FRAME_LENGTH.pack(0))
+    outfile.write(_INDEX_TRAILER.pack(position, len(offsets)))
+
+
+def _armor(header, frames):
+    yield HEADER_PREFIX + base64.urlsafe_b64encode(header)
+    for frame in frames:
+        yield base64.urlsafe_b64encode(frame)
+
+
+def encrypt_stream(
+    password,
+    infile,
+    outfile,
+    armor=False,
+    cipher=DEFAULT_CIPHER,
+    index=False,
+    pipeline=False,
+    workers=1,
+    chunk_size=None,
+    compression=None,
+    map_input=False,
+):
+    # Encrypts everything read from one binary file object into another, a
+    # chunk at a time, so pipes of any size are encrypted in constant memory.
+    # Neither object needs to be seekable.
+    if workers < 1:
+        raise LockBoxException("workers must be at least 1")
+    if index and armor:
+        raise LockBoxException("A frame index can only be written to binary files")
+
+    if isinstance(password, str):
+        password = password.encode("utf-8")
+
+    if chunk_size is not None:
+        _check_chunk_size(chunk_size)
+    compression = _get_compression(compression)
+
+    # With map_input, large regular files are mapped into memory and handed
+    # to the cipher without being copied, leaving readahead to the kernel.
+    # Anything else is read into a buffer, a fresh one for every chunk if
+    # they are encrypted on other threads.
+    size = _file_size(infile)
+    mapped = None
+    if map_input and size is not None and size >= MMAP_MIN_SIZE:
+        mapped = _map_file(infile)
+
+    chunk_size = _chunk_size(chunk_size, size, workers)
+    if mapped is not None:
+        chunks = _mapped_chunks(mapped, infile.tell(), chunk_size)
+    else:
+        if not hasattr(infile, "peek"):
+            infile = io.BufferedReader(infile)
+        chunks = _read_chunks(
+            infile,
+            chunk_size,
+            reuse_buffer=not (pipeline or workers > 1),
+            size=size,
+        )
+
+    frames = None
+    try:
+        header, stream_cipher = _new_stream(
+            password,
+            cipher,
+            chunk_size=chunk_size,
+            flags=(FLAG_INDEXED if index else 0) | _compression_flags(compression),
+        )
+        frames = _encrypt_frames(
+            stream_cipher,
+            header,
+            chunks,
+            pipeline=pipeline,
+            workers=workers,
+            compression=compression,
+        )
+
+        if armor:
+            for line in _armor(header, frames):
+                outfile.writelines((line, b"\n"))
         else:
-            chunk = infile.read(CHUNK_SIZE)
-            while chunk:
-                encrypted_data = encrypt(password, chunk)
-                print(encrypted_data.decode("utf-8"))
-                chunk = infile.read(CHUNK_SIZE)
+            offsets, position = _write_frames(outfile, header, frames)
+            if index:
+                _write_index(
+                    outfile, stream_cipher, header, offsets, position, chunk_size
+                )
+    finally:
+        if mapped is not None:
+            infile.seek(len(mapped))
+            del chunks, frames
+            # Views of the mapping still held by a traceback keep it open
+            # until they are released
+            with contextlib.suppress(BufferError):
+                mapped.close()
+
+
+@contextlib.contextmanager
+def _stdout_buffer():
+    # Binary output that follows anything already printed to stdout
+    sys.stdout.flush()
+    try:
+        yield sys.stdout.buffer
+    finally:
+        sys.stdout.buffer.flush()
+
+
+def encrypt_file(
+    password,
+    input_file,
+    output_file=None,
+    remove_original=False,
+    armor=False,
+    cipher=DEFAULT_CIPHER,
+    index=False,
+    pipeline=False,
+    workers=1,
+    chunk_size=None,
+    compression=None,
+    map_input=True,
+):
+    if not input_file.exists():
+        raise LockBoxException("{} does not exist".format(input_file))
+    if index and (armor or not output_file):
+        raise LockBoxException("A frame index can only be written to binary files")
+
+    with open(input_file, "rb") as infile:
+        # Without an output file, the armored text is written to stdout
+        with open(output_file, "wb") if output_file else _stdout_buffer() as outfile:
+            encrypt_stream(
+                password,
+                infile,
+                outfile,
+                armor=armor or not output_file,
+                cipher=cipher,
+                index=index,
+                pipeline=pipeline,
+                workers=workers,
+                chunk_size=chunk_size,
+                compression=compression,
+                map_input=map_input,
+            )
 
     if remove_original:
         input_file.unlink()
 
 
-def _split_encrypted_file(infile):
-    with open(infile, "rb") as f:
-        for line in f:
-            yield line
+def _ordered_map(executor, fn, args_iter, window):
+    # Like executor.map, but only keeps `window` calls in flight and yields
+    # results in submission order. This bounds the memory held by results
+    # waiting on a slower call ahead of them.
+    pending = collections.deque()
 
+    try:
+        for args in args_iter:
+            pending.append(executor.submit(fn, *args))
 
-def decrypt_file(password, encrypted_file, output_file=None, remove_original=False):
-    if not encrypted_file.exists():
-        raise LockBoxException("{} does not exist".format(encrypted_file))
+            if len(pending) >= window:
+                yield pending.popleft().result()
 
-    file_lines = _split_encrypted_file(encrypted_file)
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
 
-    if output_file:
-        with open(output_file, "wb") as outfile:
-            for line in file_lines:
-                data = decrypt(password, line)
-                outfile.write(data)
 
-        if remove_original:
-            encrypted_file.unlink()
-    else:
-        for line in file_lines:
-            data = decrypt(password, line)
-            print(data.decode("utf-8"))
+def _pipelined(items, transform, workers=1, depth=PIPELINE_DEPTH):
+    # Iterates `items` on a reader thread and applies `transform` to them on
+    # `workers` threads, yielding the results back in order. The caller writes
+    # the results out, so reading, encryption and writing all overlap; the
+    # cryptography primitives release the GIL while they work. At most
+    # workers + 2 * depth items are in flight at once.
+    stop = threading.Event()
+    slots = threading.Semaphore(workers + 2 * depth)
+    item_queue = queue.Queue()
+    result_queue = queue.Queue()
 
+    def read():
+        try:
+            for seq, item in enumerate(items):
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                item_queue.put((seq, item))
+        except BaseException as e:
+            result_queue.put((None, None, e))
+        finally:
+            for _ in range(workers):
+                item_queue.put((None, None))
 
-def encrypt_directory(password, directory):
-    if not directory.exists():
-        raise LockBoxException(f"{directory} does not exist")
-    if not directory.is_dir():
-        raise LockBoxException(f"{directory} is not a directory")
+    def work():
+        while True:
+            seq, item = item_queue.get()
+            if seq is None or stop.is_set():
+                result_queue.put((None, None, None))
+                return
 
-    file_count = _count_files(directory)
+            try:
+                result_queue.put((seq, transform(*item), None))
+            except BaseException as e:
+                result_queue.put((None, None, e))
+                return
 
-    for fullpath in tqdm(_path_generator(directory), total=file_count):
-        if fullpath.is_symlink():
-            continue
+    threads = [threading.Thread(target=read)]
+    threads.extend(threading.Thread(target=work) for _ in range(workers))
+    for thread in threads:
+        thread.start()
 
-        output_file = fullpath.parent / f"{fullpath.name}{LOCKBOX_SUFFIX}"
-        encrypt_file(password, fullpath, output_file=output_file, remove_original=True)
+    try:
+        results = {}
+        next_seq = 0
+        finished = 0
+        while finished < workers:
+            seq, result, error = result_queue.get()
+            if error is not None:
+                raise error
+            if seq is None:
+                finished += 1
+                continue
 
+            results[seq] = result
+            while next_seq in results:
+                yield results.pop(next_seq)
+                next_seq += 1
+                slots.release()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
 
-def decrypt_directory(password, directory):
-    if not directory.exists():
-        raise LockBoxException(f"{directory} does not exist")
-    if not directory.is_dir():
-        raise LockBoxException(f"{directory} is not a directory")
 
-    file_count = _count_files(directory)
+def _decrypt_legacy_lines(password, lines, workers=1):
+    # Legacy files carry their own salt on every line so each line is
+    # independent and the key derivations can run on separate cores.
+    if workers == 1:
+        for line in lines:
+            yield decrypt(password, line)
+        return
 
-    for fullpath in tqdm(_path_generator(directory), total=file_count):
-        if fullpath.is_symlink() or fullpath.suffix != LOCKBOX_SUFFIX:
-            continue
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=_PROCESS_CONTEXT
+    ) as executor:
+        yield from _ordered_map(
+            executor,
+            decrypt,
+            ((password, line) for line in lines),
+            window=workers * 2,
+        )
+
+
+def _read_exactly(infile, buffer):
+    view = memoryview(buffer)
+    total = 0
+    while total < len(view):
+        count = infile.readinto(view[total:])
+        if not count:
+            break
+        total += count
+    return total
+
+
+def _read_frame_length(infile):
+    # Returns None at the end of the file or at the end of frames marker
+    length = infile.read(_FRAME_LENGTH.size)
+    if not length:
+        return None
+    if len(length) < _FRAME_LENGTH.size:
+        raise LockBoxException("Encrypted file is truncated")
+
+    (length,) = _FRAME_LENGTH.unpack(length)
+    return length or None
+
+
+def _read_frame(infile):
+    length = _read_frame_length(infile)
+    if length is None:
+        return None
+
+    frame = infile.read(length)
+    if len(frame) < length:
+        raise LockBoxException("Encrypted file is truncated")
+
+    return frame
+
+
+def _read_frames(infile, max_length, reuse_buffer=True):
+    # Yields (frame, is_final) pairs. Unless reuse_buffer is False, every frame
+    # is read into the same buffer and is only valid until the next one is
+    # requested. Only the next length prefix is read ahead to find the final
+    # frame. The buffer is sized by the frames rather than max_length, so
+    # small files made with large chunks are read into small buffers.
+    buffer = bytearray()
+    length = _read_frame_length(infile)
+
+    while length is not None:
+        if length > max_length:
+            raise LockBoxException("Encrypted frame is larger than the chunk size")
+
+        if reuse_buffer:
+            if len(buffer) < length:
+                buffer = bytearray(length)
+            frame = memoryview(buffer)[:length]
+        else:
+            frame = bytearray(length)
+
+        if _read_exactly(infile, frame) < length:
+            raise LockBoxException("Encrypted file is truncated")
+
+        next_length = _read_frame_length(infile)
+        yield frame, next_length is None
+        length = next_length
+
+
+def _read_lines(infile, max_length):
+    line = infile.readline(max_length + 1)
+    while line:
+        if len(line) > max_length:
+            raise LockBoxException("Encrypted line is larger than the chunk size")
+        yield line
+        line = infile.readline(max_length + 1)
+
+
+def _armored_length(length):
+    # Length of a base64 encoded frame, allowing for a CRLF line ending
+    return -(-length // 3) * 4 + 2
+
+
+def _lookahead(items):
+    # Yields (item, is_last) pairs
+    item = next(items, None)
+    while item is not None:
+        next_item = next(items, None)
+        yield item, next_item is None
+        item = next_item
+
+
+def _decrypt_frame(cipher, header, frame, index, final):
+    try:
+        nonce = _FRAME_NONCE.pack(index, final, False)
+        return cipher.decrypt(nonce, frame, header)
+    except (InvalidToken, InvalidTag):
+        raise LockBoxException("Invalid Token has been provided")
+
+
+def _decrypt_compressed_frame(
+    cipher, header, compression, chunk_size, frame, index, final
+):
+    data = _decrypt_frame(cipher, header, frame, index, final)
+    return _decompress_frame(compression, data, chunk_size)
+
+
+def _decrypt_frames(
+    cipher,
+    header,
+    frames,
+    chunk_size,
+    pipeline=False,
+    workers=1,
+    compression=None,
+):
+    if pipeline or workers > 1:
+        if compression:
+            decrypt = functools.partial(
+                _decrypt_compressed_frame, cipher, header, compression, chunk_size
+            )
+        else:
+            decrypt = functools.partial(_decrypt_frame, cipher, header)
+
+        count = 0
+        for count, data in enumerate(
+            _pipelined(
+                ((frame, index, final) for index, (frame, final) in enumerate(frames)),
+                decrypt,
+                workers=workers,
+            ),
+            start=1,
+        ):
+            yield data
+
+        if not count:
+            raise LockBoxException("Encrypted file is truncated")
+        return
+
+    # Plaintext is decrypted into a single reusable buffer where the cipher
+    # supports it, so a yielded frame is only valid until the next one is
+    # requested. Like the frames, the buffer only grows as large as it must.
+    decrypt_into = getattr(cipher, "decrypt_into", None)
+    max_length = chunk_size + len(_FRAME_STORED) if compression else chunk_size
+    buffer = bytearray()
+
+    index = -1
+    for index, (frame, final) in enumerate(frames):
+        length = len(frame) - _AEAD_TAG_LENGTH
+        if decrypt_into and 0 <= length <= max_length:
+            if len(buffer) < length:
+                buffer = bytearray(length)
+            data = memoryview(buffer)[:length]
+            nonce = _FRAME_NONCE.pack(index, final, False)
+            try:
+                decrypt_into(nonce, frame, header, data)
+            except InvalidTag:
+                raise LockBoxException("Invalid Token has been provided")
+        else:
+            data = _decrypt_frame(cipher, header, frame, index, final)
+
+        if compression:
+            data = _decompress_frame(compression, data, chunk_size)
+        yield data
+
+    if index < 0:
+        raise LockBoxException("Encrypted file is truncated")
+
+
+def _read_header(infile):
+    if infile.read(len(MAGIC)) != MAGIC:
+        raise LockBoxException("Not a binary lockbox file")
+
+    header = infile.read(_HEADER.size)
+    return header, _unpack_header(header)
+
+
+def _check_single_file(fields):
+    # Archives and the other containers decrypt to a layout of their own
+    # rather than to a file, so they are refused by the plain decrypt paths
+    if fields.flags & FLAG_ARCHIVE:
+        raise LockBoxException(
+            "Encrypted file is a lockbox archive, use lockbox unpack to extract it"
+        )
+    if fields.flags & FLAG_BATCH:
+        raise LockBoxException("Encrypted file is a batch of tokens")
+    if fields.flags & FLAG_VAULT:
+        raise LockBoxException(
+            "Encrypted file is a lockbox vault, use lockbox vault to read it"
+        )
+    if fields.flags & FLAG_REPOSITORY:
+        raise LockBoxException(
+            "Encrypted file is a lockbox repository, use lockbox repo restore "
+            "to read it"
+        )
+
+
+class _PrefixedReader(io.RawIOBase):
+    # Reads bytes already taken from infile before the rest of it
+    def __init__(self, prefix, infile):
+        self._prefix = prefix
+        self._infile = infile
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._prefix:
+            return self._infile.readinto(buffer)
+
+        length = min(len(buffer), len(self._prefix))
+        buffer[:length] = self._prefix[:length]
+        self._prefix = self._prefix[length:]
+        return length
+
+
+def _peek_magic(infile):
+    # Returns the input with the bytes that might be the magic at its start.
+    # A pipe may give fewer of them to a single peek, in which case they are
+    # read and put back in front of the rest of the input.
+    prefix = infile.peek(len(MAGIC))[: len(MAGIC)]
+    if not prefix or len(prefix) == len(MAGIC):
+        return infile, prefix
+
+    prefix = infile.read(len(MAGIC))
+    return io.BufferedReader(_PrefixedReader(prefix, infile)), prefix
+
+
+def _decrypt_stream(password, infile, workers=1, pipeline=False):
+    # Frames of version 2 files are decrypted on threads, while legacy lines
+    # each need their own key derivation and are handed to processes
+    threaded = pipeline or workers > 1
+
+    infile, prefix = _peek_magic(infile)
+    if prefix == MAGIC:
+        header, fields = _read_header(infile)
+        _check_single_file(fields)
+        cipher = _open_stream(password, fields)
+
+        yield from _decrypt_frames(
+            cipher,
+            header,
+            _read_frames(
+                infile,
+                _max_frame_length(fields),
+                reuse_buffer=not threaded,
+            ),
+            fields.chunk_size,
+            pipeline=pipeline,
+            workers=workers,
+            compression=_header_compression(fields),
+        )
+        return
+
+    # Legacy lines are a base64 encoded salt, a separator and a Fernet token
+    legacy_length = (
+        len(base64.urlsafe_b64encode(bytes(SALT_LENGTH)))
+        + 1
+        + _armored_length(_frame_length(CIPHERS["fernet"], LEGACY_CHUNK_SIZE))
+    )
+    lines = _read_lines(infile, legacy_length)
+    first_line = next(lines, None)
+    if first_line is None:
+        return
+
+    if not first_line.startswith(HEADER_PREFIX):
+        yield from _decrypt_legacy_lines(
+            password, itertools.chain([first_line], lines), workers=workers
+        )
+        return
+
+    header = base64.urlsafe_b64decode(first_line[len(HEADER_PREFIX) :].strip())
+    fields = _unpack_header(header)
+    _check_single_file(fields)
+    cipher = _open_stream(password, fields)
+
+    lines = _read_lines(infile, _armored_length(_max_frame_length(fields)))
+    yield from _decrypt_frames(
+        cipher,
+        header,
+        _lookahead(base64.urlsafe_b64decode(line) for line in lines),
+        fields.chunk_size,
+        pipeline=pipeline,
+        workers=workers,
+        compression=_header_compression(fields),
+    )
+
+
+def decrypt_stream(password, infile, outfile, workers=1, pipeline=False):
+    # Decrypts a binary file object into another a frame at a time. The input
+    # does not need to be seekable, so it can be a pipe.
+    if workers < 1:
+        raise LockBoxException("workers must be at least 1")
+
+    if isinstance(password, str):
+        password = password.encode("utf-8")
+
+    if not hasattr(infile, "peek"):
+        infile = io.BufferedReader(infile)
+
+    outfile.writelines(
+        _decrypt_stream(password, infile, workers=workers, pipeline=pipeline)
+    )
+
+
+def decrypt_file(
+    password,
+    encrypted_file,
+    output_file=None,
+    remove_original=False,
+    workers=1,
+    pipeline=False,
+):
+    if not encrypted_file.exists():
+        raise LockBoxException("{} does not exist".format(encrypted_file))
+
+    with open(encrypted_file, "rb") as infile:
+        # Archives are refused before the output file is created
+        if infile.read(len(MAGIC)) == MAGIC:
+            _check_single_file(_unpack_header(infile.read(_HEADER.size)))
+        infile.seek(0)
+
+        # Without an output file, the plaintext is written to stdout as is
+        with open(output_file, "wb") if output_file else _stdout_buffer() as outfile:
+            decrypt_stream(
+                password, infile, outfile, workers=workers, pipeline=pipeline
+            )
+
+    if output_file and remove_original:
+        encrypted_file.unlink()
+
+
+def _read_index(infile, cipher, header, fields):
+    # Index frames hold at least one entry, even in files with smaller chunks
+    max_length = max(fields.chunk_size, _INDEX_ENTRY.size) + fields.cipher.overhead
+
+    end = infile.seek(0, os.SEEK_END)
+    start = len(MAGIC) + len(header)
+    if end < start + _INDEX_TRAILER.size:
+        raise LockBoxException("Encrypted file index is invalid")
+
+    infile.seek(end - _INDEX_TRAILER.size)
+    position, count = _INDEX_TRAILER.unpack(infile.read(_INDEX_TRAILER.size))
+    if not start <= position <= end - _INDEX_TRAILER.size:
+        raise LockBoxException("Encrypted file index is invalid")
+
+    infile.seek(position)
+    offsets = []
+    for number, (frame, final) in enumerate(_read_frames(infile, max_length)):
+        try:
+            entries = cipher.decrypt(
+                _FRAME_NONCE.pack(number, final, True), frame, header
+            )
+        except (InvalidToken, InvalidTag):
+            raise LockBoxException("Invalid Token has been provided")
+
+        offsets.extend(struct.unpack(f">{len(entries) // _INDEX_ENTRY.size}Q", entries))
+
+    if len(offsets) != count:
+        raise LockBoxException("Encrypted file index is invalid")
+
+    return offsets
+
+
+def _scan_frames(infile):
+    # Finds frame offsets in files without an index by hopping over the
+    # length prefixes. Nothing is read or decrypted along the way.
+    offsets = []
+    while True:
+        position = infile.tell()
+        length = infile.read(_FRAME_LENGTH.size)
+        if len(length) < _FRAME_LENGTH.size:
+            break
+
+        (length,) = _FRAME_LENGTH.unpack(length)
+        if not length:
+            break
+
+        offsets.append(position)
+        infile.seek(length, os.SEEK_CUR)
+
+    return offsets
+
+
+class _RangeReader:
+    # Decrypts byte ranges of a binary file, only reading the frames that
+    # cover them. Frames are found through the index if the file has one, or
+    # by hopping over the length prefixes otherwise.
+    def __init__(self, infile, header, fields, cipher):
+        self._infile = infile
+        self._header = header
+        self._cipher = cipher
+        self._max_length = _max_frame_length(fields)
+        self._compression = _header_compression(fields)
+        self.chunk_size = fields.chunk_size
+
+        if fields.flags & FLAG_INDEXED:
+            self._offsets = _read_index(infile, cipher, header, fields)
+        else:
+            self._offsets = _scan_frames(infile)
+
+        if not self._offsets:
+            raise LockBoxException("Encrypted file is truncated")
+
+        self._last_frame = None
+
+    def read_frame(self, index):
+        if index == len(self._offsets) - 1 and self._last_frame is not None:
+            return self._last_frame
+
+        self._infile.seek(self._offsets[index])
+        length = _read_frame_length(self._infile)
+        if length is None:
+            raise LockBoxException("Encrypted file is truncated")
+        if length > self._max_length:
+            raise LockBoxException("Encrypted frame is larger than the chunk size")
+
+        frame = self._infile.read(length)
+        if len(frame) < length:
+            raise LockBoxException("Encrypted file is truncated")
+
+        final = index == len(self._offsets) - 1
+        data = _decrypt_frame(self._cipher, self._header, frame, index, final)
+        if self._compression:
+            data = _decompress_frame(self._compression, data, self.chunk_size)
+        if final:
+            self._last_frame = data
+        return data
+
+    @property
+    def size(self):
+        last = len(self._offsets) - 1
+        return self.chunk_size * last + len(self.read_frame(last))
+
+    def read_pieces(self, offset, length):
+        # Negative offsets count back from the end of the plaintext
+        if offset < 0:
+            offset = max(self.size + offset, 0)
+
+        index = offset // self.chunk_size
+        start = offset - index * self.chunk_size
+        while length > 0 and index < len(self._offsets):
+            piece = self.read_frame(index)[start : start + length]
+            if not piece:
+                break
+            yield piece
+
+            length -= len(piece)
+            index += 1
+            start = 0
+
+    def read(self, offset, length):
+        return b"".join(self.read_pieces(offset, length))
+
+
+def decrypt_range(password, encrypted_file, offset, length, output_file=None):
+    if not encrypted_file.exists():
+        raise LockBoxException("{} does not exist".format(encrypted_file))
+    if length < 0:
+        raise LockBoxException("length must not be negative")
+
+    if isinstance(password, str):
+        password = password.encode("utf-8")
+
+    with open(encrypted_file, "rb") as infile:
+        header, fields = _read_header(infile)
+        _check_single_file(fields)
+        cipher = _open_stream(password, fields)
+        plaintext = _RangeReader(infile, header, fields, cipher).read(offset, length)
+
+    if not output_file:
+        return plaintext
+    else:
+        with open(output_file, "wb") as f:
+            f.write(plaintext)
+
+
+def _partial_path(path):
+    return path.with_name(f"{path.name}{PARTIAL_SUFFIX}")
+
+
+def _commit_partial(output_file):
+    # Syncs a finished partial output and renames it over output_file
+    partial = _partial_path(output_file)
+    fd = os.open(partial, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(partial, output_file)
+
+
+@contextlib.contextmanager
+def _atomic_output(output_file):
+    # Yields the partial path to write output_file to. It is committed when
+    # the block finishes and removed if the block fails.
+    partial = _partial_path(output_file)
+    try:
+        yield partial
+        _commit_partial(output_file)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+
+
+def _encrypted_path(path):
+    return path.parent / f"{path.name}{LOCKBOX_SUFFIX}"
+
+
+def _decrypted_path(path):
+    return path.parent / path.stem
+
+
+def _encrypt_path(password, path, cipher, chunk_size=None, compression=None):
+    with _atomic_output(_encrypted_path(path)) as output_file:
+        encrypt_file(
+            password,
+            path,
+            output_file=output_file,
+            cipher=cipher,
+            chunk_size=chunk_size,
+            compression=compression,
+            map_input=False,
+        )
+    path.unlink()
+
+
+def _decrypt_path(password, path):
+    with _atomic_output(_decrypted_path(path)) as output_file:
+        decrypt_file(password, path, output_file=output_file)
+    path.unlink()
+
+
+def _process_batch(fn, batch):
+    # Runs fn(*args) for each file of a batch of small files, returning
+    # (path, result, error) for each of them
+    results = []
+    for args in batch:
+        try:
+            results.append((args[0], fn(*args), None))
+        except Exception as e:
+            results.append((args[0], None, e))
+    return results
+
+
+class _SplitFile:
+    # A large file whose frames are processed in ranges by several workers,
+    # each writing into the partial output. finish(succeeded) is called once
+    # every range is done. Files are split on a worker, so this is passed
+    # back from there.
+    def __init__(self, path, output_file, ranges):
+        self.path = path
+        self.output_file = output_file
+        self.ranges = ranges
+        self.remaining = len(ranges)
+        self.error = None
+
+    def finish(self, succeeded):
+        if succeeded:
+            _commit_partial(self.output_file)
+            self.path.unlink()
+        else:
+            _partial_path(self.output_file).unlink(missing_ok=True)
+
+
+# A large file that is waiting for a worker to split it
+_SplitRequest = collections.namedtuple("_SplitRequest", ["path", "size", "args"])
+
+
+def _split_ranges(count, sizes):
+    # Groups frames into (start, stop, size) ranges, where sizes(index) is
+    # the number of bytes of progress a frame stands for
+    for start in range(0, count, SPLIT_FRAMES):
+        stop = min(start + SPLIT_FRAMES, count)
+        yield start, stop, sum(sizes(index) for index in range(start, stop))
+
+
+def _split_encrypt(
+    password, path, size, cipher=DEFAULT_CIPHER, chunk_size=None, compression=None
+):
+    # Lays out the encrypted file up front so that ranges of frames can be
+    # encrypted straight into place. Every frame but the last is a full
+    # chunk, so the position of each frame is known before it is written.
+    # Compressed frames have no known size, so those files are not split.
+    if compression:
+        return None
+
+    chunk_size = _chunk_size(chunk_size, size)
+    count = max(-(-size // chunk_size), 1)
+    if count < SPLIT_FRAMES * 2:
+        return None
+
+    fields = _new_header(cipher, chunk_size=chunk_size, salt=_new_salt(password))
+    header = _pack_header(fields)
+    master_key = _derive_key(password, fields.salt, fields.iterations)
+
+    def sizes(index):
+        return min(chunk_size, size - index * chunk_size)
+
+    frame_size = _FRAME_LENGTH.size + _frame_length(fields.cipher, chunk_size)
+    last_frame_size = _FRAME_LENGTH.size + _frame_length(
+        fields.cipher, sizes(count - 1)
+    )
+
+    output_file = _encrypted_path(path)
+    with open(_partial_path(output_file), "wb") as outfile:
+        outfile.write(MAGIC + header)
+        outfile.truncate(
+            len(MAGIC) + len(header) + (count - 1) * frame_size + last_frame_size
+        )
+
+    ranges = [
+        (
+            functools.partial(
+                _encrypt_range,
+                path,
+                _partial_path(output_file),
+                master_key,
+                header,
+                start,
+                stop,
+                size,
+            ),
+            range_size,
+        )
+        for start, stop, range_size in _split_ranges(count, sizes)
+    ]
+    return _SplitFile(path, output_file, ranges)
+
+
+def _encrypt_range(input_file, output_file, master_key, header, start, stop, size):
+    fields = _unpack_header(header)
+    cipher = _get_stream_cipher(fields.cipher, master_key, fields.nonce)
+    chunk_size = fields.chunk_size
+    count = max(-(-size // chunk_size), 1)
+    frame_size = _FRAME_LENGTH.size + _frame_length(fields.cipher, chunk_size)
+
+    with open(input_file, "rb") as infile, open(output_file, "r+b") as outfile:
+        infile.seek(start * chunk_size)
+        outfile.seek(len(MAGIC) + len(header) + start * frame_size)
+
+        for index in range(start, stop):
+            final = index == count - 1
+            chunk = infile.read(chunk_size)
+            expected = min(chunk_size, size - index * chunk_size)
+            if len(chunk) != expected or (final and infile.read(1)):
+                raise LockBoxException(
+                    f"{input_file} changed while it was being encrypted"
+                )
+
+            frame = _encrypt_frame(cipher, header, chunk, index, final)
+            if len(frame) != _frame_length(fields.cipher, len(chunk)):
+                raise LockBoxException("Encrypted frame has an unexpected size")
+
+            outfile.write(_FRAME_LENGTH.pack(len(frame)))
+            outfile.write(frame)
+
+
+def _split_decrypt(password, path, size):
+    # Only binary files can be split, since the frames of armored and legacy
+    # files can not be found without reading everything before them
+    with open(path, "rb") as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            return None
+
+        infile.seek(0)
+        header, fields = _read_header(infile)
+        _check_single_file(fields)
+        if fields.flags & FLAG_INDEXED:
+            master_key = _derive_key(password, fields.salt, fields.iterations)
+            cipher = _get_stream_cipher(fields.cipher, master_key, fields.nonce)
+            offsets = _read_index(infile, cipher, header, fields)
+        else:
+            master_key = None
+            offsets = _scan_frames(infile)
+
+    count = len(offsets)
+    if count < SPLIT_FRAMES * 2:
+        return None
+
+    if master_key is None:
+        master_key = _derive_key(password, fields.salt, fields.iterations)
+
+    # Progress counts the encrypted bytes up to the start of the next frame
+    boundaries = [0, *offsets[1:], size]
+
+    output_file = _decrypted_path(path)
+    _partial_path(output_file).write_bytes(b"")
+
+    ranges = [
+        (
+            functools.partial(
+                _decrypt_frames_at,
+                path,
+                _partial_path(output_file),
+                master_key,
+                header,
+                offsets[start:stop],
+                start,
+                count,
+            ),
+            range_size,
+        )
+        for start, stop, range_size in _split_ranges(
+            count, lambda index: boundaries[index + 1] - boundaries[index]
+        )
+    ]
+    return _SplitFile(path, output_file, ranges)
+
+
+def _decrypt_frames_at(
+    input_file, output_file, master_key, header, offsets, start, count
+):
+    fields = _unpack_header(header)
+    cipher = _get_stream_cipher(fields.cipher, master_key, fields.nonce)
+    compression = _header_compression(fields)
+    chunk_size = fields.chunk_size
+    max_length = _max_frame_length(fields)
+
+    with open(input_file, "rb") as infile, open(output_file, "r+b") as outfile:
+        outfile.seek(start * chunk_size)
+
+        for index, offset in enumerate(offsets, start):
+            infile.seek(offset)
+            length = _read_frame_length(infile)
+            if length is None or length > max_length:
+                raise LockBoxException("Encrypted frame is larger than the chunk size")
+
+            frame = infile.read(length)
+            if len(frame) < length:
+                raise LockBoxException("Encrypted file is truncated")
+
+            final = index == count - 1
+            chunk = _decrypt_frame(cipher, header, frame, index, final)
+            if compression:
+                chunk = _decompress_frame(compression, chunk, chunk_size)
+            # Ranges are written at offsets that assume full chunks
+            if not final and len(chunk) != chunk_size:
+                raise LockBoxException("Encrypted frame has an unexpected size")
+
+            outfile.write(chunk)
+
+
+def _check_directory(directory):
+    if not directory.exists():
+        raise LockBoxException(f"{directory} does not exist")
+    if not directory.is_dir():
+        raise LockBoxException(f"{directory} is not a directory")
+
+
+class _Journal:
+    # Write-ahead journal of a directory run. Files are recorded as started,
+    # and synced to disk, before they are handed to a worker, and as done once
+    # they are finished. Resuming skips files that were done, removes partial
+    # outputs of the ones that were not, and keeps the outputs of the earlier
+    # run from being picked up as inputs.
+    def __init__(self, path, operation, directory, output_of, resume=False):
+        self.path = path
+        self._directory = directory
+        started = set()
+        self.finished = set()
+
+        if path.exists():
+            if not resume:
+                raise LockBoxException(
+                    f"An interrupted run was found in {path}, "
+                    "resume it or remove the journal to start over"
+                )
+            started = self._load(operation)
+            self._recover(started - self.finished, output_of)
+
+        self.skip = set(self.finished)
+        for name in started:
+            output_file = output_of(directory / name)
+            if output_file.is_relative_to(directory):
+                self.skip.add(output_file.relative_to(directory).as_posix())
+
+        new = not path.exists()
+        self._file = open(path, "a", encoding="utf-8")
+        if new:
+            self._write([{"operation": operation}])
+
+    def _load(self, operation):
+        started = set()
+        with open(self.path, encoding="utf-8") as f:
+            lines = iter(f)
+            if json.loads(next(lines, "{}")).get("operation") != operation:
+                raise LockBoxException(
+                    f"{self.path} was not written by an interrupted {operation} run"
+                )
+
+            for line in lines:
+                try:
+                    state, name = json.loads(line)
+                except ValueError:
+                    # The last record may be cut short by the interruption
+                    break
+                (started if state == "start" else self.finished).add(name)
+
+        return started
+
+    def _recover(self, started, output_of):
+        for name in started:
+            path = self._directory / name
+            output_file = output_of(path)
+            _partial_path(output_file).unlink(missing_ok=True)
+
+            # The run was interrupted after the output was committed and the
+            # input removed, but before the file was recorded as done
+            if not path.exists() and output_file.exists():
+                self.finished.add(name)
+
+    def _write(self, records, sync=True):
+        for record in records:
+            self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def _name(self, path):
+        return path.relative_to(self._directory).as_posix()
+
+    def start(self, paths):
+        records = [["start", self._name(path)] for path in paths]
+        if records:
+            self._write(records)
+
+    def done(self, path):
+        # Losing a done record only means the file is checked again on resume
+        self._write([["done", self._name(path)]], sync=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._file.close()
+        if exc_type is None:
+            self.path.unlink()
+
+
+def _process_directory(
+    directory,
+    select,
+    fn,
+    workers=1,
+    pool="thread",
+    split=None,
+    arguments=None,
+    on_result=None,
+    journal=None,
+    unreadable=None,
+):
+    # Runs fn(path, *arguments(path)) for every file under directory accepted
+    # by select on a pool of workers, keeping at most two tasks per worker
+    # queued, and passes what it returns to on_result(path, result) on this
+    # thread. The largest file found so far is always handed out next, small
+    # files are handed out in batches, and with more than one worker
+    # split(path, size) may break a large file into ranges of frames. Since
+    # splitting derives a key, it runs on a worker as well.
+    # Progress is reported in bytes. Failures are collected rather than
+    # stopping the remaining files, and reported together at the end. With a
+    # journal, files are recorded as they are started and finished, and files
+    # it skips are left out. Paths the walk could not read are added to
+    # unreadable.
+    _check_directory(directory)
+    if workers < 1:
+        raise LockBoxException("workers must be at least 1")
+    if pool not in DIRECTORY_POOLS:
+        raise LockBoxException(f"Unknown pool {pool}")
+
+    if journal:
+        accept = select
+
+        def select(entry):
+            if entry.name.endswith(PARTIAL_SUFFIX) or entry.path == os.fspath(
+                journal.path
+            ):
+                return False
+            # The files a journal skips are still seen by the given select
+            accepted = accept is None or accept(entry)
+            name = Path(entry.path).relative_to(directory).as_posix()
+            return accepted and name not in journal.skip
+
+    # Tasks are (callable, size, owner) where the owner is a path, a list of
+    # paths, a _SplitRequest or a _SplitFile
+    tasks = collections.deque()
+    batch = []
+    batch_size = 0
+    pending = {}
+    errors = []
+
+    def add_batch():
+        nonlocal batch, batch_size
+        if batch:
+            tasks.append(
+                (functools.partial(_process_batch, fn, batch), batch_size, batch)
+            )
+            batch = []
+            batch_size = 0
+
+    def add_file(path, size):
+        nonlocal batch_size
+        args = (path, *arguments(path)) if arguments else (path,)
+        if size <= SMALL_FILE_SIZE:
+            batch.append(args)
+            batch_size += size
+            if len(batch) >= BATCH_FILES:
+                add_batch()
+            return
+
+        add_batch()
+        if split and workers > 1:
+            request = _SplitRequest(path, size, args)
+            tasks.append((functools.partial(split, path, size), 0, request))
+        else:
+            tasks.append((functools.partial(fn, *args), size, path))
+
+    def split_done(request, result):
+        # The ranges of a split file, or the whole file if it was not split,
+        # are started before anything else
+        if isinstance(result, Exception):
+            errors.append(f"{request.path}: {result}")
+            progress.update(request.size)
+        elif result:
+            tasks.extendleft(
+                (task, range_size, result)
+                for task, range_size in reversed(result.ranges)
+            )
+        else:
+            tasks.appendleft(
+                (functools.partial(fn, *request.args), request.size, request.path)
+            )
+
+    def finished(path, result):
+        if on_result:
+            on_result(path, result)
+        if journal:
+            journal.done(path)
+
+    def started(owner):
+        # Splitting creates the partial output, so split files are started
+        # by their _SplitRequest
+        if isinstance(owner, list):
+            return [args[0] for args in owner]
+        elif isinstance(owner, _SplitRequest):
+            return [owner.path]
+        elif isinstance(owner, _SplitFile):
+            return []
+        return [owner]
+
+    def submit(ready):
+        if journal:
+            journal.start(path for _, _, owner in ready for path in started(owner))
+        for task, size, owner in ready:
+            pending[executor.submit(task)] = (size, owner)
+
+    def collect(futures):
+        for future in futures:
+            size, owner = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+
+            if isinstance(owner, _SplitRequest):
+                split_done(owner, result)
+            elif isinstance(owner, _SplitFile):
+                if isinstance(result, Exception) and not owner.error:
+                    owner.error = f"{owner.path}: {result}"
+                owner.remaining -= 1
+                if not owner.remaining:
+                    try:
+                        owner.finish(not owner.error)
+                    except Exception as e:
+                        owner.error = owner.error or f"{owner.path}: {e}"
+                    if owner.error:
+                        errors.append(owner.error)
+                    else:
+                        finished(owner.path, None)
+            elif isinstance(result, Exception):
+                errors.append(f"{owner}: {result}")
+            elif isinstance(owner, list):
+                for path, batch_result, error in result:
+                    if error:
+                        errors.append(f"{path}: {error}")
+                    else:
+                        finished(path, batch_result)
+            else:
+                finished(owner, result)
+
+            progress.update(size)
+
+    with (
+        tqdm(total=0, unit="B", unit_scale=True, unit_divisor=1024) as progress,
+        DIRECTORY_POOLS[pool](max_workers=workers) as executor,
+        _scan_in_background(
+            _scan_files(directory, select, unreadable), progress
+        ) as found,
+    ):
+        scanning = True
+        while True:
+            # Tasks are started together so the journal is synced once
+            ready = []
+            while len(pending) + len(ready) < workers * 2:
+                if tasks:
+                    ready.append(tasks.popleft())
+                    continue
+                if not scanning:
+                    break
+
+                # Only wait for the walk while a worker would otherwise idle
+                idle = len(pending) + len(ready) < workers
+                try:
+                    priority, _, item = found.get(
+                        block=idle and not batch and not ready
+                    )
+                except queue.Empty:
+                    if not (idle and batch):
+                        break
+                    add_batch()
+                    continue
+
+                if item is None:
+                    scanning = False
+                    add_batch()
+                elif isinstance(item, BaseException):
+                    raise item
+                else:
+                    add_file(item, -priority)
+
+            submit(ready)
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    if errors:
+        raise LockBoxException(
+            "{} files could not be processed\n{}".format(len(errors), "\n".join(errors))
+        )
+
+
+# Directory runs keep a write-ahead journal so that an interrupted run can be
+# resumed, and write every output under a temporary name that is only renamed
+# into place once the output is complete and synced.
+JOURNAL_FILE = ".lockbox-journal"
+PARTIAL_SUFFIX = ".lockbox-partial"
+
+# Incremental runs remember the size, mtime, inode and a keyed content hash
+# of every file encrypted into an output directory in a sqlite database kept
+# there, and skip files whose size, mtime and inode are unchanged. Files whose
+# metadata changed are hashed and only encrypted if their contents did too.
+STATE_FILE = ".lockbox-state"
+FileState = collections.namedtuple("FileState", ["size", "mtime", "inode", "hash"])
+
+
+def _hash_contents(infile, key):
+    return hashlib.file_digest(
+        infile, lambda: hashlib.blake2b(key=key, digest_size=32)
+    ).digest()
+
+
+def _open_state(password, output_directory):
+    # Returns the database and the key for content hashes. The key is derived
+    # from the passphrase with a salt kept in the database, and is checked
+    # against a stored verifier so that a different passphrase is not mixed
+    # into an existing output directory.
+    db = sqlite3.connect(output_directory / STATE_FILE)
+    db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB)")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS files "
+        "(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, "
+        "hash BLOB)"
+    )
+
+    meta = dict(db.execute("SELECT name, value FROM meta"))
+    salt = meta.get("salt") or secrets.token_bytes(SALT_LENGTH)
+    iterations = meta.get("iterations") or HASH_ITERATIONS
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=KEY_LENGTH,
+        salt=salt,
+        info=b"lockbox state hash",
+        backend=default_backend(),
+    )
+    key = hkdf.derive(_derive_key(password, salt, iterations))
+    verifier = hmac.digest(key, b"lockbox state", "sha256")
+
+    if "verifier" not in meta:
+        db.executemany(
+            "INSERT INTO meta VALUES (?, ?)",
+            [("salt", salt), ("iterations", iterations), ("verifier", verifier)],
+        )
+        db.commit()
+    elif not hmac.compare_digest(meta["verifier"], verifier):
+        db.close()
+        raise LockBoxException(
+            f"Passphrase does not match the one used for {output_directory}"
+        )
+
+    return db, key
+
+
+def _mirror_directory(
+    password,
+    directory,
+    output_directory,
+    cipher=DEFAULT_CIPHER,
+    workers=1,
+    pool="thread",
+    incremental=False,
+    resume=False,
+    chunk_size=None,
+    compression=None,
+):
+    _check_directory(directory)
+    directory = Path(os.path.abspath(directory))
+    output_directory = Path(os.path.abspath(output_directory))
+    if output_directory.is_relative_to(directory):
+        raise LockBoxException(
+            f"Output directory {output_directory} can not be inside {directory}"
+        )
+    output_directory.mkdir(parents=True, exist_ok=True)
+
+    journal = _Journal(
+        output_directory / JOURNAL_FILE,
+        "encrypt",
+        directory,
+        functools.partial(_mirrored_path, directory, output_directory),
+        resume=resume,
+    )
+    with journal:
+        if incremental:
+            _mirror_incremental(
+                password,
+                directory,
+                output_directory,
+                cipher=cipher,
+                workers=workers,
+                pool=pool,
+                journal=journal,
+                chunk_size=chunk_size,
+                compression=compression,
+            )
+        else:
+            _process_directory(
+                directory,
+                None,
+                functools.partial(
+                    _mirror_path,
+                    password,
+                    directory,
+                    output_directory,
+                    cipher,
+                    chunk_size,
+                    compression,
+                ),
+                workers=workers,
+                pool=pool,
+                journal=journal,
+            )
+
+
+def _mirror_incremental(
+    password,
+    directory,
+    output_directory,
+    cipher=DEFAULT_CIPHER,
+    workers=1,
+    pool="thread",
+    journal=None,
+    chunk_size=None,
+    compression=None,
+):
+    db, key = _open_state(password, output_directory)
+    with contextlib.closing(db):
+        known = {
+            path: FileState(size, mtime, inode, digest)
+            for path, size, mtime, inode, digest in db.execute("SELECT * FROM files")
+        }
+        seen = set()
+        unreadable = []
+
+        def changed(entry):
+            name = Path(entry.path).relative_to(directory).as_posix()
+            seen.add(name)
+
+            state = known.get(name)
+            stat = entry.stat(follow_symlinks=False)
+            return not state or (state.size, state.mtime, state.inode) != (
+                stat.st_size,
+                stat.st_mtime_ns,
+                stat.st_ino,
+            )
+
+        def previous(path):
+            state = known.get(path.relative_to(directory).as_posix())
+            return key, state.hash if state else None
+
+        def record(path, state):
+            db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (path.relative_to(directory).as_posix(), *state),
+            )
+
+        try:
+            _process_directory(
+                directory,
+                changed,
+                functools.partial(
+                    _mirror_path,
+                    password,
+                    directory,
+                    output_directory,
+                    cipher,
+                    chunk_size,
+                    compression,
+                ),
+                workers=workers,
+                pool=pool,
+                arguments=previous,
+                on_result=record,
+                journal=journal,
+                unreadable=unreadable,
+            )
+        finally:
+            db.commit()
+
+        # Files that have gone from the input are removed from the mirror.
+        # Files under paths that could not be read may still be there, so
+        # they are kept until a later run can tell.
+        for name in known.keys() - seen:
+            path = directory / name
+            if any(path.is_relative_to(missed) for missed in unreadable):
+                continue
+
+            output_file = output_directory / f"{name}{LOCKBOX_SUFFIX}"
+            output_file.unlink(missing_ok=True)
+            db.execute("DELETE FROM files WHERE path = ?", (name,))
+        db.commit()
+
+
+def _mirrored_path(directory, output_directory, path):
+    return _encrypted_path(output_directory / path.relative_to(directory))
+
+
+def _mirror_path(
+    password,
+    directory,
+    output_directory,
+    cipher,
+    chunk_size,
+    compression,
+    path,
+    hash_key=None,
+    previous_hash=None,
+):
+    # Encrypts path to the same place under output_directory, leaving the
+    # original alone. With a hash_key, the contents are hashed first and the
+    # file is not encrypted again if they match previous_hash. Returns the
+    # new FileState.
+    output_file = _mirrored_path(directory, output_directory, path)
+
+    with open(path, "rb") as infile:
+        stat = os.fstat(infile.fileno())
+        digest = _hash_contents(infile, hash_key) if hash_key else None
+
+    if digest is None or digest != previous_hash or not output_file.exists():
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        with _atomic_output(output_file) as partial:
+            encrypt_file(
+                password,
+                path,
+                output_file=partial,
+                cipher=cipher,
+                chunk_size=chunk_size,
+                compression=compression,
+                map_input=False,
+            )
+
+    return FileState(stat.st_size, stat.st_mtime_ns, stat.st_ino, digest)
+
+
+def encrypt_directory(
+    password,
+    directory,
+    cipher=DEFAULT_CIPHER,
+    workers=1,
+    pool="thread",
+    output_directory=None,
+    incremental=False,
+    resume=False,
+    chunk_size=None,
+    compression=None,
+):
+    if isinstance(password, str):
+        password = password.encode("utf-8")
+    if chunk_size is not None:
+        _check_chunk_size(chunk_size)
+    _get_compression(compression)
+
+    if output_directory:
+        _mirror_directory(
+            password,
+            directory,
+            output_directory,
+            cipher=cipher,
+            workers=workers,
+            pool=pool,
+            incremental=incremental,
+            resume=resume,
+            chunk_size=chunk_size,
+            compression=compression,
+        )
+        return
+    if incremental:
+        raise LockBoxException("Incremental encryption needs an output directory")
+
+    _check_directory(directory)
+    with _Journal(
+        directory / JOURNAL_FILE, "encrypt", directory, _encrypted_path, resume=resume
+    ) as journal:
+        _process_directory(
+            directory,
+            None,
+            functools.partial(
+                _encrypt_path,
+                password,
+                cipher=cipher,
+                chunk_size=chunk_size,
+                compression=compression,
+            ),
+            workers=workers,
+            pool=pool,
+            split=functools.partial(
+                _split_encrypt,
+                password,
+                cipher=cipher,
+                chunk_size=chunk_size,
+                compression=compression,
+            ),
+            journal=journal,
+        )
+
+
+def _is_lockbox_entry(entry):
+    return entry.name.endswith(LOCKBOX_SUFFIX)
+
+
+def decrypt_directory(password, directory, workers=1, pool="thread", resume=False):
+    if isinstance(password, str):
+        password = password.encode("utf-8")
+
+    _check_directory(directory)
+    with _Journal(
+        directory / JOURNAL_FILE, "decrypt", directory, _decrypted_path, resume=resume
+    ) as journal:
+        _process_directory(
+            directory,
+            _is_lockbox_entry,
+            functools.partial(_decrypt_path, password),
+            workers=workers,
+            pool=pool,
+            split=functools.partial(_split_decrypt, password),
+            journal=journal,
+        )
+
+
+def _rechunk(pieces, chunk_size):
+    # Yields (chunk, is_final) pairs of exactly chunk_size bytes, except for
+    # the last one, from pieces of any size
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) > chunk_size:
+            yield bytes(buffer[:chunk_size]), False
+            del buffer[:chunk_size]
+
+    yield bytes(buffer), True
+
+
+def _archive_pieces(directory, chunk_size):
+    table = bytearray()
+    count = 0
+    position = 0
+
+    for path, _ in _scan_files(directory):
+        name = os.fsencode(path.relative_to(directory).as_posix())
+        if len(name) > 0xFFFF:
+            raise LockBoxException(f"{path} has too long a name to be packed")
+
+        with open(path, "rb") as infile:
+            stat = os.fstat(infile.fileno())
+            record = (
+                _MEMBER.pack(
+                    len(name), stat.st_size, stat.st_mode & 0o7777, stat.st_mtime_ns
+                )
+                + name
+            )
+            yield record
+            position += len(record)
+            table += _MEMBER_OFFSET.pack(position) + record
+
+            remaining = stat.st_size
+            while remaining:
+                data = infile.read(min(remaining, chunk_size))
+                if not data:
+                    raise LockBoxException(f"{path} changed while it was being packed")
+                yield data
+                remaining -= len(data)
+
+            position += stat.st_size
+            count += 1
+
+    yield _MEMBER.pack(0, 0, 0, 0)
+    position += _MEMBER.size
+
+    yield table
+    yield _ARCHIVE_TRAILER.pack(position, count)
+
+
+def pack_directory(
+    password, directory, archive_file, cipher=DEFAULT_CIPHER, compression=None
+):
+    if not directory.exists():
+        raise LockBoxException(f"{directory} does not exist")
+    if not directory.is_dir():
+        raise LockBoxException(f"{directory} is not a directory")
+    if Path(os.path.abspath(archive_file)).is_relative_to(os.path.abspath(directory)):
+        raise LockBoxException(f"Archive {archive_file} can not be inside {directory}")
+
+    if isinstance(password, str):
+        password = password.encode("utf-8")
+
+    compression = _get_compression(compression)
+    chunk_size = CHUNK_SIZE
+    header, stream_cipher = _new_stream(
+        password,
+        cipher,
+        chunk_size=chunk_size,
+        flags=FLAG_ARCHIVE | FLAG_INDEXED | _compression_flags(compression),
+    )
+
+    chunks = _rechunk(_archive_pieces(directory, chunk_size), chunk_size)
+    frames = _encrypt_frames(stream_cipher, header, chunks, compression=compression)
+
+    try:
+        with open(archive_file, "wb") as outfile:
+            offsets, position = _write_frames(outfile, header, frames)
+            _write_index(outfile, stream_cipher, header, offsets, position, chunk_size)
+    except BaseException:
+        archive_file.unlink(missing_ok=True)
+        raise
+
+
+class _ChunkReader:
+    # Reads across a stream of plaintext chunks. Chunks may share a buffer
+    # that is overwritten by the next one, so pieces are only valid until the
+    # next piece is requested.
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b"")
+
+    def read_pieces(self, size):
+        while size:
+            if not self._chunk:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    raise LockBoxException("Archive is truncated")
+                self._chunk = memoryview(chunk)
+
+            piece = self._chunk[:size]
+            self._chunk = self._chunk[len(piece) :]
+            size -= len(piece)
+            yield piece
+
+    def read(self, size):
+        return b"".join(bytes(piece) for piece in self.read_pieces(size))
+
+    def drain(self):
+        for _ in self._chunks:
+            pass
+
+
+def _member_path(directory, name):
+    member = PurePosixPath(os.fsdecode(name))
+    if not member.parts or member.is_absolute() or ".." in member.parts:
+        raise LockBoxException(f"Refusing to unpack {member} outside of {directory}")
+
+    return directory.joinpath(*member.parts)
+
+
+def _member_parent(directory, member, path):
+    # Creates the directories above path one at a time, refusing any that
+    # resolve outside of directory, such as symbolic links to elsewhere
+    root = os.path.realpath(directory)
+    parent = directory
+    for part in path.relative_to(directory).parts[:-1]:
+        parent = parent / part
+        try:
+            parent.mkdir()
+        except FileExistsError:
+            pass
+        except OSError as e:
+            raise LockBoxException(f"Could not write {member}: {e.strerror}")
+
+        resolved = os.path.realpath(parent)
+        if os.path.commonpath([root, resolved]) != root:
+            raise LockBoxException(
+                f"Refusing to write {member} through {parent} outside of {directory}"
+            )
+        if not os.path.isdir(resolved):
+            raise LockBoxException(
+                f"Could not write {member}: {parent} is not a directory"
+            )
+
+
+def _create_member(directory, member, path):
+    # Returns path opened as a new file. Existing files are replaced rather
+    # than written through, and neither path nor the directories above it
+    # may lead out of directory.
+    directory.mkdir(parents=True, exist_ok=True)
+    _member_parent(directory, member, path)
+    if path.is_symlink():
+        raise LockBoxException(f"Refusing to write {member} through a symbolic link")
+
+    try:
+        path.unlink(missing_ok=True)
+        fd = os.open(
+            path,
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_NOFOLLOW", 0),
+            0o600,
+        )
+    except OSError as e:
+        raise LockBoxException(f"Could not write {member}: {e.strerror}")
+
+    return open(fd, "wb")
+
+
+def _finish_member(outfile, mode, mtime, preserve_mode=False):
+    # Setuid, setgid and sticky bits are only restored when asked for
+    outfile.flush()
+    os.chmod(outfile.fileno(), mode & (0o7777 if preserve_mode else 0o777))
+    os.utime(outfile.fileno(), ns=(mtime, mtime))
+
+
+def _unpack_member(directory, record, pieces, preserve_mode=False):
+    name_length, size, mode, mtime = _MEMBER.unpack(record[: _MEMBER.size])
+    member = os.fsdecode(record[_MEMBER.size :])
+    path = _member_path(directory, record[_MEMBER.size :])
+
+    with _create_member(directory, member, path) as outfile:
+        outfile.writelines(pieces)
+        _finish_member(outfile, mode, mtime, preserve_mode=preserve_mode)
+
+
+def _open_archive(password, infile):
+    header, fields = _read_header(infile)
+    if not fields.flags & FLAG_ARCHIVE:
+        raise LockBoxException(f"{infile.name} is not a lockbox archive")
+
+    return header, fields, _open_stream(password, fields)
+
+
+def _read_member_table(reader, names):
+    # Returns {name: (offset, record)} for the requested members, found
+    # through the trailer at the end of the archive plaintext
+    position, count = _ARCHIVE_TRAILER.unpack(
+        reader.read(-_ARCHIVE_TRAILER.size, _ARCHIVE_TRAILER.size)
+    )
+    table = memoryview(
+        reader.read(position, reader.size - _ARCHIVE_TRAILER.size - position)
+    )
+
+    members = {}
+    for _ in range(count):
+        (offset,) = _MEMBER_OFFSET.unpack(table[: _MEMBER_OFFSET.size])
+        table = table[_MEMBER_OFFSET.size :]
+        try:
+            name_length = _MEMBER.unpack(table[: _MEMBER.size])[0]
+        except struct.error:
+            raise LockBoxException("Archive member table is invalid")
+
+        record = bytes(table[: _MEMBER.size + name_length])
+        table = table[len(record) :]
+
+        name = os.fsdecode(record[_MEMBER.size :])
+        if name in names:
+            members[name] = (offset, record)
+
+    return members
+
+
+def _unpack_members(reader, directory, names, preserve_mode=False):
+    members = _read_member_table(reader, names)
+
+    missing = [name for name in names if name not in members]
+    if missing:
+        raise LockBoxException("Not found in archive: {}".format(", ".join(missing)))
+
+    for name in names:
+        offset, record = members[name]
+        size = _MEMBER.unpack(record[: _MEMBER.size])[1]
+        _unpack_member(
+            directory,
+            record,
+            reader.read_pieces(offset, size),
+            preserve_mode=preserve_mode,
+        )
+
+
+def unpack_archive(
+    password, archive_file, directory, members=None, preserve_mode=False
+):
+    if not archive_file.exists():
+        raise LockBoxException(f"{archive_file} does not exist")
+
+    if isinstance(password, str):
+        password = password.encode("utf-8")
+
+    with open(archive_file, "rb") as infile:
+        header, fields, cipher = _open_archive(password, infile)
+        if members:
+            # Only the frames holding the member table and the requested
+            # members are read and decrypted
+            reader = _RangeReader(infile, header, fields, cipher)
+            _unpack_members(
+                reader,
+                directory,
+                [str(name) for name in members],
+                preserve_mode=preserve_mode,
+            )
+            return
+
+        reader = _ChunkReader(
+            _decrypt_frames(
+                cipher,
+                header,
+                _read_frames(infile, _max_frame_length(fields)),
+                fields.chunk_size,
+                compression=_header_compression(fields),
+            )
+        )
+
+        while True:
+            record = reader.read(_MEMBER.size)
+            name_length, size, _, _ = _MEMBER.unpack(record)
+            if not name_length:
+                break
+
+            record += reader.read(name_length)
+            _unpack_member(
+                directory,
+                record,
+                reader.read_pieces(size),
+                preserve_mode=preserve_mode,
+            )
+
+        # The member table follows, reading it through checks the final frame
+        reader.drain()
+
+
+class Vault:
+    # Only the key derivation happens when a vault is opened. Reading an entry
+    # decrypts just that entry and writing one replaces just its row. Every
+    # write is encrypted under a random nonce, so copies of a vault that are
+    # written to separately do not reuse nonces, and is bound to its row so
+    # that rows cannot be swapped.
+    def __init__(self, password, path, cipher=DEFAULT_CIPHER):
+        if isinstance(password, str):
+            password = password.encode("utf-8")
+
+        self.path = Path(path)
+        self._db = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(lookup BLOB PRIMARY KEY, frame INTEGER, data BLOB)"
+            )
+            meta = dict(self._db.execute("SELECT name, value FROM meta"))
+            self._open(password, cipher, meta)
+        except sqlite3.DatabaseError:
+            self._db.close()
+            raise LockBoxException(f"{self.path} is not a lockbox vault")
+        except LockBoxException:
+            self._db.close()
+            raise
+
+    def _open(self, password, cipher, meta):
+        if "header" in meta:
+            self._header = meta["header"]
+            fields = _unpack_header(self._header)
+            if not fields.flags & FLAG_VAULT:
+                raise LockBoxException(f"{self.path} is not a lockbox vault")
+        else:
+            fields = _new_header(
+                cipher,
+                chunk_size=MAX_CHUNK_SIZE,
+                flags=FLAG_VAULT,
+                salt=_new_salt(password),
+            )
+            self._header = _pack_header(fields)
+
+        master_key = _derive_key(password, fields.salt, fields.iterations)
+        hkdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=KEY_LENGTH,
+            salt=fields.nonce,
+            info=b"lockbox vault lookup",
+            backend=default_backend(),
+        )
+        self._lookup_key = hkdf.derive(master_key)
+        self._cipher = _get_stream_cipher(fields.cipher, master_key, fields.nonce)
+        self._chunk_size = fields.chunk_size
+
+        verifier = hmac.digest(self._lookup_key, b"lockbox vault", "sha256")
+        if "verifier" not in meta:
+            with self._db:
+                self._db.execute("BEGIN IMMEDIATE")
+                self._db.executemany(
+                    "INSERT INTO meta VALUES (?, ?)",
+                    [
+                        ("header", self._header),
+                        ("verifier", verifier),
+                    ],
+                )
+        elif not hmac.compare_digest(meta["verifier"], verifier):
+            raise LockBoxException(
+                f"Passphrase does not match the one used for {self.path}"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def _lookup(self, name):
+        return hmac.digest(self._lookup_key, name.encode("utf-8"), "sha256")
+
+    def _decrypt(self, lookup, frame, data):
+        if frame is None:
+            nonce, data = data[: _FRAME_NONCE.size], data[_FRAME_NONCE.size :]
+        else:
+            # Rows written before entries got random nonces hold the frame
+            # index their nonce was made from
+            nonce = _FRAME_NONCE.pack(frame, False, False)
+
+        try:
+            entry = self._cipher.decrypt(nonce, data, self._header + lookup)
+        except (InvalidToken, InvalidTag):
+            raise LockBoxException(f"{self.path} has been tampered with")
+
+        (name_length,) = _VAULT_NAME.unpack_from(entry)
+        start = _VAULT_NAME.size + name_length
+        return entry[_VAULT_NAME.size : start].decode("utf-8"), entry[start:]
+
+    def get(self, name):
+        lookup = self._lookup(name)
+        row = self._db.execute(
+            "SELECT frame, data FROM entries WHERE lookup = ?", (lookup,)
+        ).fetchone()
+        if not row:
+            raise LockBoxException(f"{name} is not in {self.path}")
+
+        return self._decrypt(lookup, *row)[1]
+
+    def set(self, name, value):
+        if not isinstance(value, bytes):
+            value = value.encode("utf-8")
+
+        encoded_name = name.encode("utf-8")
+        entry = _VAULT_NAME.pack(len(encoded_name)) + encoded_name + value
+        if len(entry) > self._chunk_size:
+            raise LockBoxException(f"{name} is too large to be kept in a vault")
+
+        lookup = self._lookup(name)
+        nonce = secrets.token_bytes(_FRAME_NONCE.size)
+        data = self._cipher.encrypt(nonce, entry, self._header + lookup)
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, NULL, ?)",
+                (lookup, nonce + data),
+            )
+
+    def names(self):
+        return sorted(
+            self._decrypt(*row)[0]
+            for row in self._db.execute("SELECT lookup, frame, data FROM entries")
+        )
+
+
+def _file_record(directory, path, status):
+    return {
+        "path": path.relative_to(directory).as_posix(),
+        "size": status.st_size,
+        "mode": stat.S_IMODE(status.st_mode),
+        "mtime": status.st_mtime_ns,
+        "inode": status.st_ino,
+    }
+
+
+def _check_repository_chunk_size(chunk_size):
+    # Chunks must average at least 2 bytes for the cut masks to have bits
+    _check_chunk_size(chunk_size)
+    if chunk_size < REPOSITORY_MIN_CHUNK_SIZE:
+        raise LockBoxException(
+            f"Repository chunk size must be at least {REPOSITORY_MIN_CHUNK_SIZE} bytes"
+        )
+
+
+def _gear_tables(gear):
+    # Translate tables giving each byte of the gear values, lowest first
+    return tuple(
+        bytes((value >> shift) & 0xFF for value in gear) for shift in (0, 8, 16, 24)
+    )
+
+
+def _gear_tests(mask):
+    # For every byte of the hash that mask covers, a translate table giving 1
+    # for the values of that byte with none of the bits of mask set
+    tests = []
+    for index in range(4):
+        bits = (mask >> (8 * index)) & 0xFF
+        if bits:
+            tests.append((index, bytes(int(not value & bits) for value in range(256))))
+    return tests
+
+
+def _gear_cut(view, origin, start, stop, tests, tables):
+    # Returns the position just after the first byte from start to stop where
+    # the gear hash has none of the bits of mask set, or None. The hash starts
+    # from 0 at origin and every byte doubles it and adds its gear value.
+    #
+    # Rather than looping over the bytes, the hashes of a block are found at
+    # once. The gear value of every byte goes into a 64 bit lane of a single
+    # integer, and adding copies of it shifted by one lane and one bit more
+    # each time sums the last 32 values, each doubled once per byte after it.
+    # Only the low 32 bits of a lane are the hash, and the sum never carries
+    # into the next lane. Doubling the number of copies each time takes five
+    # additions.
+    if not tests:
+        return start + 1 if start < stop else None
+
+    for low in range(start, stop, GEAR_BLOCK_SIZE):
+        # Each block starts with up to 31 bytes before it, which only count
+        # towards the hashes of the block
+        context = min(low - origin, 31)
+        data = bytes(view[low - context : min(low + GEAR_BLOCK_SIZE, stop)])
+        lanes = bytearray(len(data) * 8)
+        for index, table in enumerate(tables):
+            lanes[index::8] = data.translate(table)
+
+        hashes = int.from_bytes(lanes, "little")
+        for step in range(5):
+            hashes += hashes << (65 << step)
+        lanes = hashes.to_bytes(len(lanes) + 256, "little")
+
+        clear = -1
+        for index, table in tests:
+            clear &= int.from_bytes(
+                lanes[index : len(data) * 8 : 8].translate(table), "little"
+            )
+        position = clear.to_bytes(len(data), "little").find(1, context)
+        if position >= 0:
+            return low - context + position + 1
+
+    return None
+
+
+def _content_chunks(infile, gear, max_size):
+    # Yields views of what is read from infile cut in the style of FastCDC.
+    # The gear hash only depends on the last 32 bytes, so cuts line up again
+    # shortly after an insertion or deletion. A cut needs more bits to be
+    # clear before the average size than after it, which keeps chunks close
+    # to the average. No more than max_size bytes are read ahead of a cut,
+    # and chunks are only valid until the next one is requested.
+    _check_repository_chunk_size(max_size)
+    min_size = max_size // 16
+    average = max_size // 8
+    bits = average.bit_length() - 1
+    strict = _gear_tests(((1 << bits + 1) - 1) << (31 - bits))
+    loose = _gear_tests(((1 << bits - 1) - 1) << (33 - bits))
+    tables = _gear_tables(gear)
+
+    buffer = bytearray(max_size * 2)
+    view = memoryview(buffer)
+    start = length = 0
+    end_of_file = False
+    while True:
+        if length - start < max_size and not end_of_file:
+            # What is left is moved to the front of the buffer and the rest
+            # of it is filled from infile
+            left = length - start
+            view[:left] = view[start:length]
+            read = _read_exactly(infile, view[left:])
+            end_of_file = read < len(buffer) - left
+            length = left + read
+            start = 0
+            continue
+        if start == length:
+            break
+
+        end = min(start + max_size, length)
+        cut = None
+        if end - start > min_size:
+            origin = start + min_size
+            normal = min(start + average, end)
+            cut = _gear_cut(view, origin, origin, normal, strict, tables)
+            if cut is None:
+                cut = _gear_cut(view, origin, normal, end, loose, tables)
+
+        cut = cut or end
+        yield view[start:cut]
+        start = cut
+
+
+class Repository:
+    # Only the key derivation happens when a repository is opened. Backups
+    # only read files whose size, mtime or inode changed since the latest
+    # snapshot of the same directory, and only write the chunks that are not
+    # stored yet. Chunk boundaries and ids are keyed, so the stored chunks say
+    # nothing about the contents of the files. Changed files are chunked on
+    # a pool of processes, which get the repository handed to them pickled.
+    def __init__(
+        self,
+        password,
+        path,
+        cipher=DEFAULT_CIPHER,
+        compression=None,
+        chunk_size=REPOSITORY_CHUNK_SIZE,
+    ):
+        if isinstance(password, str):
+            password = password.encode("utf-8")
+
+        self.path = Path(path)
+        config = self.path / REPOSITORY_CONFIG
+        if config.is_file():
+            with open(config, "rb") as infile:
+                try:
+                    header, fields = _read_header(infile)
+                except LockBoxException:
+                    fields = None
+                verifier = infile.read()
+            if not fields or not fields.flags & FLAG_REPOSITORY:
+                raise LockBoxException(f"{self.path} is not a lockbox repository")
+        else:
+            if self.path.exists() and any(self.path.iterdir()):
+                raise LockBoxException(f"{self.path} is not a lockbox repository")
+
+            _check_repository_chunk_size(chunk_size)
+            compression = _get_compression(compression)
+            fields = _new_header(
+                cipher,
+                chunk_size=chunk_size,
+                flags=FLAG_REPOSITORY | _compression_flags(compression),
+                salt=_new_salt(password),
+            )
+            header = _pack_header(fields)
+            verifier = None
+
+        self._header = header
+        self._master_key = _derive_key(password, fields.salt, fields.iterations)
+        self._open_keys()
+
+        expected = hmac.digest(self._id_key, b"lockbox repository", "sha256")
+        if verifier is None:
+            (self.path / REPOSITORY_DATA).mkdir(parents=True, exist_ok=True)
+            (self.path / REPOSITORY_SNAPSHOTS).mkdir(exist_ok=True)
+            with _atomic_output(config) as partial:
+                partial.write_bytes(MAGIC + header + expected)
+        elif not hmac.compare_digest(verifier, expected):
+            raise LockBoxException(
+                f"Passphrase does not match the one used for {self.path}"
+            )
+
+    def _open_keys(self):
+        self._fields = _unpack_header(self._header)
+        self._compression = _header_compression(self._fields)
+        self._id_key = self._subkey(b"lockbox repository id")
+        self._blob_key = self._subkey(b"lockbox repository blob")
+        self._gear = _GEAR.unpack(
+            self._subkey(b"lockbox repository chunker", _GEAR.size)
+        )
+
+    def __getstate__(self):
+        # Cipher classes can not be pickled, so workers unpack the header and
+        # derive the subkeys again
+        return self.path, self._header, self._master_key
+
+    def __setstate__(self, state):
+        self.path, self._header, self._master_key = state
+        self._open_keys()
+
+    def _subkey(self, info, length=KEY_LENGTH):
+        hkdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=length,
+            salt=self._fields.nonce,
+            info=info,
+            backend=default_backend(),
+        )
+        return hkdf.derive(self._master_key)
+
+    @contextlib.contextmanager
+    def _lock(self, exclusive=False):
+        # Backups share the repository, but forgetting a snapshot needs it to
+        # itself, since it removes chunks that no finished snapshot lists yet
+        with open(self.path / REPOSITORY_CONFIG, "rb") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _blob_path(self, blob_id):
+        name = blob_id.hex()
+        return self.path / REPOSITORY_DATA / name[:2] / name
+
+    def _blob_cipher(self, blob_id):
+        # Every chunk is encrypted under a key of its own
+        return _get_stream_cipher(self._fields.cipher, self._blob_key, blob_id)
+
+    def _store(self, chunk):
+        # Returns the id of chunk, storing it if it is not stored already
+        blob_id = hashlib.blake2b(chunk, key=self._id_key, digest_size=32).digest()
+        path = self._blob_path(blob_id)
+        if path.exists():
+            return blob_id
+
+        if self._compression:
+            chunk = _compress_frame(self._compression, chunk)
+        nonce = _FRAME_NONCE.pack(0, True, False)
+        blob = self._blob_cipher(blob_id).encrypt(nonce, chunk, self._header + blob_id)
+
+        # Workers may store the same chunk at once, so each of them writes a
+        # partial file of its own
+        path.parent.mkdir(exist_ok=True)
+        partial = path.with_name(f"{path.name}.{secrets.token_hex(8)}{PARTIAL_SUFFIX}")
+        try:
+            with open(partial, "wb") as outfile:
+                outfile.write(blob)
+                os.fsync(outfile.fileno())
+            os.replace(partial, path)
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        return blob_id
+
+    def _load(self, blob_id):
+        try:
+            blob = self._blob_path(blob_id).read_bytes()
+        except FileNotFoundError:
+            raise LockBoxException(f"Chunk {blob_id.hex()} is missing from {self.path}")
+
+        try:
+            if len(blob) > _max_frame_length(self._fields):
+                raise InvalidTag
+            nonce = _FRAME_NONCE.pack(0, True, False)
+            chunk = self._blob_cipher(blob_id).decrypt(
+                nonce, blob, self._header + blob_id
+            )
+        except (InvalidToken, InvalidTag):
+            raise LockBoxException(f"{self.path} has been tampered with")
+
+        if self._compression:
+            chunk = _decompress_frame(self._compression, chunk, self._fields.chunk_size)
+        return chunk
+
+    def _snapshot_path(self, snapshot_id):
+        try:
+            valid = len(bytes.fromhex(snapshot_id)) == SNAPSHOT_ID_LENGTH
+        except ValueError:
+            valid = False
+        if not valid:
+            raise LockBoxException(f"Invalid snapshot id {snapshot_id}")
+
+        return self.path / REPOSITORY_SNAPSHOTS / snapshot_id
+
+    def _write_manifest(self, snapshot_id, lines):
+        # Manifests are lockbox files of their own, keyed by the repository
+        # header, so the passphrase is not run through the KDF again
+        fields = _new_header(
+            self._fields.cipher.name,
+            chunk_size=_chunk_size(),
+            flags=_compression_flags(self._compression),
+            salt=self._fields.salt,
+        )._replace(iterations=self._fields.iterations)
+        header = _pack_header(fields)
+        cipher = _get_stream_cipher(fields.cipher, self._master_key, fields.nonce)
+
+        frames = _encrypt_frames(
+            cipher,
+            header,
+            _rechunk(lines, fields.chunk_size),
+            compression=self._compression,
+        )
+        with _atomic_output(self._snapshot_path(snapshot_id)) as partial:
+            with open(partial, "wb") as outfile:
+                _write_frames(outfile, header, frames)
+
+    def _read_manifest(self, snapshot_id):
+        # Yields the snapshot record and then a record for every file
+        path = self._snapshot_path(snapshot_id)
+        if not path.is_file():
+            raise LockBoxException(f"Snapshot {snapshot_id} is not in {self.path}")
+
+        with open(path, "rb") as infile:
+            header, fields = _read_header(infile)
+            if (fields.salt, fields.iterations) != (
+                self._fields.salt,
+                self._fields.iterations,
+            ):
+                raise LockBoxException(f"{self.path} has been tampered with")
+
+            cipher = _get_stream_cipher(fields.cipher, self._master_key, fields.nonce)
+            pending = b""
+            for data in _decrypt_frames(
+                cipher,
+                header,
+                _read_frames(infile, _max_frame_length(fields)),
+                fields.chunk_size,
+                compression=_header_compression(fields),
+            ):
+                *lines, pending = (pending + bytes(data)).split(b"\n")
+                for line in lines:
+                    yield json.loads(line)
+
+    def _snapshot(self, snapshot_id):
+        with contextlib.closing(self._read_manifest(snapshot_id)) as records:
+            record = next(records)
+        return Snapshot(snapshot_id, record["time"], record["source"])
+
+    def snapshots(self):
+        # Oldest first
+        return sorted(
+            (
+                self._snapshot(path.name)
+                for path in (self.path / REPOSITORY_SNAPSHOTS).iterdir()
+                if not path.name.endswith(PARTIAL_SUFFIX)
+            ),
+            key=lambda snapshot: snapshot.time,
+        )
+
+    def _resolve(self, snapshot_id):
+        if snapshot_id != "latest":
+            return snapshot_id
+
+        snapshots = self.snapshots()
+        if not snapshots:
+            raise LockBoxException(f"{self.path} has no snapshots")
+        return snapshots[-1].id
+
+    def _backup_file(self, directory, path):
+        # Stores the chunks of path and returns its record, or None if it has
+        # been removed since the walk found it. Files are read rather than
+        # mapped, since a mapped file that shrinks would kill the worker.
+        try:
+            infile = open(path, "rb")
+        except FileNotFoundError:
+            return None
+
+        with infile:
+            record = _file_record(directory, path, os.fstat(infile.fileno()))
+            chunks = []
+            size = 0
+            for chunk in _content_chunks(infile, self._gear, self._fields.chunk_size):
+                chunks.append(self._store(chunk).hex())
+                size += len(chunk)
+
+        # The size that is restored is the size that was read
+        record["size"] = size
+        record["chunks"] = chunks
+        return record
+
+    def backup(self, directory, workers=1):
+        _check_directory(directory)
+        directory = Path(os.path.abspath(directory))
+        if Path(os.path.abspath(self.path)).is_relative_to(directory):
+            raise LockBoxException(
+                f"Repository {self.path} can not be inside {directory}"
+            )
+
+        # Files are compared with the latest snapshot of the same directory
+        known = {}
+        for snapshot in reversed(self.snapshots()):
+            if snapshot.source == str(directory):
+                records = self._read_manifest(snapshot.id)
+                next(records)
+                known = {record["path"]: record for record in records}
+                break
+
+        snapshot = Snapshot(
+            secrets.token_hex(SNAPSHOT_ID_LENGTH), time.time(), str(directory)
+        )
+        records = []
+        unreadable = []
+
+        def changed(entry):
+            # Unchanged files keep their chunks and are not handed to workers
+            path = Path(entry.path)
+            record = _file_record(directory, path, entry.stat(follow_symlinks=False))
+            previous = known.get(record["path"])
+            if previous and all(
+                previous[key] == record[key] for key in ("size", "mtime", "inode")
+            ):
+                record["chunks"] = previous["chunks"]
+                records.append(record)
+                return False
+            return True
+
+        def backed_up(path, record):
+            if record:
+                records.append(record)
+
+        # Chunking holds the GIL, so it is spread over processes
+        with self._lock():
+            _process_directory(
+                directory,
+                changed,
+                functools.partial(self._backup_file, directory),
+                workers=workers,
+                pool="process" if workers > 1 else "thread",
+                on_result=backed_up,
+                unreadable=unreadable,
+            )
+
+            # Files under paths that could not be read are kept as they were
+            found = {record["path"] for record in records}
+            records.extend(
+                record
+                for name, record in known.items()
+                if name not in found
+                and any(
+                    (directory / name).is_relative_to(missed) for missed in unreadable
+                )
+            )
+            records.sort(key=lambda record: record["path"])
+
+            lines = [{"time": snapshot.time, "source": snapshot.source}, *records]
+            self._write_manifest(
+                snapshot.id,
+                (json.dumps(line).encode("utf-8") + b"\n" for line in lines),
+            )
+        return snapshot
+
+    def restore(self, snapshot_id, directory, members=None, preserve_mode=False):
+        names = {str(member) for member in members} if members else None
+        found = set()
+
+        records = self._read_manifest(self._resolve(snapshot_id))
+        next(records)
+        for record in records:
+            if names is not None and record["path"] not in names:
+                continue
+            found.add(record["path"])
+
+            path = _member_path(directory, record["path"])
+            with _create_member(directory, record["path"], path) as outfile:
+                for blob_id in record["chunks"]:
+                    outfile.write(self._load(bytes.fromhex(blob_id)))
+                if outfile.tell() != record["size"]:
+                    raise LockBoxException(f"{record['path']} has an unexpected size")
+
+                _finish_member(
+                    outfile,
+                    record["mode"],
+                    record["mtime"],
+                    preserve_mode=preserve_mode,
+                )
+
+        if names is not None and names - found:
+            raise LockBoxException(
+                "Not found in snapshot: {}".format(", ".join(sorted(names - found)))
+            )
+
+    def forget(self, snapshot_id):
+        # Removes a snapshot and every chunk that no other snapshot lists,
+        # returning the number of chunks removed
+        with self._lock(exclusive=True):
+            path = self._snapshot_path(self._resolve(snapshot_id))
+            if not path.is_file():
+                raise LockBoxException(f"Snapshot {snapshot_id} is not in {self.path}")
+            path.unlink()
+
+            used = set()
+            for snapshot in self.snapshots():
+                records = self._read_manifest(snapshot.id)
+                next(records)
+                for record in records:
+                    used.update(record["chunks"])
 
-        output_file = fullpath.parent / fullpath.stem
-        decrypt_file(password, fullpath, output_file=output_file, remove_original=True)
+            removed = 0
+            for path in (self.path / REPOSITORY_DATA).glob("*/*"):
+                if path.name not in used:
+                    path.unlink()
+                    removed += 1
+        return removed
@@ -1,6 +1,14 @@
 import pytest
+import base64
+import io
 import os
+import random
 import hashlib
+import sqlite3
+import threading
+import time
+import tracemalloc
+from src.lockbox import main, agent
 from src.lockbox.main import (
     _get_fernet,
     encrypt,
@@ -9,7 +17,20 @@ from src.lockbox.main import (
     decrypt_file,
     encrypt_directory,
     decrypt_directory,
+    decrypt_range,
+    pack_directory,
+    unpack_archive,
+    encrypt_stream,
+    decrypt_stream,
+    encrypt_many,
+    decrypt_many,
+    enable_key_cache,
+    Vault,
+    Repository,
+    disable_key_cache,
+    LockBoxException,
 )
+from src.lockbox.agent import Agent, AgentClient, connect_agent
 
 from cryptography.fernet import Fernet
 
@@ -47,6 +68,11 @@ class TestEncryptDecryptRoundTrip:
 
         assert plaintext == returned_plaintext
 
+    @pytest.mark.parametrize("ciphertext", [b"no separator", b"a$b$c"])
+    def test_malformed_token(self, ciphertext):
+        with pytest.raises(LockBoxException):
+            decrypt(b"super secret passphrase", ciphertext)
+
 
 class TestEncryptFileDecryptFileRoundTrip:
     @pytest.fixture(autouse=True)
@@ -135,3 +161,2521 @@ class TestEncryptFileDecryptFileRoundTrip:
         decrypt_file(self.password, encrypted_filename, output_file=test_filename)
 
         assert _get_hash(plaintext_filename) == _get_hash(test_filename)
+
+
+class TestVersionTwoFileFormat:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+        mocker.patch("src.lockbox.main.CHUNK_SIZE", 16)
+        self.derive_key_spy = mocker.spy(main, "_derive_key")
+
+        self.password = b"super secret passphrase"
+        self.plaintext = b"this is a sample plaintext to be encrypted" * 4
+
+        self.plaintext_filename = self.temp_dir / "plaintext_filename.txt"
+        self.encrypted_filename = self.temp_dir / "encrypted_filename.txt"
+        self.test_filename = self.temp_dir / "test_filename.txt"
+
+        with open(self.plaintext_filename, "wb") as f:
+            f.write(self.plaintext)
+
+    def test_key_derived_once_per_file(self):
+        encrypt_file(
+            self.password, self.plaintext_filename, output_file=self.encrypted_filename
+        )
+        decrypt_file(
+            self.password, self.encrypted_filename, output_file=self.test_filename
+        )
+
+        assert self.derive_key_spy.call_count == 2
+        assert self.encrypted_filename.read_bytes().startswith(main.MAGIC)
+        assert self.test_filename.read_bytes() == self.plaintext
+
+    @pytest.mark.parametrize("cipher", ["fernet", "aes-256-gcm", "chacha20-poly1305"])
+    @pytest.mark.parametrize("armor", [True, False])
+    def test_ciphers(self, cipher, armor):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            armor=armor,
+            cipher=cipher,
+        )
+        decrypt_file(
+            self.password, self.encrypted_filename, output_file=self.test_filename
+        )
+
+        assert self.test_filename.read_bytes() == self.plaintext
+
+    def test_auto_cipher_is_aead(self):
+        assert main._fastest_cipher() in ("aes-256-gcm", "chacha20-poly1305")
+
+    def test_unknown_cipher_raises(self):
+        with pytest.raises(LockBoxException):
+            encrypt_file(
+                self.password,
+                self.plaintext_filename,
+                output_file=self.encrypted_filename,
+                cipher="rot13",
+            )
+
+    def test_tampered_header_raises(self):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            cipher="aes-256-gcm",
+        )
+        data = bytearray(self.encrypted_filename.read_bytes())
+        # Flip a bit in the nonce, which is the last field of the header
+        data[len(main.MAGIC) + main._HEADER.size - 1] ^= 1
+        self.encrypted_filename.write_bytes(data)
+
+        with pytest.raises(LockBoxException):
+            decrypt_file(
+                self.password, self.encrypted_filename, output_file=self.test_filename
+            )
+
+    def test_armored(self):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            armor=True,
+        )
+        decrypt_file(
+            self.password, self.encrypted_filename, output_file=self.test_filename
+        )
+
+        assert self.derive_key_spy.call_count == 2
+        assert self.encrypted_filename.read_bytes().startswith(main.HEADER_PREFIX)
+        assert len(self.encrypted_filename.read_bytes().splitlines()) > 2
+        assert self.test_filename.read_bytes() == self.plaintext
+
+    def test_binary_smaller_than_armored(self):
+        armored_filename = self.temp_dir / "armored_filename.txt"
+
+        encrypt_file(
+            self.password, self.plaintext_filename, output_file=self.encrypted_filename
+        )
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=armored_filename,
+            armor=True,
+        )
+
+        assert self.encrypted_filename.stat().st_size < armored_filename.stat().st_size
+
+    def test_empty_file(self):
+        self.plaintext_filename.write_bytes(b"")
+
+        encrypt_file(
+            self.password, self.plaintext_filename, output_file=self.encrypted_filename
+        )
+        decrypt_file(
+            self.password, self.encrypted_filename, output_file=self.test_filename
+        )
+
+        assert self.test_filename.read_bytes() == b""
+
+    def test_legacy_file(self):
+        with open(self.encrypted_filename, "wb") as f:
+            for i in range(0, len(self.plaintext), 64):
+                f.write(encrypt(self.password, self.plaintext[i : i + 64]) + b"\n")
+
+        decrypt_file(
+            self.password, self.encrypted_filename, output_file=self.test_filename
+        )
+
+        assert self.test_filename.read_bytes() == self.plaintext
+
+    def test_legacy_file_with_workers(self):
+        with open(self.encrypted_filename, "wb") as f:
+            for i in range(0, len(self.plaintext), 64):
+                f.write(encrypt(self.password, self.plaintext[i : i + 64]) + b"\n")
+
+        decrypt_file(
+            self.password,
+            self.encrypted_filename,
+            output_file=self.test_filename,
+            workers=2,
+        )
+
+        assert self.test_filename.read_bytes() == self.plaintext
+
+    def test_legacy_file_with_full_size_lines(self):
+        # Written the way encrypt_file used to, a full line per 10 MB
+        plaintext = os.urandom(main.LEGACY_CHUNK_SIZE + 5)
+        with open(self.encrypted_filename, "wb") as f:
+            for i in range(0, len(plaintext), main.LEGACY_CHUNK_SIZE):
+                chunk = plaintext[i : i + main.LEGACY_CHUNK_SIZE]
+                f.write(encrypt(self.password, chunk) + b"\n")
+
+        decrypt_file(
+            self.password, self.encrypted_filename, output_file=self.test_filename
+        )
+
+        assert self.test_filename.read_bytes() == plaintext
+
+    @pytest.mark.parametrize("length", [-1, -10, -200])
+    def test_truncated_binary_file_raises(self, length):
+        encrypt_file(
+            self.password, self.plaintext_filename, output_file=self.encrypted_filename
+        )
+        data = self.encrypted_filename.read_bytes()
+        self.encrypted_filename.write_bytes(data[:length])
+
+        with pytest.raises(LockBoxException):
+            decrypt_file(
+                self.password, self.encrypted_filename, output_file=self.test_filename
+            )
+
+    def test_truncated_armored_file_raises(self):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            armor=True,
+        )
+        lines = self.encrypted_filename.read_bytes().splitlines(keepends=True)
+        self.encrypted_filename.write_bytes(b"".join(lines[:-1]))
+
+        with pytest.raises(LockBoxException):
+            decrypt_file(
+                self.password, self.encrypted_filename, output_file=self.test_filename
+            )
+
+    def test_reordered_frames_raise(self):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            armor=True,
+        )
+        lines = self.encrypted_filename.read_bytes().splitlines(keepends=True)
+        lines[1], lines[2] = lines[2], lines[1]
+        self.encrypted_filename.write_bytes(b"".join(lines))
+
+        with pytest.raises(LockBoxException):
+            decrypt_file(
+                self.password, self.encrypted_filename, output_file=self.test_filename
+            )
+
+
+class TestDecryptRange:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+        mocker.patch("src.lockbox.main.CHUNK_SIZE", 100)
+
+        self.password = b"super secret passphrase"
+        self.plaintext = os.urandom(1050)
+
+        self.plaintext_filename = self.temp_dir / "plaintext_filename"
+        self.encrypted_filename = self.temp_dir / "encrypted_filename"
+        self.plaintext_filename.write_bytes(self.plaintext)
+
+    @pytest.mark.parametrize("index", [True, False])
+    @pytest.mark.parametrize(
+        "offset, length",
+        [
+            (0, 10),
+            (95, 10),
+            (250, 500),
+            (1000, 100),
+            (2000, 10),
+            (-30, 20),
+            (-5000, 50),
+        ],
+    )
+    def test_range(self, index, offset, length):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            index=index,
+        )
+
+        if offset < 0:
+            expected = self.plaintext[offset:][:length]
+        else:
+            expected = self.plaintext[offset : offset + length]
+        actual = decrypt_range(self.password, self.encrypted_filename, offset, length)
+
+        assert expected == actual
+
+    def test_indexed_file_decrypts_sequentially(self):
+        test_filename = self.temp_dir / "test_filename"
+
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            index=True,
+        )
+        decrypt_file(self.password, self.encrypted_filename, output_file=test_filename)
+
+        assert test_filename.read_bytes() == self.plaintext
+
+    def test_only_covering_frames_decrypted(self, mocker):
+        decrypt_frame_spy = mocker.spy(main, "_decrypt_frame")
+
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            index=True,
+        )
+        decrypt_range(self.password, self.encrypted_filename, 450, 100)
+
+        # Only the two frames covering the range
+        assert decrypt_frame_spy.call_count == 2
+
+    def test_index_spanning_many_frames(self, mocker):
+        mocker.patch("src.lockbox.main.CHUNK_SIZE", 16)
+
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            index=True,
+        )
+
+        expected = self.plaintext[-40:]
+        actual = decrypt_range(self.password, self.encrypted_filename, -40, 40)
+
+        assert expected == actual
+
+    @pytest.mark.parametrize("size", [0, 1, 7])
+    def test_range_of_small_indexed_file(self, size):
+        self.plaintext_filename.write_bytes(self.plaintext[:size])
+
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            index=True,
+        )
+
+        actual = decrypt_range(self.password, self.encrypted_filename, 0, 10)
+        assert self.plaintext[:size] == actual
+
+    def test_range_with_chunks_smaller_than_index_entries(self):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            index=True,
+            chunk_size=3,
+        )
+
+        actual = decrypt_range(self.password, self.encrypted_filename, 95, 10)
+        assert self.plaintext[95:105] == actual
+
+    def test_tampered_index_raises(self):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            index=True,
+        )
+        data = bytearray(self.encrypted_filename.read_bytes())
+        data[-1] ^= 1
+        self.encrypted_filename.write_bytes(data)
+
+        with pytest.raises(LockBoxException):
+            decrypt_range(self.password, self.encrypted_filename, 0, 10)
+
+    @pytest.mark.parametrize("size", [0, 4, main._INDEX_TRAILER.size - 1])
+    def test_truncated_index_raises(self, size):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            index=True,
+        )
+        data = self.encrypted_filename.read_bytes()
+        self.encrypted_filename.write_bytes(
+            data[: len(main.MAGIC) + main._HEADER.size + size]
+        )
+
+        with pytest.raises(LockBoxException, match="index is invalid"):
+            decrypt_range(self.password, self.encrypted_filename, 0, 10)
+
+    @pytest.mark.parametrize("position", [0, 2**40])
+    def test_index_position_out_of_file_raises(self, position):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            index=True,
+        )
+        data = bytearray(self.encrypted_filename.read_bytes())
+        _, count = main._INDEX_TRAILER.unpack(data[-main._INDEX_TRAILER.size :])
+        data[-main._INDEX_TRAILER.size :] = main._INDEX_TRAILER.pack(position, count)
+        self.encrypted_filename.write_bytes(data)
+
+        with pytest.raises(LockBoxException, match="index is invalid"):
+            decrypt_range(self.password, self.encrypted_filename, 0, 10)
+
+    def test_armored_index_raises(self):
+        with pytest.raises(LockBoxException):
+            encrypt_file(
+                self.password,
+                self.plaintext_filename,
+                output_file=self.encrypted_filename,
+                armor=True,
+                index=True,
+            )
+
+
+class TestStreamingDecryptMemory:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+        self.chunk_size = 256 * 1024
+        mocker.patch("src.lockbox.main.CHUNK_SIZE", self.chunk_size)
+
+        self.password = b"super secret passphrase"
+
+        self.plaintext_filename = self.temp_dir / "plaintext_filename"
+        self.encrypted_filename = self.temp_dir / "encrypted_filename"
+        self.test_filename = self.temp_dir / "test_filename"
+
+        with open(self.plaintext_filename, "wb") as f:
+            for i in range(4):
+                f.write(os.urandom(ONE_MB))
+
+    @pytest.mark.parametrize("cipher", ["aes-256-gcm", "chacha20-poly1305"])
+    def test_peak_memory_is_bounded_by_chunk_size(self, cipher):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            cipher=cipher,
+        )
+
+        tracemalloc.start()
+        try:
+            decrypt_file(
+                self.password, self.encrypted_filename, output_file=self.test_filename
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        # Without decrypt_into, every frame is decrypted into a new buffer
+        buffers = 2 if hasattr(main.CIPHERS[cipher].factory, "decrypt_into") else 3
+        assert peak < (buffers + 0.5) * self.chunk_size
+        assert _get_hash(self.plaintext_filename) == _get_hash(self.test_filename)
+
+    @pytest.mark.parametrize("mapped", [False, True])
+    @pytest.mark.parametrize("cipher", ["aes-256-gcm", "chacha20-poly1305"])
+    def test_encrypt_peak_memory_is_bounded_by_chunk_size(self, mocker, cipher, mapped):
+        # One buffer for the plaintext, unless the file is mapped, and one for
+        # the ciphertext of a frame, no matter how many frames the file has
+        if mapped:
+            mocker.patch("src.lockbox.main.MMAP_MIN_SIZE", 0)
+        mapped_chunks_spy = mocker.spy(main, "_mapped_chunks")
+
+        # Set up the cipher backend first, so only the file is measured
+        empty_filename = self.temp_dir / "empty_filename"
+        empty_filename.write_bytes(b"")
+        encrypt_file(
+            self.password,
+            empty_filename,
+            output_file=self.encrypted_filename,
+            cipher=cipher,
+        )
+
+        tracemalloc.start()
+        try:
+            encrypt_file(
+                self.password,
+                self.plaintext_filename,
+                output_file=self.encrypted_filename,
+                cipher=cipher,
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        # Without encrypt_into, every frame is encrypted into a new buffer
+        buffers = 2 if hasattr(main.CIPHERS[cipher].factory, "encrypt_into") else 3
+        assert mapped == mapped_chunks_spy.called
+        assert peak < (buffers + 0.5) * self.chunk_size
+        decrypt_file(
+            self.password, self.encrypted_filename, output_file=self.test_filename
+        )
+        assert _get_hash(self.plaintext_filename) == _get_hash(self.test_filename)
+
+    @pytest.mark.parametrize("cipher", ["aes-256-gcm", "chacha20-poly1305"])
+    def test_peak_memory_of_input_smaller_than_chunk(self, cipher):
+        # Buffers follow the data rather than the chunk size, on both sides
+        small_filename = self.temp_dir / "small_filename"
+        small_filename.write_bytes(os.urandom(1000))
+        encrypt_file(
+            self.password,
+            small_filename,
+            output_file=self.encrypted_filename,
+            cipher=cipher,
+        )
+
+        tracemalloc.start()
+        try:
+            encrypt_file(
+                self.password,
+                small_filename,
+                output_file=self.encrypted_filename,
+                cipher=cipher,
+                chunk_size=main.MAX_CHUNK_SIZE,
+            )
+            _, encrypt_peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            decrypt_file(
+                self.password, self.encrypted_filename, output_file=self.test_filename
+            )
+            _, decrypt_peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert encrypt_peak < self.chunk_size / 4
+        assert decrypt_peak < self.chunk_size / 4
+        assert small_filename.read_bytes() == self.test_filename.read_bytes()
+
+    def test_oversized_frame_raises(self):
+        encrypt_file(
+            self.password, self.plaintext_filename, output_file=self.encrypted_filename
+        )
+        data = bytearray(self.encrypted_filename.read_bytes())
+        offset = len(main.MAGIC) + main._HEADER.size
+        data[offset : offset + 4] = (2**32 - 1).to_bytes(4, "big")
+        self.encrypted_filename.write_bytes(data)
+
+        with pytest.raises(LockBoxException):
+            decrypt_file(
+                self.password, self.encrypted_filename, output_file=self.test_filename
+            )
+
+
+class TestPipeline:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+        mocker.patch("src.lockbox.main.CHUNK_SIZE", 1000)
+
+        self.password = b"super secret passphrase"
+        self.plaintext = os.urandom(10500)
+
+        self.plaintext_filename = self.temp_dir / "plaintext_filename"
+        self.encrypted_filename = self.temp_dir / "encrypted_filename"
+        self.test_filename = self.temp_dir / "test_filename"
+        self.plaintext_filename.write_bytes(self.plaintext)
+
+    @pytest.mark.parametrize("encrypt_pipeline", [True, False])
+    @pytest.mark.parametrize("decrypt_pipeline", [True, False])
+    @pytest.mark.parametrize("armor", [True, False])
+    def test_round_trip(self, encrypt_pipeline, decrypt_pipeline, armor):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            armor=armor,
+            pipeline=encrypt_pipeline,
+        )
+        decrypt_file(
+            self.password,
+            self.encrypted_filename,
+            output_file=self.test_filename,
+            pipeline=decrypt_pipeline,
+        )
+
+        assert self.test_filename.read_bytes() == self.plaintext
+
+    @pytest.mark.parametrize("encrypt_workers", [1, 4])
+    @pytest.mark.parametrize("decrypt_workers", [1, 3])
+    @pytest.mark.parametrize("cipher", ["fernet", "aes-256-gcm"])
+    def test_workers(self, encrypt_workers, decrypt_workers, cipher):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            cipher=cipher,
+            workers=encrypt_workers,
+        )
+        decrypt_file(
+            self.password,
+            self.encrypted_filename,
+            output_file=self.test_filename,
+            workers=decrypt_workers,
+        )
+
+        assert self.test_filename.read_bytes() == self.plaintext
+
+    def test_results_stay_in_order(self):
+        def transform(value):
+            # Later items finish first
+            time.sleep(0.001 * (20 - value))
+            return value
+
+        actual = list(main._pipelined(((i,) for i in range(20)), transform, workers=4))
+
+        assert actual == list(range(20))
+
+    def test_indexed(self):
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            index=True,
+            pipeline=True,
+            workers=3,
+        )
+
+        actual = decrypt_range(self.password, self.encrypted_filename, -5, 5)
+        assert self.plaintext[-5:] == actual
+
+    def test_error_stops_all_stages(self):
+        thread_count = threading.active_count()
+
+        encrypt_file(
+            self.password,
+            self.plaintext_filename,
+            output_file=self.encrypted_filename,
+            pipeline=True,
+        )
+        data = bytearray(self.encrypted_filename.read_bytes())
+        data[-1] ^= 1
+        self.encrypted_filename.write_bytes(data)
+
+        with pytest.raises(LockBoxException):
+            decrypt_file(
+                self.password,
+                self.encrypted_filename,
+                output_file=self.test_filename,
+                workers=4,
+            )
+
+        assert threading.active_count() == thread_count
+
+
+class TestParallelDirectory:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_dir):
+        self.temp_dir = temp_dir
+        self.password = b"super secret passphrase"
+
+        self.file_hashes = {}
+        for i in range(6):
+            subdirectory = self.temp_dir / f"dir{i % 3}"
+            subdirectory.mkdir(exist_ok=True)
+
+            file_path = subdirectory / f"file{i}.txt"
+            file_path.write_bytes(f"This is file {i}".encode("utf-8"))
+            self.file_hashes[file_path] = _get_hash(file_path)
+
+        self.link = self.temp_dir / "link.txt"
+        self.link.symlink_to(file_path)
+
+    @pytest.mark.parametrize("pool", ["thread", "process"])
+    def test_round_trip(self, pool):
+        encrypt_directory(self.password, self.temp_dir, workers=3, pool=pool)
+
+        for path in self.file_hashes:
+            assert not path.exists()
+            assert path.with_name(f"{path.name}.lockbox").exists()
+        assert self.link.is_symlink()
+
+        decrypt_directory(self.password, self.temp_dir, workers=3, pool=pool)
+
+        for path, file_hash in self.file_hashes.items():
+            assert file_hash == _get_hash(path)
+            assert not path.with_name(f"{path.name}.lockbox").exists()
+
+    def test_errors_are_collected(self):
+        encrypt_directory(self.password, self.temp_dir, workers=2)
+
+        corrupt_path = self.temp_dir / "dir0" / "file0.txt.lockbox"
+        corrupt_path.write_bytes(b"not encrypted")
+
+        with pytest.raises(LockBoxException, match="1 files could not be processed"):
+            decrypt_directory(self.password, self.temp_dir, workers=2)
+
+        assert corrupt_path.exists()
+        for path, file_hash in self.file_hashes.items():
+            if path.name != "file0.txt":
+                assert file_hash == _get_hash(path)
+
+    def test_unknown_pool_raises(self):
+        with pytest.raises(LockBoxException):
+            encrypt_directory(self.password, self.temp_dir, pool="fibers")
+
+
+class TestScanFiles:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_dir):
+        self.temp_dir = temp_dir
+
+        (self.temp_dir / "a.txt").write_bytes(b"a" * 10)
+        (self.temp_dir / "sub").mkdir()
+        (self.temp_dir / "sub" / "b.txt.lockbox").write_bytes(b"b" * 20)
+        (self.temp_dir / "sub" / "deeper").mkdir()
+        (self.temp_dir / "sub" / "deeper" / "c.txt").write_bytes(b"c" * 30)
+
+        (self.temp_dir / "file_link").symlink_to(self.temp_dir / "a.txt")
+        (self.temp_dir / "dir_link").symlink_to(self.temp_dir / "sub")
+
+    def test_yields_regular_files_with_sizes(self):
+        expected = {
+            self.temp_dir / "a.txt": 10,
+            self.temp_dir / "sub" / "b.txt.lockbox": 20,
+            self.temp_dir / "sub" / "deeper" / "c.txt": 30,
+        }
+        actual = dict(main._scan_files(self.temp_dir))
+
+        assert expected == actual
+
+    def test_select(self):
+        expected = [(self.temp_dir / "sub" / "b.txt.lockbox", 20)]
+        actual = list(main._scan_files(self.temp_dir, main._is_lockbox_entry))
+
+        assert expected == actual
+
+    def test_scan_in_background_largest_first(self, mocker):
+        progress = mocker.MagicMock(total=0)
+
+        with main._scan_in_background(
+            main._scan_files(self.temp_dir), progress
+        ) as found:
+            # Let the walk finish so that every file is queued
+            while found.qsize() < 4:
+                time.sleep(0.01)
+            actual = [found.get()[2] for _ in range(4)]
+
+        assert [
+            self.temp_dir / "sub" / "deeper" / "c.txt",
+            self.temp_dir / "sub" / "b.txt.lockbox",
+            self.temp_dir / "a.txt",
+            None,
+        ] == actual
+        assert 60 == progress.total
+
+    def test_scan_in_background_errors_come_first(self, mocker):
+        def files():
+            yield self.temp_dir / "a.txt", 10
+            raise OSError("disk on fire")
+
+        threads = threading.active_count()
+        with main._scan_in_background(files(), mocker.MagicMock(total=0)) as found:
+            error = found.get()[2]
+
+        assert isinstance(error, OSError)
+        assert threads == threading.active_count()
+
+    def test_scan_in_background_stays_ahead_by_a_bounded_amount(self, mocker):
+        mocker.patch("src.lockbox.main.SCAN_AHEAD", 2)
+        files = ((self.temp_dir / f"file{i}.txt", i) for i in range(100))
+
+        threads = threading.active_count()
+        with main._scan_in_background(files, mocker.MagicMock(total=0)) as found:
+            time.sleep(0.1)
+            assert 2 == found.qsize()
+
+        assert threads == threading.active_count()
+
+
+class TestDirectoryScheduling:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+        mocker.patch("src.lockbox.main.CHUNK_SIZE", 16)
+        mocker.patch("src.lockbox.main.SMALL_FILE_SIZE", 8)
+        mocker.patch("src.lockbox.main.BATCH_FILES", 3)
+        mocker.patch("src.lockbox.main.HASH_ITERATIONS", 1000)
+        self.password = b"super secret passphrase"
+
+        self.file_hashes = {}
+        for i, size in enumerate([200, 129, 40, 5, 0, 7, 3, 1]):
+            file_path = self.temp_dir / f"file{i}.txt"
+            file_path.write_bytes(os.urandom(size))
+            self.file_hashes[file_path] = _get_hash(file_path)
+
+    @pytest.mark.parametrize("cipher", list(main.CIPHERS))
+    def test_frame_length(self, cipher):
+        cipher = main.CIPHERS[cipher]
+        stream_cipher = cipher.factory(bytes(main.KEY_LENGTH))
+        nonce = main._FRAME_NONCE.pack(0, True, False)
+
+        for length in (0, 1, 15, 16, 17, 100):
+            expected = len(stream_cipher.encrypt(nonce, bytes(length), b"header"))
+            actual = main._frame_length(cipher, length)
+
+            assert expected == actual
+
+    @pytest.mark.parametrize("cipher", list(main.CIPHERS))
+    def test_split_round_trip(self, mocker, cipher):
+        encrypt_range_spy = mocker.spy(main, "_encrypt_range")
+        decrypt_range_spy = mocker.spy(main, "_decrypt_frames_at")
+
+        encrypt_directory(self.password, self.temp_dir, cipher=cipher, workers=3)
+
+        # 200 and 129 byte files are split into ranges of 4 frames
+        assert 4 + 3 == encrypt_range_spy.call_count
+        encrypted = self.temp_dir / "file0.txt.lockbox"
+        decrypt_file(self.password, encrypted, output_file=self.temp_dir / "check")
+        assert self.file_hashes[self.temp_dir / "file0.txt"] == _get_hash(
+            self.temp_dir / "check"
+        )
+        (self.temp_dir / "check").unlink()
+
+        decrypt_directory(self.password, self.temp_dir, workers=3)
+
+        assert 4 + 3 == decrypt_range_spy.call_count
+        for path, file_hash in self.file_hashes.items():
+            assert file_hash == _get_hash(path)
+            assert not path.with_name(f"{path.name}.lockbox").exists()
+
+    def test_split_indexed_file(self, mocker):
+        decrypt_range_spy = mocker.spy(main, "_decrypt_frames_at")
+        path = self.temp_dir / "file0.txt"
+        encrypt_file(
+            self.password,
+            path,
+            output_file=path.with_suffix(".txt.lockbox"),
+            remove_original=True,
+            index=True,
+        )
+
+        decrypt_directory(self.password, self.temp_dir, workers=2)
+
+        assert 4 == decrypt_range_spy.call_count
+        assert self.file_hashes[path] == _get_hash(path)
+
+    def test_split_runs_on_workers(self, mocker):
+        split_encrypt = main._split_encrypt
+        split_threads = []
+
+        def split(*args, **kwargs):
+            split_threads.append(threading.current_thread())
+            return split_encrypt(*args, **kwargs)
+
+        mocker.patch("src.lockbox.main._split_encrypt", split)
+
+        encrypt_directory(self.password, self.temp_dir, workers=3)
+
+        # Every file that is not batched, even the 40 byte one that is not split
+        assert 3 == len(split_threads)
+        assert threading.main_thread() not in split_threads
+        for path in self.file_hashes:
+            assert path.with_name(f"{path.name}.lockbox").exists()
+
+    def test_not_split_with_one_worker(self, mocker):
+        encrypt_range_spy = mocker.spy(main, "_encrypt_range")
+
+        encrypt_directory(self.password, self.temp_dir)
+
+        assert not encrypt_range_spy.called
+
+    def test_small_files_are_batched(self, mocker):
+        batch_spy = mocker.spy(main, "_process_batch")
+
+        encrypt_directory(self.password, self.temp_dir, workers=2)
+
+        batches = sorted(len(call.args[1]) for call in batch_spy.call_args_list)
+        assert [2, 3] == batches
+        for path in self.file_hashes:
+            assert path.with_name(f"{path.name}.lockbox").exists()
+
+    def test_failed_split_file_is_cleaned_up(self):
+        encrypt_directory(self.password, self.temp_dir, workers=2)
+
+        encrypted = self.temp_dir / "file0.txt.lockbox"
+        data = bytearray(encrypted.read_bytes())
+        data[-10] ^= 1
+        encrypted.write_bytes(data)
+
+        with pytest.raises(LockBoxException, match="1 files could not be processed"):
+            decrypt_directory(self.password, self.temp_dir, workers=2)
+
+        assert encrypted.exists()
+        assert not (self.temp_dir / "file0.txt").exists()
+        for path, file_hash in self.file_hashes.items():
+            if path.name != "file0.txt":
+                assert file_hash == _get_hash(path)
+
+
+class TestArchive:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+        mocker.patch("src.lockbox.main.CHUNK_SIZE", 16)
+        self.derive_key_spy = mocker.spy(main, "_derive_key")
+        self.password = b"super secret passphrase"
+
+        self.source = self.temp_dir / "source"
+        self.archive = self.temp_dir / "source.lockbox"
+        self.destination = self.temp_dir / "destination"
+
+        self.files = {
+            "empty.txt": b"",
+            "small.txt": b"small",
+            "nested/deeper/large.bin": os.urandom(100),
+            "nested/exact.bin": os.urandom(32),
+        }
+        for name, data in self.files.items():
+            path = self.source / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+
+        os.chmod(self.source / "small.txt", 0o600)
+        os.utime(self.source / "small.txt", ns=(1_000_000_000, 1_000_000_000))
+
+    def test_round_trip(self):
+        pack_directory(self.password, self.source, self.archive)
+
+        assert 1 == self.derive_key_spy.call_count
+        assert not any(
+            name.encode() in self.archive.read_bytes() for name in self.files
+        )
+
+        unpack_archive(self.password, self.archive, self.destination)
+
+        assert 2 == self.derive_key_spy.call_count
+        for name, data in self.files.items():
+            assert data == (self.destination / name).read_bytes()
+
+        stat = (self.destination / "small.txt").stat()
+        assert 0o600 == stat.st_mode & 0o777
+        assert 1_000_000_000 == stat.st_mtime_ns
+
+    def test_symlinks_are_skipped(self):
+        (self.source / "link").symlink_to(self.source / "small.txt")
+
+        pack_directory(self.password, self.source, self.archive)
+        unpack_archive(self.password, self.archive, self.destination)
+
+        assert not (self.destination / "link").exists()
+
+    def test_archive_inside_directory_raises(self):
+        archive = self.source / "nested" / "source.lockbox"
+
+        with pytest.raises(LockBoxException, match="can not be inside"):
+            pack_directory(self.password, self.source, archive)
+
+        assert not archive.exists()
+
+    def test_bad_password(self):
+        pack_directory(self.password, self.source, self.archive)
+
+        with pytest.raises(LockBoxException):
+            unpack_archive(b"wrong passphrase", self.archive, self.destination)
+
+    def test_truncated_archive(self):
+        pack_directory(self.password, self.source, self.archive)
+        data = self.archive.read_bytes()
+        self.archive.write_bytes(data[: len(data) // 2])
+
+        with pytest.raises(LockBoxException):
+            unpack_archive(self.password, self.archive, self.destination)
+
+    def test_not_an_archive(self):
+        encrypted = self.temp_dir / "small.txt.lockbox"
+        encrypt_file(self.password, self.source / "small.txt", output_file=encrypted)
+
+        with pytest.raises(LockBoxException, match="not a lockbox archive"):
+            unpack_archive(self.password, encrypted, self.destination)
+
+    def test_decrypting_archive_raises(self):
+        pack_directory(self.password, self.source, self.archive)
+        output = self.temp_dir / "source"
+
+        with pytest.raises(LockBoxException, match="use lockbox unpack"):
+            decrypt_file(self.password, self.archive, output_file=output)
+        with pytest.raises(LockBoxException, match="use lockbox unpack"):
+            decrypt_range(self.password, self.archive, 0, 10)
+        with open(self.archive, "rb") as infile:
+            with pytest.raises(LockBoxException, match="use lockbox unpack"):
+                decrypt_stream(self.password, infile, io.BytesIO())
+
+        assert self.source.is_dir()
+        assert self.archive.exists()
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_decrypt_directory_leaves_archives(self, mocker, workers):
+        mocker.patch("src.lockbox.main.SMALL_FILE_SIZE", 8)
+        mocker.patch("src.lockbox.main.SPLIT_FRAMES", 2)
+        directory = self.temp_dir / "encrypted"
+        directory.mkdir()
+        archive = directory / "packed.lockbox"
+        pack_directory(self.password, self.source, archive)
+        archived = archive.read_bytes()
+        (directory / "plain.txt").write_bytes(b"plain")
+        encrypt_file(
+            self.password,
+            directory / "plain.txt",
+            output_file=directory / "plain.txt.lockbox",
+            remove_original=True,
+        )
+
+        with pytest.raises(LockBoxException, match="packed.lockbox: .*unpack"):
+            decrypt_directory(self.password, directory, workers=workers)
+
+        assert archived == archive.read_bytes()
+        assert not (directory / "packed").exists()
+        assert b"plain" == (directory / "plain.txt").read_bytes()
+
+    @pytest.mark.parametrize("name", [b"../escape", b"/etc/passwd", b"a/../../b", b""])
+    def test_unsafe_member_paths(self, name):
+        with pytest.raises(LockBoxException):
+            main._member_path(self.destination, name)
+
+    @pytest.mark.parametrize("members", [None, ["small.txt"]])
+    def test_symlink_at_member_path_raises(self, members):
+        outside = self.temp_dir / "outside.txt"
+        outside.write_bytes(b"outside")
+        self.destination.mkdir()
+        (self.destination / "small.txt").symlink_to(outside)
+        pack_directory(self.password, self.source, self.archive)
+
+        with pytest.raises(LockBoxException, match="symbolic link"):
+            unpack_archive(
+                self.password, self.archive, self.destination, members=members
+            )
+
+        assert b"outside" == outside.read_bytes()
+
+    def test_symlinked_parent_outside_raises(self):
+        outside = self.temp_dir / "outside"
+        outside.mkdir()
+        self.destination.mkdir()
+        (self.destination / "nested").symlink_to(outside)
+        pack_directory(self.password, self.source, self.archive)
+
+        with pytest.raises(LockBoxException, match="outside of"):
+            unpack_archive(
+                self.password,
+                self.archive,
+                self.destination,
+                members=["nested/deeper/large.bin"],
+            )
+
+        assert not any(outside.iterdir())
+
+    def test_symlinked_parent_inside_is_followed(self):
+        self.destination.mkdir()
+        (self.destination / "elsewhere").mkdir()
+        (self.destination / "nested").symlink_to(self.destination / "elsewhere")
+        pack_directory(self.password, self.source, self.archive)
+
+        unpack_archive(self.password, self.archive, self.destination)
+
+        assert (
+            self.files["nested/exact.bin"]
+            == (self.destination / "elsewhere" / "exact.bin").read_bytes()
+        )
+
+    def test_existing_files_are_replaced_not_written_through(self):
+        outside = self.temp_dir / "outside.txt"
+        outside.write_bytes(b"outside")
+        self.destination.mkdir()
+        os.link(outside, self.destination / "small.txt")
+        pack_directory(self.password, self.source, self.archive)
+
+        unpack_archive(self.password, self.archive, self.destination)
+
+        assert b"small" == (self.destination / "small.txt").read_bytes()
+        assert b"outside" == outside.read_bytes()
+
+    def test_directory_at_member_path_raises(self):
+        (self.destination / "small.txt").mkdir(parents=True)
+        pack_directory(self.password, self.source, self.archive)
+
+        with pytest.raises(LockBoxException, match="Could not write small.txt"):
+            unpack_archive(self.password, self.archive, self.destination)
+
+    @pytest.mark.parametrize(
+        "preserve_mode, expected", [(False, 0o755), (True, 0o4755)]
+    )
+    def test_special_mode_bits(self, preserve_mode, expected):
+        os.chmod(self.source / "small.txt", 0o4755)
+        pack_directory(self.password, self.source, self.archive)
+
+        unpack_archive(
+            self.password,
+            self.archive,
+            self.destination,
+            preserve_mode=preserve_mode,
+        )
+
+        mode = (self.destination / "small.txt").stat().st_mode
+        assert expected == mode & 0o7777
+
+    def test_unpack_member(self, mocker):
+        pack_directory(self.password, self.source, self.archive)
+        decrypt_frame_spy = mocker.spy(main, "_decrypt_frame")
+
+        unpack_archive(
+            self.password,
+            self.archive,
+            self.destination,
+            members=["nested/exact.bin"],
+        )
+
+        assert (
+            self.files["nested/exact.bin"]
+            == (self.destination / "nested" / "exact.bin").read_bytes()
+        )
+        assert ["nested/exact.bin"] == [
+            path.relative_to(self.destination).as_posix()
+            for path in self.destination.rglob("*")
+            if path.is_file()
+        ]
+        with open(self.archive, "rb") as infile:
+            main._read_header(infile)
+            frame_count = len(main._scan_frames(infile))
+        # Only the trailer, member table and member are decrypted
+        assert decrypt_frame_spy.call_count < frame_count * 2 / 3
+        assert 2 == self.derive_key_spy.call_count
+
+    def test_unpack_missing_member(self):
+        pack_directory(self.password, self.source, self.archive)
+
+        with pytest.raises(LockBoxException, match="missing.txt"):
+            unpack_archive(
+                self.password,
+                self.archive,
+                self.destination,
+                members=["small.txt", "missing.txt"],
+            )
+
+        assert not self.destination.exists()
+
+
+class TestMirrorDirectory:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+        mocker.patch("src.lockbox.main.HASH_ITERATIONS", 1000)
+        self.encrypt_file_spy = mocker.spy(main, "encrypt_file")
+        self.password = b"super secret passphrase"
+
+        self.source = self.temp_dir / "source"
+        self.mirror = self.temp_dir / "mirror"
+        self.files = {
+            "a.txt": b"first file",
+            "nested/b.txt": b"second file",
+            "nested/deeper/c.txt": b"third file",
+        }
+        for name, data in self.files.items():
+            path = self.source / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+
+    def _decrypted(self, name):
+        output_file = self.temp_dir / "check"
+        decrypt_file(
+            self.password,
+            self.mirror / f"{name}.lockbox",
+            output_file=output_file,
+        )
+        return output_file.read_bytes()
+
+    def test_mirror(self):
+        encrypt_directory(self.password, self.source, output_directory=self.mirror)
+
+        for name, data in self.files.items():
+            assert data == (self.source / name).read_bytes()
+            assert data == self._decrypted(name)
+        assert not (self.mirror / main.STATE_FILE).exists()
+
+    def test_unchanged_files_are_skipped(self):
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+        assert 3 == self.encrypt_file_spy.call_count
+
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+        assert 3 == self.encrypt_file_spy.call_count
+
+    def test_changed_files_are_encrypted(self):
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+        (self.source / "nested" / "b.txt").write_bytes(b"changed file")
+        (self.source / "new.txt").write_bytes(b"new file")
+
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+
+        assert 5 == self.encrypt_file_spy.call_count
+        assert b"changed file" == self._decrypted("nested/b.txt")
+        assert b"new file" == self._decrypted("new.txt")
+
+    def test_touched_files_are_hashed_not_encrypted(self, mocker):
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+        os.utime(self.source / "a.txt", ns=(1_000_000_000, 1_000_000_000))
+        hash_spy = mocker.spy(main, "_hash_contents")
+
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+
+        assert 3 == self.encrypt_file_spy.call_count
+        assert 1 == hash_spy.call_count
+
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+        assert 1 == hash_spy.call_count
+
+    def test_removed_files_are_pruned(self):
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+        (self.source / "a.txt").unlink()
+
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+
+        assert not (self.mirror / "a.txt.lockbox").exists()
+        assert (self.mirror / "nested" / "b.txt.lockbox").exists()
+
+    def test_unreadable_directories_are_not_pruned(self, mocker):
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+        scandir = os.scandir
+        unreadable = os.fspath(self.source / "nested")
+
+        def flaky_scandir(path):
+            if path == unreadable:
+                raise PermissionError(path)
+            return scandir(path)
+
+        mocker.patch("src.lockbox.main.os.scandir", flaky_scandir)
+        (self.source / "a.txt").unlink()
+
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+
+        assert not (self.mirror / "a.txt.lockbox").exists()
+        assert b"second file" == self._decrypted("nested/b.txt")
+        assert b"third file" == self._decrypted("nested/deeper/c.txt")
+
+        # Once the directory can be read again, nothing is encrypted again
+        mocker.patch("src.lockbox.main.os.scandir", scandir)
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+        assert 3 == self.encrypt_file_spy.call_count
+
+    def test_different_password_raises(self):
+        encrypt_directory(
+            self.password, self.source, output_directory=self.mirror, incremental=True
+        )
+        (self.source / "a.txt").write_bytes(b"changed file")
+
+        with pytest.raises(LockBoxException, match="Passphrase does not match"):
+            encrypt_directory(
+                b"other passphrase",
+                self.source,
+                output_directory=self.mirror,
+                incremental=True,
+            )
+
+        assert b"first file" == self._decrypted("a.txt")
+
+    def test_incremental_needs_output_directory(self):
+        with pytest.raises(LockBoxException):
+            encrypt_directory(self.password, self.source, incremental=True)
+
+    def test_output_inside_input_raises(self):
+        with pytest.raises(LockBoxException):
+            encrypt_directory(
+                self.password, self.source, output_directory=self.source / "mirror"
+            )
+
+
+class TestResumableDirectory:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+        mocker.patch("src.lockbox.main.HASH_ITERATIONS", 1000)
+        self.password = b"super secret passphrase"
+        self.journal = self.temp_dir / main.JOURNAL_FILE
+
+        self.files = {
+            "a.txt": b"first file",
+            "b.txt": b"second file",
+            "nested/c.txt": b"third file",
+        }
+        for name, data in self.files.items():
+            path = self.temp_dir / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+
+    def _interrupt_on(self, mocker, name):
+        encrypt_path = main._encrypt_path
+
+        def interrupted(password, path, cipher, **kwargs):
+            if path.name == name:
+                raise KeyboardInterrupt
+            return encrypt_path(password, path, cipher, **kwargs)
+
+        return mocker.patch.object(main, "_encrypt_path", side_effect=interrupted)
+
+    def _assert_encrypted_once(self):
+        for name, data in self.files.items():
+            path = self.temp_dir / name
+            assert not path.exists()
+            assert not path.with_name(f"{path.name}.lockbox.lockbox").exists()
+
+            decrypt_file(
+                self.password,
+                path.with_name(f"{path.name}.lockbox"),
+                output_file=self.temp_dir / "check",
+            )
+            assert data == (self.temp_dir / "check").read_bytes()
+
+    def test_resume_after_interruption(self, mocker):
+        mock_encrypt_path = self._interrupt_on(mocker, "c.txt")
+
+        with pytest.raises(KeyboardInterrupt):
+            encrypt_directory(self.password, self.temp_dir)
+
+        assert self.journal.exists()
+        assert (self.temp_dir / "nested" / "c.txt").exists()
+        mocker.stop(mock_encrypt_path)
+
+        with pytest.raises(LockBoxException, match="interrupted run"):
+            encrypt_directory(self.password, self.temp_dir)
+
+        encrypt_directory(self.password, self.temp_dir, resume=True)
+
+        assert not self.journal.exists()
+        self._assert_encrypted_once()
+
+    def test_resume_cleans_up_partial_outputs(self):
+        # Interrupted after a.txt was committed and removed but before it was
+        # recorded as done, and while b.txt was being written
+        encrypt_file(
+            self.password,
+            self.temp_dir / "a.txt",
+            output_file=self.temp_dir / "a.txt.lockbox",
+            remove_original=True,
+        )
+        partial = self.temp_dir / f"b.txt.lockbox{main.PARTIAL_SUFFIX}"
+        partial.write_bytes(b"half written")
+        self.journal.write_text(
+            '{"operation": "encrypt"}\n["start", "a.txt"]\n["start", "b.txt"]\n["do'
+        )
+
+        encrypt_directory(self.password, self.temp_dir, resume=True)
+
+        assert not partial.exists()
+        assert not self.journal.exists()
+        self._assert_encrypted_once()
+
+    def test_resume_skips_outputs_of_finished_files(self):
+        encrypt_file(
+            self.password,
+            self.temp_dir / "a.txt",
+            output_file=self.temp_dir / "a.txt.lockbox",
+            remove_original=True,
+        )
+        self.journal.write_text(
+            '{"operation": "encrypt"}\n["start", "a.txt"]\n["done", "a.txt"]\n'
+        )
+
+        encrypt_directory(self.password, self.temp_dir, resume=True)
+
+        self._assert_encrypted_once()
+
+    def test_resume_other_operation_raises(self):
+        self.journal.write_text('{"operation": "encrypt"}\n')
+
+        with pytest.raises(LockBoxException, match="not written by"):
+            decrypt_directory(self.password, self.temp_dir, resume=True)
+
+    def test_failed_files_are_retried_on_resume(self):
+        encrypt_directory(self.password, self.temp_dir)
+        corrupt = self.temp_dir / "b.txt.lockbox"
+        data = corrupt.read_bytes()
+        corrupt.write_bytes(b"not encrypted")
+
+        with pytest.raises(LockBoxException, match="1 files could not be processed"):
+            decrypt_directory(self.password, self.temp_dir)
+
+        assert self.journal.exists()
+        assert not (self.temp_dir / f"b.txt{main.PARTIAL_SUFFIX}").exists()
+        corrupt.write_bytes(data)
+
+        decrypt_directory(self.password, self.temp_dir, resume=True)
+
+        assert not self.journal.exists()
+        for name, data in self.files.items():
+            assert data == (self.temp_dir / name).read_bytes()
+
+
+class TestAgent:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+        mocker.patch("src.lockbox.main.HASH_ITERATIONS", 1000)
+        self.password = b"super secret passphrase"
+        self.socket_path = self.temp_dir / "agent" / "agent.sock"
+
+        self.agent = self._start(ttl=60)
+        self.client = AgentClient(self.socket_path)
+
+    def _start(self, **kwargs):
+        agent = Agent(self.password, path=self.socket_path, **kwargs)
+        thread = threading.Thread(target=agent.run, daemon=True)
+        thread.start()
+        self.threads = [thread]
+        return agent
+
+    @pytest.fixture(autouse=True)
+    def tearDown(self):
+        yield
+        self.agent.shutdown()
+        for thread in self.threads:
+            thread.join()
+
+    def test_socket_is_private(self):
+        assert 0o600 == self.socket_path.stat().st_mode & 0o777
+        assert 0o700 == self.socket_path.parent.stat().st_mode & 0o777
+
+    def test_files_round_trip_with_the_passphrase(self):
+        plain_file = self.temp_dir / "plain"
+        plain_file.write_bytes(b"agent data" * 100)
+
+        encrypt_file(self.client, plain_file, output_file=self.temp_dir / "enc")
+        decrypt_file(
+            self.password, self.temp_dir / "enc", output_file=self.temp_dir / "dec"
+        )
+        assert plain_file.read_bytes() == (self.temp_dir / "dec").read_bytes()
+
+        encrypt_file(self.password, plain_file, output_file=self.temp_dir / "enc2")
+        decrypt_file(
+            self.client, self.temp_dir / "enc2", output_file=self.temp_dir / "dec2"
+        )
+        assert plain_file.read_bytes() == (self.temp_dir / "dec2").read_bytes()
+
+    def test_strings_round_trip_with_the_passphrase(self):
+        assert b"secret" == decrypt(self.password, encrypt(self.client, b"secret"))
+        assert b"secret" == decrypt(self.client, encrypt(self.password, b"secret"))
+
+    def test_key_derived_once_for_many_files(self, mocker):
+        derive_key_spy = mocker.spy(main, "_pbkdf2")
+        for name in ("a", "b", "c"):
+            plain_file = self.temp_dir / name
+            plain_file.write_bytes(name.encode("utf-8"))
+            encrypted_file = self.temp_dir / f"{name}.lockbox"
+            encrypt_file(self.client, plain_file, output_file=encrypted_file)
+            decrypt_file(self.client, encrypted_file, output_file=plain_file)
+
+        assert 1 == derive_key_spy.call_count
+        assert 1 == self.client.ping()["keys"]
+
+    def test_wrong_passphrase(self):
+        plain_file = self.temp_dir / "plain"
+        plain_file.write_bytes(b"agent data")
+        encrypted_file = self.temp_dir / "plain.lockbox"
+        encrypt_file(b"another passphrase", plain_file, output_file=encrypted_file)
+
+        with pytest.raises(LockBoxException):
+            decrypt_file(self.client, encrypted_file, output_file=plain_file)
+
+    def test_evicts_least_recently_used_keys(self):
+        self.agent.keys.maxsize = 2
+        for salt in (b"1" * 16, b"2" * 16, b"1" * 16, b"3" * 16, b"1" * 16):
+            self.client.derive_key(salt, 1000)
+        assert 2 == self.agent.keys.hits
+        assert 3 == self.agent.keys.misses
+
+        self.client.derive_key(b"2" * 16, 1000)
+        assert 4 == self.agent.keys.misses
+
+    def test_keys_expire(self):
+        self.agent.shutdown()
+        self.threads[0].join()
+        self.agent = self._start(ttl=60, key_ttl=0.1)
+
+        self.client.derive_key(b"1" * 16, 1000)
+        assert 1 == self.client.ping()["keys"]
+
+        deadline = time.monotonic() + 5
+        while self.client.ping()["keys"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert 0 == self.client.ping()["keys"]
+
+        self.client.derive_key(b"1" * 16, 1000)
+        assert 2 == self.agent.keys.misses
+
+    def test_rejects_invalid_requests(self):
+        with pytest.raises(LockBoxException):
+            self.client.derive_key(b"1" * 16, agent.MAX_ITERATIONS + 1)
+        with pytest.raises(LockBoxException):
+            self.client._request(op="unknown")
+
+    def test_exits_after_ttl(self):
+        self.agent.shutdown()
+        self.threads[0].join()
+        self.agent = self._start(ttl=0.1)
+        self.threads[0].join(timeout=5)
+
+        assert not self.socket_path.exists()
+        assert connect_agent(self.socket_path) is None
+        with pytest.raises(LockBoxException):
+            encrypt(self.client, b"secret")
+
+    def test_stop(self):
+        self.client.stop()
+        self.threads[0].join(timeout=5)
+
+        assert not self.threads[0].is_alive()
+        assert not self.socket_path.exists()
+
+    def test_refuses_to_replace_running_agent(self):
+        with pytest.raises(LockBoxException):
+            Agent(self.password, path=self.socket_path)
+
+    def test_connect_agent_from_environment(self, monkeypatch):
+        monkeypatch.delenv("LOCKBOX_AGENT_SOCK", raising=False)
+        assert connect_agent() is None
+
+        monkeypatch.setenv("LOCKBOX_AGENT_SOCK", str(self.socket_path))
+        assert self.socket_path == connect_agent().path
+
+        monkeypatch.setenv("LOCKBOX_AGENT_SOCK", str(self.temp_dir / "missing"))
+        assert connect_agent() is None
+
+
+class TestKeyCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+        mocker.patch("src.lockbox.main.HASH_ITERATIONS", 1000)
+        self.pbkdf2_spy = mocker.spy(main, "_pbkdf2")
+        self.password = b"super secret passphrase"
+
+        self.cache = enable_key_cache()
+        yield
+        disable_key_cache()
+
+    def test_disabled_by_default(self):
+        disable_key_cache()
+        token = encrypt(self.password, b"secret")
+        decrypt(self.password, token)
+        decrypt(self.password, token)
+
+        assert 3 == self.pbkdf2_spy.call_count
+
+    def test_repeated_decrypt(self):
+        token = encrypt(self.password, b"secret")
+        self.cache.clear()
+
+        for _ in range(5):
+            assert b"secret" == decrypt(self.password, token)
+
+        assert 2 == self.pbkdf2_spy.call_count
+        assert 4 == self.cache.hits
+        assert 2 == self.cache.misses
+
+    def test_repeated_decrypt_file(self):
+        plain_file = self.temp_dir / "plain"
+        plain_file.write_bytes(b"cached" * 100)
+        encrypted_file = self.temp_dir / "plain.lockbox"
+        encrypt_file(self.password, plain_file, output_file=encrypted_file)
+
+        for _ in range(3):
+            decrypt_file(self.password, encrypted_file, output_file=plain_file)
+            assert b"cached" * 100 == plain_file.read_bytes()
+
+        assert 1 == self.pbkdf2_spy.call_count
+
+    def test_other_passphrase_is_not_served_from_cache(self):
+        token = encrypt(self.password, b"secret")
+
+        with pytest.raises(LockBoxException):
+            decrypt(b"another passphrase", token)
+        assert 2 == self.pbkdf2_spy.call_count
+
+    def test_passphrase_is_not_kept(self):
+        encrypt(self.password, b"secret")
+
+        for key in self.cache._entries:
+            assert self.password not in key
+
+    def test_expired_entries_are_derived_again(self):
+        self.cache.ttl = 0.05
+        token = encrypt(self.password, b"secret")
+        time.sleep(0.1)
+        decrypt(self.password, token)
+
+        assert 2 == self.pbkdf2_spy.call_count
+        assert 1 == len(self.cache)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.maxsize = 2
+        tokens = [encrypt(self.password, data) for data in (b"a", b"b", b"c")]
+
+        assert 2 == len(self.cache)
+        decrypt(self.password, tokens[2])
+        decrypt(self.password, tokens[0])
+        assert 4 == self.pbkdf2_spy.call_count
+
+    def test_clear(self):
+        token = encrypt(self.password, b"secret")
+        self.cache.clear()
+        decrypt(self.password, token)
+
+        assert 0 == self.cache.hits
+        assert 2 == self.pbkdf2_spy.call_count
+
+
+class TestBatch:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("src.lockbox.main.HASH_ITERATIONS", 1000)
+        self.pbkdf2_spy = mocker.spy(main, "_pbkdf2")
+        self.password = b"super secret passphrase"
+        self.values = [f"value {i}".encode("utf-8") * (i % 7) for i in range(500)]
+
+    def test_round_trip_with_one_key_derivation(self):
+        tokens = list(encrypt_many(self.password, self.values))
+        assert 1 == self.pbkdf2_spy.call_count
+
+        assert self.values == list(decrypt_many(self.password, tokens))
+        assert 2 == self.pbkdf2_spy.call_count
+
+    @pytest.mark.parametrize("cipher", ["fernet", "aes-256-gcm", "chacha20-poly1305"])
+    def test_ciphers(self, cipher):
+        tokens = encrypt_many(self.password, self.values, cipher=cipher)
+
+        assert self.values == list(decrypt_many(self.password, tokens))
+
+    def test_results_are_streamed(self):
+        tokens = encrypt_many(self.password, iter(self.values))
+        values = decrypt_many(self.password, tokens)
+
+        assert self.values[:3] == [next(values) for _ in range(3)]
+
+    def test_tokens_decrypt_independently(self):
+        tokens = list(encrypt_many("super secret passphrase", ["a", "b", "c"]))
+        other_tokens = list(encrypt_many(self.password, [b"d", b"e"]))
+
+        mixed = [other_tokens[1], tokens[2], tokens[0].decode("utf-8"), other_tokens[0]]
+        assert [b"e", b"c", b"a", b"d"] == list(decrypt_many(self.password, mixed))
+
+    def test_tokens_are_compact(self):
+        (token,) = encrypt_many(self.password, [b"x" * 100], cipher="aes-256-gcm")
+        legacy_token = encrypt(self.password, b"x" * 100)
+
+        assert len(token) < len(legacy_token)
+
+    @pytest.mark.parametrize(
+        "tamper",
+        [
+            lambda data: data[:-1] + bytes([data[-1] ^ 1]),
+            lambda data: data[:-20],
+            lambda data: data[:43] + (7).to_bytes(4, "big") + data[47:],
+            lambda data: data[:10],
+        ],
+    )
+    def test_tampered_token(self, tamper):
+        (token,) = encrypt_many(self.password, [b"secret value"])
+        data = tamper(base64.urlsafe_b64decode(token))
+
+        with pytest.raises(LockBoxException):
+            list(decrypt_many(self.password, [base64.urlsafe_b64encode(data)]))
+
+    def test_wrong_passphrase(self):
+        tokens = encrypt_many(self.password, [b"secret value"])
+
+        with pytest.raises(LockBoxException):
+            list(decrypt_many(b"another passphrase", tokens))
+
+    def test_not_a_batch_token(self):
+        with pytest.raises(LockBoxException):
+            list(decrypt_many(self.password, [encrypt(self.password, b"value")]))
+
+
+class TestVault:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+        mocker.patch("src.lockbox.main.HASH_ITERATIONS", 1000)
+        self.pbkdf2_spy = mocker.spy(main, "_pbkdf2")
+        self.password = b"super secret passphrase"
+        self.path = self.temp_dir / "secrets.vault"
+
+        self.secrets = {f"SECRET_{i}": f"value {i}".encode("utf-8") for i in range(50)}
+        with Vault(self.password, self.path) as vault:
+            for name, value in self.secrets.items():
+                vault.set(name, value)
+
+    def _rows(self):
+        with sqlite3.connect(self.path) as db:
+            return dict(
+                (lookup, (frame, data))
+                for lookup, frame, data in db.execute("SELECT * FROM entries")
+            )
+
+    def test_get_decrypts_one_entry(self, mocker):
+        with Vault(self.password, self.path) as vault:
+            decrypt_spy = mocker.spy(vault, "_decrypt")
+
+            assert b"value 7" == vault.get("SECRET_7")
+            assert b"value 42" == vault.get("SECRET_42")
+
+        assert 2 == decrypt_spy.call_count
+        assert 2 == self.pbkdf2_spy.call_count
+
+    def test_names(self):
+        with Vault(self.password, self.path) as vault:
+            assert sorted(self.secrets) == vault.names()
+
+    def test_set_rewrites_one_entry(self):
+        before = self._rows()
+        with Vault(self.password, self.path) as vault:
+            vault.set("SECRET_3", "new value")
+            assert b"new value" == vault.get("SECRET_3")
+
+        after = self._rows()
+        changed = [lookup for lookup in before if before[lookup] != after[lookup]]
+        assert 1 == len(changed)
+        assert before.keys() == after.keys()
+        # Every entry is encrypted under a nonce of its own
+        nonces = {data[: main._FRAME_NONCE.size] for _, data in after.values()}
+        assert len(self.secrets) == len(nonces)
+
+    def test_copies_do_not_reuse_nonces(self):
+        copy = self.temp_dir / "copy.vault"
+        copy.write_bytes(self.path.read_bytes())
+
+        for path in (self.path, copy):
+            with Vault(self.password, path) as vault:
+                vault.set("NEW", "same value")
+
+        nonces = set()
+        for path in (self.path, copy):
+            with sqlite3.connect(path) as db:
+                for (data,) in db.execute("SELECT data FROM entries"):
+                    nonces.add(data[: main._FRAME_NONCE.size])
+        # The entries written to each copy got nonces of their own
+        assert len(self.secrets) + 2 == len(nonces)
+
+    def test_legacy_frame_rows(self):
+        # Rows used to be encrypted under a nonce made from a frame index
+        with Vault(self.password, self.path) as vault:
+            entry = main._VAULT_NAME.pack(6) + b"LEGACY" + b"old value"
+            lookup = vault._lookup("LEGACY")
+            data = vault._cipher.encrypt(
+                main._FRAME_NONCE.pack(1000, False, False),
+                entry,
+                vault._header + lookup,
+            )
+            vault._db.execute(
+                "INSERT INTO entries VALUES (?, ?, ?)", (lookup, 1000, data)
+            )
+
+            assert b"old value" == vault.get("LEGACY")
+
+    def test_names_are_not_stored(self):
+        contents = self.path.read_bytes()
+
+        assert b"SECRET_" not in contents
+        assert b"value 1" not in contents
+
+    def test_missing_entry(self):
+        with Vault(self.password, self.path) as vault:
+            with pytest.raises(LockBoxException):
+                vault.get("MISSING")
+
+    def test_wrong_passphrase(self):
+        with pytest.raises(LockBoxException):
+            Vault(b"another passphrase", self.path)
+
+    def test_swapped_rows(self):
+        with sqlite3.connect(self.path) as db:
+            db.execute("UPDATE entries SET data = (SELECT data FROM entries LIMIT 1)")
+
+        with Vault(self.password, self.path) as vault:
+            with pytest.raises(LockBoxException):
+                vault.names()
+
+    def test_not_a_vault(self):
+        path = self.temp_dir / "plain.txt"
+        path.write_bytes(b"not a database" * 100)
+
+        with pytest.raises(LockBoxException):
+            Vault(self.password, path)
+
+
+class TestStreams:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("src.lockbox.main.HASH_ITERATIONS", 1000)
+        mocker.patch("src.lockbox.main.CHUNK_SIZE", 1024)
+        self.password = b"super secret passphrase"
+        self.data = os.urandom(10_000) + b"\n\r\x00\xff"
+
+    @pytest.mark.parametrize("armor", [False, True])
+    def test_round_trip(self, armor):
+        encrypted = io.BytesIO()
+        encrypt_stream(self.password, io.BytesIO(self.data), encrypted, armor=armor)
+
+        decrypted = io.BytesIO()
+        decrypt_stream(self.password, io.BytesIO(encrypted.getvalue()), decrypted)
+        assert self.data == decrypted.getvalue()
+
+    @pytest.mark.parametrize("armor", [False, True])
+    def test_short_reads(self, armor):
+        class ShortReads(io.RawIOBase):
+            # Like a pipe that only has a few bytes ready at a time
+            def __init__(self, data):
+                self.data = io.BytesIO(data)
+
+            def readable(self):
+                return True
+
+            def readinto(self, buffer):
+                data = self.data.read(min(len(buffer), 3))
+                buffer[: len(data)] = data
+                return len(data)
+
+        encrypted = io.BytesIO()
+        encrypt_stream(self.password, io.BytesIO(self.data), encrypted, armor=armor)
+
+        decrypted = io.BytesIO()
+        decrypt_stream(self.password, ShortReads(encrypted.getvalue()), decrypted)
+        assert self.data == decrypted.getvalue()
+
+    def test_through_pipes(self):
+        # Pipes cannot seek or report their size
+        read_plain, write_plain = os.pipe()
+        read_encrypted, write_encrypted = os.pipe()
+        read_decrypted, write_decrypted = os.pipe()
+
+        def feed():
+            with open(write_plain, "wb") as outfile:
+                outfile.write(self.data)
+
+        def encrypt_pipe():
+            with (
+                open(read_plain, "rb") as infile,
+                open(write_encrypted, "wb") as outfile,
+            ):
+                encrypt_stream(self.password, infile, outfile, index=True)
+
+        def decrypt_pipe():
+            with (
+                open(read_encrypted, "rb") as infile,
+                open(write_decrypted, "wb") as outfile,
+            ):
+                decrypt_stream(self.password, infile, outfile)
+
+        threads = [
+            threading.Thread(target=fn) for fn in (feed, encrypt_pipe, decrypt_pipe)
+        ]
+        for thread in threads:
+            thread.start()
+        with open(read_decrypted, "rb") as infile:
+            assert self.data == infile.read()
+        for thread in threads:
+            thread.join()
+
+    @pytest.mark.parametrize("workers", [1, 3])
+    def test_large_regular_files_are_mapped(self, mocker, temp_dir, workers):
+        mocker.patch("src.lockbox.main.MMAP_MIN_SIZE", 1024)
+        map_file_spy = mocker.spy(main, "_map_file")
+        mapped_chunks_spy = mocker.spy(main, "_mapped_chunks")
+        plain_file = temp_dir / "plain"
+        plain_file.write_bytes(self.data)
+
+        with open(plain_file, "rb") as infile:
+            # Only what is left of the file is encrypted
+            infile.read(100)
+            encrypted = io.BytesIO()
+            encrypt_stream(
+                self.password, infile, encrypted, workers=workers, map_input=True
+            )
+            assert len(self.data) == infile.tell()
+
+        assert mapped_chunks_spy.called
+        assert map_file_spy.spy_return.closed
+        decrypted = io.BytesIO()
+        decrypt_stream(self.password, io.BytesIO(encrypted.getvalue()), decrypted)
+        assert self.data[100:] == decrypted.getvalue()
+
+    def test_empty_files_are_not_mapped(self, mocker, temp_dir):
+        mocker.patch("src.lockbox.main.MMAP_MIN_SIZE", 0)
+        mapped_chunks_spy = mocker.spy(main, "_mapped_chunks")
+        plain_file = temp_dir / "plain"
+        plain_file.write_bytes(b"")
+
+        with open(plain_file, "rb") as infile:
+            encrypted = io.BytesIO()
+            encrypt_stream(self.password, infile, encrypted, map_input=True)
+
+        assert not mapped_chunks_spy.called
+        decrypted = io.BytesIO()
+        decrypt_stream(self.password, io.BytesIO(encrypted.getvalue()), decrypted)
+        assert b"" == decrypted.getvalue()
+
+    def test_small_files_are_not_mapped(self, mocker, temp_dir):
+        mapped_chunks_spy = mocker.spy(main, "_mapped_chunks")
+        plain_file = temp_dir / "plain"
+        plain_file.write_bytes(self.data)
+        encrypted_file = temp_dir / "plain.lockbox"
+
+        encrypt_file(self.password, plain_file, output_file=encrypted_file)
+
+        assert not mapped_chunks_spy.called
+        decrypted = io.BytesIO()
+        with open(encrypted_file, "rb") as infile:
+            decrypt_stream(self.password, infile, decrypted)
+        assert self.data == decrypted.getvalue()
+
+    @pytest.mark.parametrize("output_directory", [None, "mirror"])
+    def test_directory_files_are_not_mapped(self, mocker, temp_dir, output_directory):
+        # A file truncated while it is mapped would kill the whole run
+        mocker.patch("src.lockbox.main.MMAP_MIN_SIZE", 0)
+        mapped_chunks_spy = mocker.spy(main, "_mapped_chunks")
+        source = temp_dir / "source"
+        source.mkdir()
+        (source / "plain").write_bytes(self.data)
+
+        encrypt_directory(
+            self.password,
+            source,
+            workers=2,
+            output_directory=output_directory and temp_dir / output_directory,
+        )
+
+        assert not mapped_chunks_spy.called
+
+    def test_decrypt_file_to_stdout_is_binary(self, temp_dir, capsysbinary):
+        plain_file = temp_dir / "plain"
+        plain_file.write_bytes(self.data)
+        encrypted_file = temp_dir / "plain.lockbox"
+        encrypt_file(self.password, plain_file, output_file=encrypted_file)
+
+        decrypt_file(self.password, encrypted_file)
+
+        assert self.data == capsysbinary.readouterr().out
+
+    def test_encrypt_file_to_stdout_is_armored(self, temp_dir, capsysbinary):
+        plain_file = temp_dir / "plain"
+        plain_file.write_bytes(self.data)
+
+        encrypt_file(self.password, plain_file)
+
+        decrypted = io.BytesIO()
+        output = capsysbinary.readouterr().out
+        assert output.startswith(main.HEADER_PREFIX)
+        decrypt_stream(self.password, io.BytesIO(output), decrypted)
+        assert self.data == decrypted.getvalue()
+
+
+class TestChunkSize:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        mocker.patch("src.lockbox.main.HASH_ITERATIONS", 1000)
+        self.temp_dir = temp_dir
+        self.password = b"super secret passphrase"
+        self.data = os.urandom(10_000)
+
+        self.plain_file = temp_dir / "plain"
+        self.plain_file.write_bytes(self.data)
+        self.encrypted_file = temp_dir / "plain.lockbox"
+        self.decrypted_file = temp_dir / "decrypted"
+
+    def _frames(self, path):
+        with open(path, "rb") as infile:
+            _, fields = main._read_header(infile)
+            return fields.chunk_size, len(main._scan_frames(infile))
+
+    @pytest.mark.parametrize("workers", [1, 3])
+    def test_chunk_size_is_recorded(self, workers):
+        encrypt_file(
+            self.password,
+            self.plain_file,
+            output_file=self.encrypted_file,
+            workers=workers,
+            chunk_size=1000,
+            index=True,
+        )
+
+        assert (1000, 10) == self._frames(self.encrypted_file)
+        decrypt_file(
+            self.password, self.encrypted_file, output_file=self.decrypted_file
+        )
+        assert self.data == self.decrypted_file.read_bytes()
+        assert self.data[2500:4500] == decrypt_range(
+            self.password, self.encrypted_file, 2500, 2000
+        )
+
+    @pytest.mark.parametrize("chunk_size", [0, -1, main.MAX_CHUNK_SIZE + 1])
+    def test_invalid_chunk_size_raises(self, chunk_size):
+        with pytest.raises(LockBoxException):
+            encrypt_file(
+                self.password,
+                self.plain_file,
+                output_file=self.encrypted_file,
+                chunk_size=chunk_size,
+            )
+        with pytest.raises(LockBoxException):
+            encrypt_directory(self.password, self.temp_dir, chunk_size=chunk_size)
+
+        assert self.plain_file.exists()
+
+    def test_pipes_use_small_chunks(self):
+        encrypted = io.BytesIO()
+        encrypt_stream(self.password, io.BytesIO(self.data), encrypted)
+
+        encrypted.seek(0)
+        _, fields = main._read_header(encrypted)
+        assert main.STREAM_CHUNK_SIZE == fields.chunk_size
+
+    def test_adaptive_chunk_size(self, mocker):
+        mocker.patch("src.lockbox.main.CHUNK_SIZE", 1000)
+        mocker.patch("src.lockbox.main.STREAM_CHUNK_SIZE", 500)
+        mocker.patch("src.lockbox.main.MIN_CHUNK_SIZE", 100)
+        mocker.patch("src.lockbox.main.LARGE_CHUNK_SIZE", 4000)
+        mocker.patch("src.lockbox.main.LARGE_FILE_FRAMES", 10)
+
+        assert 500 == main._chunk_size()
+        # Files smaller than a chunk get a single frame of their own size
+        assert 10 == main._chunk_size(size=10)
+        assert 1 == main._chunk_size(size=0)
+        assert 1000 == main._chunk_size(size=1000)
+        assert 2000 == main._chunk_size(size=20_000)
+        assert 4000 == main._chunk_size(size=1_000_000)
+        # Every worker gets a few frames, but frames never get too small
+        assert 500 == main._chunk_size(size=8000, workers=4)
+        assert 100 == main._chunk_size(size=1000, workers=4)
+        assert 300 == main._chunk_size(300, size=1_000_000, workers=4)
+
+    def test_small_file_chunk_size(self):
+        small_file = self.temp_dir / "small"
+        small_file.write_bytes(b"hello world")
+        encrypted_file = self.temp_dir / "small.lockbox"
+        # Set up the cipher backend first, so only the file is measured
+        encrypt_file(self.password, small_file, output_file=encrypted_file)
+
+        tracemalloc.start()
+        try:
+            encrypt_file(self.password, small_file, output_file=encrypted_file)
+            decrypt_file(self.password, encrypted_file, output_file=self.decrypted_file)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert (len(b"hello world"), 1) == self._frames(encrypted_file)
+        # Nowhere near the default chunk size
+        assert peak < main.MIN_CHUNK_SIZE
+        assert b"hello world" == self.decrypted_file.read_bytes()
+
+    def test_directory_chunk_size(self, mocker):
+        mocker.patch("src.lockbox.main.SPLIT_FRAMES", 2)
+
+        encrypt_directory(self.password, self.temp_dir, workers=3, chunk_size=1000)
+
+        # Large enough to be split between workers
+        assert (1000, 10) == self._frames(self.encrypted_file)
+        decrypt_directory(self.password, self.temp_dir)
+        assert self.data == self.plain_file.read_bytes()
+
+
+class TestCompression:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        mocker.patch("src.lockbox.main.HASH_ITERATIONS", 1000)
+        mocker.patch("src.lockbox.main.CHUNK_SIZE", 4096)
+        self.temp_dir = temp_dir
+        self.password = b"super secret passphrase"
+        self.data = b"".join(
+            b"2024-01-01 12:00:%02d INFO request %d served\n" % (i % 60, i)
+            for i in range(2000)
+        )
+
+        self.plain_file = temp_dir / "plain.log"
+        self.plain_file.write_bytes(self.data)
+        self.encrypted_file = temp_dir / "plain.log.lockbox"
+        self.decrypted_file = temp_dir / "decrypted"
+
+    def _compressions(self):
+        return [
+            name
+            for name, compression in main.COMPRESSIONS.items()
+            if compression.compress
+        ]
+
+    @pytest.mark.parametrize("armor", [False, True])
+    @pytest.mark.parametrize("workers", [1, 3])
+    def test_round_trip(self, armor, workers):
+        for compression in self._compressions():
+            encrypt_file(
+                self.password,
+                self.plain_file,
+                output_file=self.encrypted_file,
+                armor=armor,
+                workers=workers,
+                compression=compression,
+            )
+            assert self.encrypted_file.stat().st_size < len(self.data) / 4
+
+            decrypt_file(
+                self.password,
+                self.encrypted_file,
+                output_file=self.decrypted_file,
+                workers=workers,
+            )
+            assert self.data == self.decrypted_file.read_bytes()
+
+    def test_compression_is_recorded(self):
+        encrypt_file(
+            self.password,
+            self.plain_file,
+            output_file=self.encrypted_file,
+            compression="lzma",
+        )
+
+        with open(self.encrypted_file, "rb") as infile:
+            _, fields = main._read_header(infile)
+        assert main.COMPRESSIONS["lzma"] == main._header_compression(fields)
+
+    def test_incompressible_chunks_are_stored(self, mocker):
+        compress = mocker.Mock(wraps=main.zlib.compress)
+        mocker.patch.dict(
+            main.COMPRESSIONS,
+            zlib=main.COMPRESSIONS["zlib"]._replace(compress=compress),
+        )
+        data = os.urandom(4096 * 3) + self.data[:4096]
+        self.plain_file.write_bytes(data)
+
+        encrypt_file(
+            self.password,
+            self.plain_file,
+            output_file=self.encrypted_file,
+            compression="zlib",
+        )
+
+        # Only the last chunk is worth compressing
+        assert 1 == compress.call_count
+        assert self.encrypted_file.stat().st_size < len(data)
+        decrypt_file(
+            self.password, self.encrypted_file, output_file=self.decrypted_file
+        )
+        assert data == self.decrypted_file.read_bytes()
+
+    def test_range(self):
+        encrypt_file(
+            self.password,
+            self.plain_file,
+            output_file=self.encrypted_file,
+            index=True,
+            compression="zlib",
+        )
+
+        assert self.data[5000:15000] == decrypt_range(
+            self.password, self.encrypted_file, 5000, 10_000
+        )
+        assert self.data[-100:] == decrypt_range(
+            self.password, self.encrypted_file, -100, 100
+        )
+
+    def test_directory(self, mocker):
+        mocker.patch("src.lockbox.main.SPLIT_FRAMES", 2)
+        mocker.patch("src.lockbox.main.SMALL_FILE_SIZE", 1024)
+
+        encrypt_directory(self.password, self.temp_dir, workers=3, compression="zlib")
+        assert self.encrypted_file.stat().st_size < len(self.data) / 4
+
+        # Compressed frames are still split between workers when decrypting
+        split_spy = mocker.spy(main, "_decrypt_frames_at")
+        decrypt_directory(self.password, self.temp_dir, workers=3)
+        assert split_spy.called
+        assert self.data == self.plain_file.read_bytes()
+
+    def test_archive(self):
+        source = self.temp_dir / "source"
+        source.mkdir()
+        self.plain_file.rename(source / "plain.log")
+        (source / "other.log").write_bytes(self.data[:100])
+        archive = self.temp_dir / "source.lockbox"
+
+        pack_directory(self.password, source, archive, compression="zlib")
+        assert archive.stat().st_size < len(self.data) / 4
+
+        destination = self.temp_dir / "destination"
+        unpack_archive(self.password, archive, destination)
+        assert self.data == (destination / "plain.log").read_bytes()
+
+        member = self.temp_dir / "member"
+        unpack_archive(self.password, archive, member, members=["other.log"])
+        assert self.data[:100] == (member / "other.log").read_bytes()
+
+    def test_unknown_compression_raises(self):
+        with pytest.raises(LockBoxException):
+            encrypt_file(
+                self.password,
+                self.plain_file,
+                output_file=self.encrypted_file,
+                compression="rar",
+            )
+
+    def test_unavailable_compression_raises(self, mocker):
+        encrypt_file(
+            self.password,
+            self.plain_file,
+            output_file=self.encrypted_file,
+            compression="zlib",
+        )
+        mocker.patch.dict(
+            main.COMPRESSIONS,
+            zlib=main.COMPRESSIONS["zlib"]._replace(compress=None, decompress=None),
+        )
+
+        with pytest.raises(LockBoxException):
+            decrypt_file(
+                self.password, self.encrypted_file, output_file=self.decrypted_file
+            )
+
+    @pytest.mark.parametrize("name", ["zlib", "lzma", "zstd"])
+    def test_frames_are_bounded_by_the_chunk_size(self, name):
+        compression = main.COMPRESSIONS[name]
+        if not compression.compress:
+            pytest.skip(f"{name} is not available")
+
+        frame = main._compress_frame(compression, bytes(1000))
+        assert bytes(1000) == main._decompress_frame(compression, frame, 1000)
+        with pytest.raises(LockBoxException):
+            main._decompress_frame(compression, frame, 999)
+        with pytest.raises(LockBoxException):
+            main._decompress_frame(compression, main._FRAME_STORED + bytes(1000), 999)
+
+
+class TestRepository:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        mocker.patch("src.lockbox.main.HASH_ITERATIONS", 1000)
+        self.temp_dir = temp_dir
+        self.password = b"super secret passphrase"
+        self.chunk_size = 64 * 1024
+        self.path = temp_dir / "repository"
+        self.source = temp_dir / "source"
+        self.destination = temp_dir / "destination"
+
+        self.files = {
+            "big.bin": os.urandom(300_000),
+            "empty.txt": b"",
+            "nested/notes.txt": b"some notes\n" * 1000,
+        }
+        for name, data in self.files.items():
+            path = self.source / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+        (self.source / "nested" / "notes.txt").chmod(0o640)
+
+    def _open(self, **kwargs):
+        return Repository(
+            self.password, self.path, chunk_size=self.chunk_size, **kwargs
+        )
+
+    def _blobs(self):
+        return set((self.path / main.REPOSITORY_DATA).glob("*/*"))
+
+    def _assert_restored(self, destination, files=None):
+        files = files or self.files
+        for name, data in files.items():
+            assert data == (destination / name).read_bytes()
+            assert (self.source / name).stat().st_mode == (
+                destination / name
+            ).stat().st_mode
+            assert (self.source / name).stat().st_mtime_ns == (
+                destination / name
+            ).stat().st_mtime_ns
+
+    @pytest.mark.parametrize("compression", [None, "zlib"])
+    def test_round_trip(self, compression):
+        snapshot = self._open(compression=compression).backup(self.source)
+
+        # Only the key derivation and the header are needed to reopen it
+        self._open().restore(snapshot.id, self.destination)
+        self._assert_restored(self.destination)
+        assert [snapshot] == self._open().snapshots()
+
+    def test_changed_files_are_chunked_on_processes(self):
+        # Identical files are chunked at the same time and store the same chunks
+        for i in range(4):
+            (self.source / f"copy{i}.bin").write_bytes(self.files["big.bin"])
+        repository = self._open()
+
+        snapshot = repository.backup(self.source, workers=3)
+
+        repository.restore(snapshot.id, self.destination)
+        self._assert_restored(self.destination)
+        for i in range(4):
+            assert (
+                self.files["big.bin"]
+                == (self.destination / f"copy{i}.bin").read_bytes()
+            )
+        assert not any(
+            blob.name.endswith(main.PARTIAL_SUFFIX) for blob in self._blobs()
+        )
+
+    def test_unreadable_directories_keep_their_files(self, mocker):
+        repository = self._open()
+        repository.backup(self.source)
+        scandir = os.scandir
+        unreadable = os.fspath(self.source / "nested")
+
+        def flaky_scandir(path):
+            if path == unreadable:
+                raise PermissionError(path)
+            return scandir(path)
+
+        mocker.patch("src.lockbox.main.os.scandir", flaky_scandir)
+        snapshot = repository.backup(self.source)
+        mocker.patch("src.lockbox.main.os.scandir", scandir)
+
+        repository.restore(snapshot.id, self.destination)
+        self._assert_restored(self.destination)
+
+    def test_restore_refuses_symlink_at_member_path(self):
+        outside = self.temp_dir / "outside.txt"
+        outside.write_bytes(b"outside")
+        self.destination.mkdir()
+        (self.destination / "empty.txt").symlink_to(outside)
+        repository = self._open()
+        snapshot = repository.backup(self.source)
+
+        with pytest.raises(LockBoxException, match="symbolic link"):
+            repository.restore(snapshot.id, self.destination, members=["empty.txt"])
+
+        assert b"outside" == outside.read_bytes()
+
+    def test_restore_refuses_symlinked_parent_outside(self):
+        outside = self.temp_dir / "outside"
+        outside.mkdir()
+        self.destination.mkdir()
+        (self.destination / "nested").symlink_to(outside)
+        repository = self._open()
+        snapshot = repository.backup(self.source)
+
+        with pytest.raises(LockBoxException, match="outside of"):
+            repository.restore(
+                snapshot.id, self.destination, members=["nested/notes.txt"]
+            )
+
+        assert not any(outside.iterdir())
+
+    def test_restore_replaces_existing_files(self):
+        outside = self.temp_dir / "outside.txt"
+        outside.write_bytes(b"outside")
+        self.destination.mkdir()
+        os.link(outside, self.destination / "empty.txt")
+        repository = self._open()
+        snapshot = repository.backup(self.source)
+
+        repository.restore(snapshot.id, self.destination)
+
+        assert b"" == (self.destination / "empty.txt").read_bytes()
+        assert b"outside" == outside.read_bytes()
+
+    @pytest.mark.parametrize(
+        "preserve_mode, expected", [(False, 0o755), (True, 0o4755)]
+    )
+    def test_restore_special_mode_bits(self, preserve_mode, expected):
+        os.chmod(self.source / "empty.txt", 0o4755)
+        repository = self._open()
+        snapshot = repository.backup(self.source)
+
+        repository.restore(snapshot.id, self.destination, preserve_mode=preserve_mode)
+
+        mode = (self.destination / "empty.txt").stat().st_mode
+        assert expected == mode & 0o7777
+
+    def _log_lines(self, size):
+        # Text made of few distinct bytes, unlike random data
+        rand = random.Random(0)
+        words = ["GET", "POST", "/api/v1/users", "200", "404", "INFO", "request"]
+        lines = []
+        while size > 0:
+            line = "2026-10-18T12:{:02}:{:02} {} {}ms\n".format(
+                rand.randrange(60),
+                rand.randrange(60),
+                " ".join(rand.choice(words) for _ in range(8)),
+                rand.randrange(1000),
+            ).encode("utf-8")
+            lines.append(line)
+            size -= len(line)
+        return b"".join(lines)
+
+    @pytest.mark.parametrize("text", [False, True])
+    def test_content_defined_chunks(self, text):
+        data = self._log_lines(300_000) if text else self.files["big.bin"]
+        gear = self._open()._gear
+        chunks = [
+            bytes(chunk)
+            for chunk in main._content_chunks(io.BytesIO(data), gear, 65536)
+        ]
+
+        assert data == b"".join(chunks)
+        assert all(len(chunk) <= 65536 for chunk in chunks)
+        assert all(len(chunk) >= 4096 for chunk in chunks[:-1])
+        # Cuts are found from the contents rather than at the largest size
+        assert len(chunks) > len(data) // 32768
+
+        # Boundaries line up again after an insertion
+        shifted = [
+            bytes(chunk)
+            for chunk in main._content_chunks(io.BytesIO(b"x" + data), gear, 65536)
+        ]
+        assert len(set(chunks) & set(shifted)) >= len(chunks) - 2
+
+    @pytest.mark.parametrize("text", [False, True])
+    def test_gear_cuts_match_byte_at_a_time(self, mocker, text):
+        # Blocks much smaller than the chunks put many cuts near their edges
+        mocker.patch("src.lockbox.main.GEAR_BLOCK_SIZE", 7)
+        data = self._log_lines(50_000) if text else self.files["big.bin"][:50_000]
+        gear = self._open()._gear
+
+        expected = []
+        start = 0
+        while start < len(data):
+            end = min(start + 1024, len(data))
+            cut = end
+            h = 0
+            for position in range(start + 64, end):
+                h = (h + h + gear[data[position]]) & 0xFFFFFFFF
+                mask = 0xFF000000 if position < start + 128 else 0xFC000000
+                if end - start > 64 and not h & mask:
+                    cut = position + 1
+                    break
+            expected.append(data[start:cut])
+            start = cut
+
+        actual = [
+            bytes(chunk) for chunk in main._content_chunks(io.BytesIO(data), gear, 1024)
+        ]
+        assert expected == actual
+
+    @pytest.mark.parametrize("chunk_size", [1, 8, main.REPOSITORY_MIN_CHUNK_SIZE - 1])
+    def test_small_chunk_size_raises(self, chunk_size):
+        with pytest.raises(LockBoxException, match="at least"):
+            Repository(self.password, self.path, chunk_size=chunk_size)
+
+    def test_smallest_chunk_size(self):
+        data = self.files["nested/notes.txt"]
+        size = main.REPOSITORY_MIN_CHUNK_SIZE
+        chunks = [
+            bytes(chunk)
+            for chunk in main._content_chunks(
+                io.BytesIO(data), self._open()._gear, size
+            )
+        ]
+
+        assert data == b"".join(chunks)
+        assert all(size // 16 < len(chunk) <= size for chunk in chunks[:-1])
+
+    def test_unchanged_data_is_stored_once(self, mocker):
+        repository = self._open()
+        first = repository.backup(self.source)
+        blobs = self._blobs()
+
+        # Unchanged files are not even read
+        content_chunks_spy = mocker.spy(main, "_content_chunks")
+        second = repository.backup(self.source)
+        assert not content_chunks_spy.called
+        assert blobs == self._blobs()
+        repository.restore(first.id, self.destination)
+        self._assert_restored(self.destination)
+
+        big = self.source / "big.bin"
+        big.write_bytes(b"a few new bytes" + self.files["big.bin"])
+        third = repository.backup(self.source)
+        assert 1 == content_chunks_spy.call_count
+        assert len(self._blobs() - blobs) <= 2
+
+        repository.restore("latest", self.destination / "latest")
+        assert (
+            big.read_bytes() == (self.destination / "latest" / "big.bin").read_bytes()
+        )
+        assert [first, second, third] == repository.snapshots()
+
+    def test_restore_members(self):
+        repository = self._open()
+        snapshot = repository.backup(self.source)
+
+        repository.restore(snapshot.id, self.destination, members=["nested/notes.txt"])
+        assert ["nested/notes.txt"] == [
+            path.relative_to(self.destination).as_posix()
+            for path in self.destination.rglob("*")
+            if path.is_file()
+        ]
+
+        with pytest.raises(LockBoxException):
+            repository.restore(snapshot.id, self.destination, members=["missing"])
+
+    def test_forget(self):
+        repository = self._open()
+        first = repository.backup(self.source)
+        (self.source / "big.bin").write_bytes(os.urandom(100_000))
+        second = repository.backup(self.source)
+        blobs = self._blobs()
+
+        assert repository.forget(first.id) > 0
+        assert [second] == repository.snapshots()
+        assert self._blobs() < blobs
+
+        repository.restore(second.id, self.destination)
+        assert (self.source / "big.bin").read_bytes() == (
+            self.destination / "big.bin"
+        ).read_bytes()
+
+        with pytest.raises(LockBoxException):
+            repository.forget(first.id)
+
+    def test_wrong_passphrase_raises(self):
+        self._open().backup(self.source)
+
+        with pytest.raises(LockBoxException):
+            Repository(b"wrong passphrase", self.path)
+
+    def test_tampered_chunk_raises(self):
+        repository = self._open()
+        snapshot = repository.backup(self.source)
+        blob = next(iter(self._blobs()))
+        data = bytearray(blob.read_bytes())
+        data[-1] ^= 1
+        blob.write_bytes(data)
+
+        with pytest.raises(LockBoxException):
+            repository.restore(snapshot.id, self.destination)
+
+    @pytest.mark.parametrize("snapshot_id", ["../config", "latest", "00" * 8])
+    def test_unknown_snapshot_raises(self, snapshot_id):
+        with pytest.raises(LockBoxException):
+            self._open().restore(snapshot_id, self.destination)
+
+    def test_not_a_repository_raises(self):
+        with pytest.raises(LockBoxException):
+            Repository(self.password, self.source)
+
+    def test_repository_inside_source_raises(self):
+        with pytest.raises(LockBoxException):
+            Repository(self.password, self.source / "repository").backup(self.source)
@@ -1,10 +1,23 @@
 import pytest
+import runpy
 
 from pathlib import Path
 from src.lockbox.cli import (
     cli_encrypt,
     cli_decrypt,
+    cli_pack,
+    cli_unpack,
+    cli_agent,
+    cli_agent_stop,
+    cli_vault_get,
+    cli_vault_set,
+    cli_vault_list,
+    cli_repo_backup,
+    cli_repo_snapshots,
+    cli_repo_restore,
+    cli_repo_forget,
 )
+from src.lockbox.main import LockBoxException, Snapshot
 
 
 class TestCliEncrypt:
@@ -37,6 +50,72 @@ class TestCliEncrypt:
             self.mock_encrypt.return_value.decode.return_value
         )
 
+    def test_recursive_into_output_directory(self):
+        output_directory = self.temp_dir / "mirror"
+        output_directory.mkdir()
+
+        cli_encrypt(
+            self.passphrase,
+            infile=self.temp_dir,
+            outfile=output_directory,
+            recursive=True,
+            incremental=True,
+        )
+
+        self.mock_encrypt_directory.assert_called_once_with(
+            self.passphrase,
+            self.temp_dir,
+            cipher="auto",
+            workers=1,
+            pool="thread",
+            output_directory=output_directory,
+            incremental=True,
+            resume=False,
+            chunk_size=None,
+            compression=None,
+        )
+
+    def test_input_from_file_armored(self):
+        infile = self.temp_dir / "test_infile"
+        infile.write_bytes(b"test_data")
+
+        expected = None
+        actual = cli_encrypt(self.passphrase, infile=infile, armor=True)
+
+        assert expected == actual
+        self.mock_encrypt_file.assert_called_once_with(
+            self.passphrase,
+            infile,
+            output_file=self.temp_dir / "test_infile.lockbox",
+            remove_original=False,
+            armor=True,
+            cipher="auto",
+            index=False,
+            pipeline=False,
+            workers=1,
+            chunk_size=None,
+            compression=None,
+        )
+        assert not self.mock_encrypt.called
+
+    def test_input_from_file_with_chunk_size(self):
+        infile = self.temp_dir / "test_infile"
+        infile.write_bytes(b"test_data")
+
+        cli_encrypt(self.passphrase, infile=infile, chunk_size="64k")
+
+        _, kwargs = self.mock_encrypt_file.call_args
+        assert 64 * 1024 == kwargs["chunk_size"]
+
+    def test_invalid_chunk_size_raises(self):
+        infile = self.temp_dir / "test_infile"
+        infile.write_bytes(b"test_data")
+
+        with pytest.raises(LockBoxException):
+            cli_encrypt(self.passphrase, infile=infile, chunk_size="16X")
+
+        assert not self.mock_encrypt_file.called
+
 
 class TestCliDecrypt:
     @pytest.fixture(autouse=True)
@@ -50,6 +129,8 @@ class TestCliDecrypt:
 
         self.mock_decrypt_directory = mocker.patch("src.lockbox.cli.decrypt_directory")
 
+        self.mock_decrypt_range = mocker.patch("src.lockbox.cli.decrypt_range")
+
         self.mock_print = mocker.patch("src.lockbox.cli.print")
 
         self.passphrase = b"test_passphrase"
@@ -73,3 +154,452 @@ class TestCliDecrypt:
         )
         assert not self.mock_decrypt_file.called
         assert not self.mock_decrypt_directory.called
+
+    def test_input_from_file_with_jobs(self):
+        infile = self.temp_dir / "test_infile.lockbox"
+        infile.write_bytes(b"test_encrypted_data")
+
+        expected = None
+        actual = cli_decrypt(self.passphrase, infile=infile, jobs=4)
+
+        assert expected == actual
+        self.mock_decrypt_file.assert_called_once_with(
+            self.passphrase,
+            infile,
+            output_file=self.temp_dir / "test_infile",
+            remove_original=False,
+            workers=4,
+            pipeline=False,
+        )
+        assert not self.mock_decrypt.called
+        assert not self.mock_decrypt_directory.called
+
+    def test_input_from_file_with_range(self, mocker):
+        mock_sys = mocker.patch("src.lockbox.cli.sys")
+        infile = self.temp_dir / "test_infile.lockbox"
+        infile.write_bytes(b"test_encrypted_data")
+
+        expected = None
+        actual = cli_decrypt(self.passphrase, infile=infile, byte_range="-10:5")
+
+        assert expected == actual
+        self.mock_decrypt_range.assert_called_once_with(
+            self.passphrase, infile, -10, 5, output_file=None
+        )
+        mock_sys.stdout.buffer.write.assert_called_once_with(
+            self.mock_decrypt_range.return_value
+        )
+        mock_sys.stdout.buffer.flush.assert_called_once_with()
+        assert not self.mock_print.called
+        assert not self.mock_decrypt_file.called
+
+    def test_input_from_file_with_range_to_file(self):
+        infile = self.temp_dir / "test_infile.lockbox"
+        infile.write_bytes(b"test_encrypted_data")
+        outfile = self.temp_dir / "range"
+
+        cli_decrypt(self.passphrase, infile=infile, outfile=outfile, byte_range="0:5")
+
+        self.mock_decrypt_range.assert_called_once_with(
+            self.passphrase, infile, 0, 5, output_file=outfile
+        )
+        assert not self.mock_print.called
+
+    def test_invalid_range_raises(self):
+        infile = self.temp_dir / "test_infile.lockbox"
+        infile.write_bytes(b"test_encrypted_data")
+
+        with pytest.raises(LockBoxException):
+            cli_decrypt(self.passphrase, infile=infile, byte_range="10")
+
+        assert not self.mock_decrypt_range.called
+
+    def test_recursive_with_jobs(self):
+        expected = None
+        actual = cli_decrypt(
+            self.passphrase,
+            infile=self.temp_dir,
+            recursive=True,
+            jobs=4,
+            pool="process",
+            resume=True,
+        )
+
+        assert expected == actual
+        self.mock_decrypt_directory.assert_called_once_with(
+            self.passphrase, self.temp_dir, workers=4, pool="process", resume=True
+        )
+        assert not self.mock_decrypt_file.called
+
+
+class TestCliPack:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+
+        self.mock_getpass = mocker.patch("src.lockbox.cli.getpass.getpass")
+        self.mock_pack_directory = mocker.patch("src.lockbox.cli.pack_directory")
+        self.mock_unpack_archive = mocker.patch("src.lockbox.cli.unpack_archive")
+        self.mock_print = mocker.patch("src.lockbox.cli.print")
+
+        self.passphrase = b"test_passphrase"
+        self.mock_getpass.return_value = "test_passphrase"
+
+    def test_pack_default_output(self):
+        directory = self.temp_dir / "configs"
+        directory.mkdir()
+
+        cli_pack(self.passphrase, directory, cipher="aes-256-gcm", compression="lzma")
+
+        self.mock_pack_directory.assert_called_once_with(
+            self.passphrase,
+            directory,
+            self.temp_dir / "configs.lockbox",
+            cipher="aes-256-gcm",
+            compression="lzma",
+        )
+
+    def test_pack_file_raises(self):
+        infile = self.temp_dir / "file.txt"
+        infile.write_text("test")
+
+        with pytest.raises(LockBoxException):
+            cli_pack(self.passphrase, infile, outfile=self.temp_dir / "out")
+
+        assert not self.mock_pack_directory.called
+
+    def test_unpack_default_output(self):
+        archive = self.temp_dir / "configs.lockbox"
+        archive.write_bytes(b"")
+
+        cli_unpack(self.passphrase, archive)
+
+        self.mock_unpack_archive.assert_called_once_with(
+            self.passphrase,
+            archive,
+            self.temp_dir / "configs",
+            members=None,
+            preserve_mode=False,
+        )
+
+    def test_unpack_members(self):
+        archive = self.temp_dir / "configs.lockbox"
+        archive.write_bytes(b"")
+
+        cli_unpack(
+            self.passphrase,
+            archive,
+            outfile=self.temp_dir / "restore",
+            members=["app/settings.toml"],
+            preserve_mode=True,
+        )
+
+        self.mock_unpack_archive.assert_called_once_with(
+            self.passphrase,
+            archive,
+            self.temp_dir / "restore",
+            members=["app/settings.toml"],
+            preserve_mode=True,
+        )
+
+    def test_unpack_unknown_output_raises(self):
+        archive = self.temp_dir / "configs.tar"
+        archive.write_bytes(b"")
+
+        with pytest.raises(LockBoxException):
+            cli_unpack(self.passphrase, archive)
+
+        assert not self.mock_unpack_archive.called
+
+
+class TestCliAgent:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+
+        self.mock_getpass = mocker.patch("src.lockbox.cli.getpass.getpass")
+        self.mock_agent = mocker.patch("src.lockbox.cli.Agent")
+        self.mock_connect_agent = mocker.patch("src.lockbox.cli.connect_agent")
+        self.mock_encrypt = mocker.patch("src.lockbox.cli.encrypt")
+        self.mock_print = mocker.patch("src.lockbox.cli.print")
+
+        self.passphrase = b"test_passphrase"
+        self.mock_getpass.return_value = "test_passphrase"
+        self.socket_path = self.temp_dir / "agent.sock"
+
+    def test_agent_in_foreground(self):
+        self.mock_agent.return_value.path = self.socket_path
+
+        cli_agent(
+            self.passphrase, socket_path=self.socket_path, ttl=10, foreground=True
+        )
+
+        self.mock_agent.assert_called_once_with(
+            self.passphrase, path=self.socket_path, ttl=10
+        )
+        self.mock_agent.return_value.run.assert_called_once_with()
+        self.mock_print.assert_called_once_with(
+            f"LOCKBOX_AGENT_SOCK={self.socket_path}; export LOCKBOX_AGENT_SOCK;"
+        )
+
+    def test_agent_passphrase_mismatch(self):
+        self.mock_getpass.return_value = "another passphrase"
+
+        with pytest.raises(LockBoxException):
+            cli_agent(self.passphrase, foreground=True)
+
+        assert not self.mock_agent.called
+
+    def test_encrypt_through_agent_does_not_confirm(self):
+        client = self.mock_connect_agent.return_value
+
+        cli_encrypt(client, data="test_string")
+
+        assert not self.mock_getpass.called
+        self.mock_encrypt.assert_called_once_with(client, "test_string", outfile=None)
+
+    def test_stop(self):
+        cli_agent_stop(self.socket_path)
+
+        self.mock_connect_agent.assert_called_once_with(self.socket_path)
+        self.mock_connect_agent.return_value.stop.assert_called_once_with()
+
+    def test_stop_without_agent(self):
+        self.mock_connect_agent.return_value = None
+
+        with pytest.raises(LockBoxException):
+            cli_agent_stop(self.socket_path)
+
+
+class TestCliVault:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+
+        self.mock_getpass = mocker.patch("src.lockbox.cli.getpass.getpass")
+        self.mock_vault = mocker.patch("src.lockbox.cli.Vault")
+        self.mock_print = mocker.patch("src.lockbox.cli.print")
+        self.mock_sys = mocker.patch("src.lockbox.cli.sys")
+        self.opened = self.mock_vault.return_value.__enter__.return_value
+
+        self.passphrase = b"test_passphrase"
+        self.mock_getpass.return_value = "test_passphrase"
+        self.vault = self.temp_dir / "secrets.vault"
+
+    def test_get(self):
+        self.vault.write_bytes(b"")
+        self.opened.get.return_value = b"value"
+
+        cli_vault_get(self.passphrase, self.vault, "NAME")
+
+        self.mock_vault.assert_called_once_with(self.passphrase, self.vault)
+        self.opened.get.assert_called_once_with("NAME")
+        self.mock_sys.stdout.buffer.write.assert_called_once_with(b"value")
+        self.mock_sys.stdout.buffer.flush.assert_called_once_with()
+        assert not self.mock_print.called
+
+    def test_get_binary(self):
+        self.vault.write_bytes(b"")
+        self.opened.get.return_value = b"\x00\xff\xfe"
+
+        cli_vault_get(self.passphrase, self.vault, "NAME")
+
+        self.mock_sys.stdout.buffer.write.assert_called_once_with(b"\x00\xff\xfe")
+
+    def test_get_missing_vault(self):
+        with pytest.raises(LockBoxException):
+            cli_vault_get(self.passphrase, self.vault, "NAME")
+
+        assert not self.mock_vault.called
+
+    def test_set_new_vault_confirms_passphrase(self):
+        cli_vault_set(self.passphrase, self.vault, "NAME", "value")
+
+        self.mock_getpass.assert_called_once_with("Confirm passphrase: ")
+        self.opened.set.assert_called_once_with("NAME", "value")
+
+    def test_set_existing_vault(self):
+        self.vault.write_bytes(b"")
+
+        cli_vault_set(self.passphrase, self.vault, "NAME", "value", cipher="fernet")
+
+        assert not self.mock_getpass.called
+        self.mock_vault.assert_called_once_with(
+            self.passphrase, self.vault, cipher="fernet"
+        )
+
+    def test_list(self):
+        self.vault.write_bytes(b"")
+        self.opened.names.return_value = ["A", "B"]
+
+        cli_vault_list(self.passphrase, self.vault)
+
+        assert [call.args for call in self.mock_print.call_args_list] == [
+            ("A",),
+            ("B",),
+        ]
+
+
+class TestCliRepository:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+
+        self.mock_getpass = mocker.patch("src.lockbox.cli.getpass.getpass")
+        self.mock_repository = mocker.patch("src.lockbox.cli.Repository")
+        self.mock_print = mocker.patch("src.lockbox.cli.print")
+        self.opened = self.mock_repository.return_value
+
+        self.passphrase = b"test_passphrase"
+        self.mock_getpass.return_value = "test_passphrase"
+        self.repository = self.temp_dir / "backups"
+
+    def _create(self):
+        self.repository.mkdir()
+        (self.repository / "config").write_bytes(b"")
+
+    def test_backup_new_repository_confirms_passphrase(self):
+        cli_repo_backup(self.passphrase, self.repository, "source", compression="zlib")
+
+        self.mock_getpass.assert_called_once_with("Confirm passphrase: ")
+        self.mock_repository.assert_called_once_with(
+            self.passphrase, self.repository, cipher="auto", compression="zlib"
+        )
+        self.opened.backup.assert_called_once_with(Path("source"), workers=1)
+
+    def test_backup_existing_repository(self):
+        self._create()
+
+        cli_repo_backup(self.passphrase, self.repository, "source", jobs=4)
+
+        assert not self.mock_getpass.called
+        self.opened.backup.assert_called_once_with(Path("source"), workers=4)
+
+    def test_snapshots(self):
+        self._create()
+        self.opened.snapshots.return_value = [
+            Snapshot("0123456789abcdef", 0, "/source")
+        ]
+
+        cli_repo_snapshots(self.passphrase, self.repository)
+
+        (args,) = [call.args for call in self.mock_print.call_args_list]
+        assert args[0].startswith("0123456789abcdef  ")
+        assert args[0].endswith("  /source")
+
+    def test_restore_missing_repository(self):
+        with pytest.raises(LockBoxException):
+            cli_repo_restore(self.passphrase, self.repository, "latest", "out")
+
+        assert not self.mock_repository.called
+
+    def test_restore(self):
+        self._create()
+
+        cli_repo_restore(
+            self.passphrase,
+            self.repository,
+            "latest",
+            "out",
+            members=["a.txt"],
+            preserve_mode=True,
+        )
+
+        self.opened.restore.assert_called_once_with(
+            "latest", Path("out"), members=["a.txt"], preserve_mode=True
+        )
+
+    def test_forget(self):
+        self._create()
+
+        cli_repo_forget(self.passphrase, self.repository, "0123456789abcdef")
+
+        self.opened.forget.assert_called_once_with("0123456789abcdef")
+
+
+class TestCliStreams:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_dir):
+        self.temp_dir = temp_dir
+
+        self.mock_getpass = mocker.patch("src.lockbox.cli.getpass.getpass")
+        self.mock_encrypt_stream = mocker.patch("src.lockbox.cli.encrypt_stream")
+        self.mock_decrypt_stream = mocker.patch("src.lockbox.cli.decrypt_stream")
+        self.mock_sys = mocker.patch("src.lockbox.cli.sys")
+        self.mock_stdin = self.mock_sys.stdin
+        self.mock_stdout = self.mock_sys.stdout
+        self.mock_stdout.isatty.return_value = False
+
+        self.passphrase = b"test_passphrase"
+        self.mock_getpass.return_value = "test_passphrase"
+
+    def test_encrypt_to_stdout(self):
+        cli_encrypt(self.passphrase, infile="-", jobs=2)
+
+        self.mock_encrypt_stream.assert_called_once_with(
+            self.passphrase,
+            self.mock_stdin.buffer,
+            self.mock_stdout.buffer,
+            armor=False,
+            cipher="auto",
+            index=False,
+            pipeline=False,
+            workers=2,
+            chunk_size=None,
+            compression=None,
+        )
+        self.mock_stdout.buffer.flush.assert_called_once_with()
+
+    def test_encrypt_binary_to_terminal(self):
+        self.mock_stdout.isatty.return_value = True
+
+        with pytest.raises(LockBoxException):
+            cli_encrypt(self.passphrase, infile="-")
+
+        assert not self.mock_encrypt_stream.called
+
+    def test_encrypt_armored_to_terminal(self):
+        self.mock_stdout.isatty.return_value = True
+
+        cli_encrypt(self.passphrase, infile="-", armor=True)
+
+        assert self.mock_encrypt_stream.called
+
+    def test_decrypt_to_file(self):
+        outfile = self.temp_dir / "out"
+
+        cli_decrypt(self.passphrase, infile="-", outfile=outfile)
+
+        args, kwargs = self.mock_decrypt_stream.call_args
+        assert (self.passphrase, self.mock_stdin.buffer) == args[:2]
+        assert outfile == Path(args[2].name)
+        assert {"workers": 1, "pipeline": False} == kwargs
+        assert outfile.exists()
+
+
+class TestParser:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        # The script parses sys.argv as it is loaded
+        mocker.patch("sys.argv", ["lockbox"])
+        script = Path(__file__).parents[2] / "lockbox"
+        self.parser = runpy.run_path(str(script))["parser"]
+
+    @pytest.mark.parametrize(
+        "option, expected",
+        [
+            (["--range", "100:50"], "100:50"),
+            (["--range=100:50"], "100:50"),
+            (["--range=-100:50"], "-100:50"),
+        ],
+    )
+    def test_decrypt_range(self, option, expected):
+        args = self.parser.parse_args(["decrypt", "-i", "f.lockbox", *option])
+
+        assert expected == args.byte_range
+
+    def test_negative_range_needs_equals(self, capsys):
+        with pytest.raises(SystemExit):
+            self.parser.parse_args(["decrypt", "-i", "f.lockbox", "--range", "-100:50"])
+
+        assert "expected one argument" in capsys.readouterr().err